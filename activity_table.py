@@ -0,0 +1,165 @@
+import os
+import threading
+import urllib.parse
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from parameters import *
+
+
+# The activity summaries as a typed, columnar table: one Parquet file per athlete, year and activity type, under
+# activities/athlete_id=<id>/year=<year>/type=<type>/. Reads only open the partitions that match their filter, and
+# only the columns they ask for, so e.g. the map pages never touch descriptions or polylines.
+# Nested fields get flattened: start/end positions become separate latitude/longitude columns and the map becomes its
+# summary polyline. Gear details and segment efforts are left out, gear has its own table in the store.
+ACTIVITY_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('name', pa.string()),
+    ('description', pa.string()),
+    ('athlete_count', pa.int16()),
+    ('distance', pa.float32()),
+    ('moving_time', pa.float32()),
+    ('total_elevation_gain', pa.float32()),
+    ('elev_high', pa.float32()),
+    ('elev_low', pa.float32()),
+    ('average_speed', pa.float32()),
+    ('max_speed', pa.float32()),
+    ('gear_id', pa.string()),
+    ('has_heartrate', pa.bool_()),
+    ('workout_type', pa.int8()),
+    ('calories', pa.float32()),
+    ('start_date', pa.timestamp('s', tz='UTC')),
+    ('start_lat', pa.float64()),
+    ('start_lng', pa.float64()),
+    ('end_lat', pa.float64()),
+    ('end_lng', pa.float64()),
+    ('summary_polyline', pa.string()),
+])
+PARTITION_SCHEMA = pa.schema([('year', pa.int16()), ('type', pa.string())])
+NULLABLE_TYPES = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype()}
+
+
+def _latLng(value, index):
+    # start_latlng/end_latlng are [lat, lng], or empty for activities without a route
+    if value is None or len(value) < 2:
+        return None
+    return float(value[index])
+
+
+def _utcTimestamp(value):
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tzinfo is None else value.tz_convert('UTC')
+
+
+def flattenActivity(activity) -> dict:
+    # A raw activity dict (as in the /athlete/activities response) to one row of ACTIVITY_SCHEMA, plus its type
+    start_date = activity.get('start_date')
+    if start_date is not None:
+        start_date = _utcTimestamp(start_date)
+    row = {col: activity.get(col) for col in ACTIVITY_SCHEMA.names}
+    row.update({
+        'start_date': None if start_date is None else start_date.to_pydatetime(),
+        'start_lat': _latLng(activity.get('start_latlng'), 0),
+        'start_lng': _latLng(activity.get('start_latlng'), 1),
+        'end_lat': _latLng(activity.get('end_latlng'), 0),
+        'end_lng': _latLng(activity.get('end_latlng'), 1),
+        'summary_polyline': (activity.get('map') or {}).get('summary_polyline') or None,
+        'type': activity.get('type') or 'Other',
+    })
+    return row
+
+
+class ActivityTable:
+    def __init__(self, root=os.path.join(STORE_PATH, 'activities')):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _athleteDir(self, athlete_id) -> str:
+        return os.path.join(self.root, f"athlete_id={athlete_id}")
+
+    def _partitionPath(self, athlete_id, year, kind) -> str:
+        return os.path.join(self._athleteDir(athlete_id), f"year={year}",
+                            f"type={urllib.parse.quote(kind, safe='')}", 'part-0.parquet')
+
+    def exists(self, athlete_id) -> bool:
+        return os.path.isdir(self._athleteDir(athlete_id))
+
+    def write(self, athlete_id, activity_dicts) -> int:
+        # Adds or replaces activities (by id). Only the partitions they fall into get rewritten.
+        partitions = {}
+        for activity in activity_dicts:
+            row = flattenActivity(activity)
+            if row['start_date'] is None:
+                continue
+            partitions.setdefault((row['start_date'].year, row.pop('type')), []).append(row)
+
+        with self._lock:
+            for (year, kind), rows in partitions.items():
+                table = pa.Table.from_pylist(rows, schema=ACTIVITY_SCHEMA)
+                path = self._partitionPath(athlete_id, year, kind)
+                if os.path.exists(path):
+                    table = pa.concat_tables([pq.read_table(path, schema=ACTIVITY_SCHEMA), table])
+                self._writePartition(path, table)
+        return sum(len(x) for x in partitions.values())
+
+    def delete(self, athlete_id, year, kind, id_list) -> None:
+        # Used when an activity moves to another partition, e.g. because its type was changed on Strava
+        path = self._partitionPath(athlete_id, year, kind)
+        with self._lock:
+            if not os.path.exists(path):
+                return
+            table = pq.read_table(path, schema=ACTIVITY_SCHEMA)
+            table = table.filter(pc.invert(pc.is_in(table['id'], pa.array(id_list, pa.int64()))))
+            self._writePartition(path, table)
+
+    @staticmethod
+    def _writePartition(path, table) -> None:
+        # Newest version of every activity, sorted by start date so the row group statistics are useful for filtering
+        # on it. Written next to the old file first (hidden, so readers skip it), then swapped in.
+        frame = table.to_pandas().drop_duplicates('id', keep='last').sort_values('start_date')
+        table = pa.Table.from_pandas(frame, schema=ACTIVITY_SCHEMA, preserve_index=False)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{threading.get_ident()}.tmp")
+        pq.write_table(table, temp_path, compression='zstd')
+        os.replace(temp_path, path)
+
+    def read(self, athlete_id, columns=None, types=None, since=None, until=None) -> pd.DataFrame:
+        # Activities of one athlete, newest first. columns picks the columns to read ('type' and 'year' are the
+        # partition columns), types the activity types, since/until (inclusive/exclusive) a range of start dates.
+        # The filters go down to the Parquet reader: partitions that can't match are skipped entirely.
+        if columns is None:
+            columns = ACTIVITY_SCHEMA.names + ['type']
+        schema = pa.unify_schemas([ACTIVITY_SCHEMA, PARTITION_SCHEMA])
+        if not self.exists(athlete_id):
+            # Typed like any other read, so callers can still use e.g. .dt on start_date
+            frame = schema.empty_table().to_pandas(types_mapper=NULLABLE_TYPES.get)
+            frame['type'] = frame['type'].astype('category')
+            return frame[list(columns)]
+
+        dataset = ds.dataset(self._athleteDir(athlete_id), format='parquet', schema=schema,
+                             partitioning=ds.partitioning(PARTITION_SCHEMA, flavor='hive'))
+        conditions = []
+        if types is not None:
+            conditions.append(ds.field('type').isin(list(types)))
+        if since is not None:
+            since = _utcTimestamp(since)
+            conditions += [ds.field('year') >= since.year, ds.field('start_date') >= since]
+        if until is not None:
+            until = _utcTimestamp(until)
+            conditions += [ds.field('year') <= until.year, ds.field('start_date') < until]
+        condition = None
+        for x in conditions:
+            condition = x if condition is None else condition & x
+
+        read_columns = list(columns) if 'start_date' in columns else list(columns) + ['start_date']
+        # Nullable integers stay integers, rather than turning into floats
+        frame = dataset.to_table(columns=read_columns, filter=condition).to_pandas(types_mapper=NULLABLE_TYPES.get)
+        frame = frame.sort_values('start_date', ascending=False, ignore_index=True)
+        if 'type' in frame:
+            frame['type'] = frame['type'].astype('category')
+        return frame[list(columns)]
@@ -1,17 +1,32 @@
 import dash
-from dash import Input, Output, State, ctx
+import flask
+import folium
+from dash import Input, Output, State, ClientsideFunction, ctx
 
-from stravalib import Client
-import datetime as dt
-import requests
+import os
 
 import pandas as pd
-import json
 
 from static_layout import *
 from parameters import *
 import functions as fun
-import debug_functions as defun
+import simplify as simp
+import geometry as geom
+from sessions import SessionRegistry
+from store import ActivityStore
+from sync import syncActivities
+from heatmap import HeatmapTiles
+from render_cache import RenderCache
+from spatial_index import SpatialIndex
+from routes import RouteClusterer
+from best_efforts import BestEffortsEngine
+from features import FeatureEngine
+from derived import DerivedEngine
+from fitness import FitnessEngine
+from gear import GearTracker
+from journal import ResponseJournal, streamPayload
+from jobs import JobRunner
+from metrics import metrics
 
 
 class DashApp:
@@ -21,18 +36,25 @@ class DashApp:
         self.client_secret = _client_secret
         self.client_refresh = _client_refresh
 
-        self.access_token = None
-        self.refresh_token = None
-        self.expires_at = None
-        self.expires_in = None
-        self.already_authorised = False
-
-        # Track the current state of the app
-        self.logged_in = False
-
-        # Strava data
-        self.client = Client()
-        self.athlete = None
+        # Strava clients and tokens, one set per logged-in user
+        self.sessions = SessionRegistry(self.client_id, self.client_secret)
+
+        # Local copy of everything fetched so far, so a sync only needs to fetch what's new
+        self.store = ActivityStore()
+        # Every raw response from Strava, to replay the store from (see journal.py)
+        self.journal = ResponseJournal() if JOURNAL_ENABLED else None
+        self.heatmap = HeatmapTiles()
+        self.render_cache = RenderCache()
+        self.spatial_index = SpatialIndex(self.store)
+        self.route_clusterer = RouteClusterer(self.store)
+        self.best_efforts = BestEffortsEngine(self.store)
+        self.derived = DerivedEngine(self.store)
+        self.features = FeatureEngine(self.store)
+        self.fitness = FitnessEngine(self.store)
+        self.gear = GearTracker(self.store, journal=self.journal)
+
+        # Background jobs, so fetching data doesn't block the page
+        self.jobs = JobRunner()
 
         # Generate app instance
         self.app = dash.Dash(__name__,
@@ -46,11 +68,7 @@ class DashApp:
                 html.Div(id='hidden_div'),
                 dcc.Interval(id='init_load_timer', n_intervals=0, max_intervals=1, interval=100),
                 dcc.Location(id='current_url'),
-                dcc.Store(id='access_token', storage_type='session'),
-                dcc.Store(id='refresh_token', storage_type='session'),
-                dcc.Store(id='expires_at', storage_type='session'),
-                dcc.Store(id='expires_in', storage_type='session'),
-                dcc.Store(id='expires_timestamp', storage_type='session'),
+                dcc.Store(id='session_id', storage_type='session'),
                 dcc.Store(id='already_authorised', data=False),
                 dcc.Store(id='logged_in', storage_type='session', data=False),
 
@@ -60,36 +78,45 @@ class DashApp:
                 #   and the URL contains no auth-code. We need to go through OAUTH first.
                 # 2. We've been redirected here after the Strava OAUTH. There's no access token yet, but there's an
                 #   auth-code in the URL, with which we can retrieve our access/refresh tokens.
-                # 3. We've loaded an existing access/refresh token from the dcc.Store elements. We can check whether
-                #   they're still valid (via the expires_at item in storage). If not, fetch an updated token. Otherwise,
-                #   just use the loaded one as a valid one.
-                #
-                # Addendum: If a user wants to fetch an update, the app should check again whether the tokens are still
-                # valid.
+                # 3. We've loaded an existing session id from the dcc.Store. The tokens belonging to it live in
+                #   self.sessions, which keeps them fresh.
                 html.Div(children=[], id='page_content'),
             ],
             id='app_layout',
         )
 
-        # Generate all callbacks
+        # Generate all callbacks and routes
         self.addCallbacks()
+        self.addRoutes()
 
     # Define methods here. The final method is the one generating all callbacks
-    def setTokens(self, response, request_type) -> None:
-        # Store the various bits of information into separate variables, for ease.
-        # Some of the responses give the same structure, but Strava API is weird.
-        self.access_token = response['access_token']
-        self.refresh_token = response['refresh_token']
-        self.already_authorised = True
-
-        if request_type == "authorise":
-            self.expires_at = dt.datetime.fromtimestamp(response['expires_at'], dt.timezone.utc)
-            self.expires_in = (self.expires_at - dt.datetime.now(dt.timezone.utc)).total_seconds()
-        elif request_type == "refresh":
-            self.expires_at = response['expires_at']
-            self.expires_in = response['expires_in']
-
-    def genPolyLineList(self, base_list, fetch_data_types, id_list):
+    def fetchMissingStreams(self, user, id_list, fetch_data_types, progress=None,
+                            resolution=MAP_STREAM_RESOLUTION) -> list:
+        # Only fetch the streams we don't have yet at this resolution (or finer), concurrently, and add them to the
+        # store as they come in, so the progressive map can show them while the rest are still being fetched. Returns
+        # the ids that still don't have them, because fetching failed.
+        missing_id_list = self.store.missingStreams(user.athlete.id, id_list, fetch_data_types, resolution)
+        failed_id_list = []
+        with metrics.stage('stream_fetch', athlete_id=user.athlete.id, resolution=resolution,
+                           activities=len(missing_id_list)):
+            fetched_streams = user.stream_fetcher.iterStreams(missing_id_list, fetch_data_types, resolution, progress)
+            for activity_id, activity_stream in zip(missing_id_list, fetched_streams):
+                if activity_stream is None:
+                    failed_id_list.append(activity_id)
+                    continue
+                if self.journal is not None:
+                    self.journal.record('streams', user.athlete.id, activity_id, streamPayload(activity_stream),
+                                        {'types': fetch_data_types, 'resolution': resolution})
+                self.store.saveStreams(user.athlete.id, activity_id, fetch_data_types, activity_stream, resolution)
+        # Streams that allow it get their derived streams straight away
+        if 'distance' in fetch_data_types and 'time' in fetch_data_types:
+            with metrics.stage('derived_streams', athlete_id=user.athlete.id, resolution=resolution):
+                self.derived.update(user.athlete.id, missing_id_list, resolution)
+        return failed_id_list
+
+    def genPolyLineList(self, user, base_list, fetch_data_types, id_list, progress=None, fetch=True):
+        # Polylines of these activities, added to base_list. fetch=False leaves out fetching the missing streams, for
+        # callers that just did that themselves.
         if base_list is None:
             base_list = []
         if fetch_data_types is None:
@@ -98,18 +125,415 @@ class DashApp:
             print("Passed an empty id-list. Breaking out of the function and returning None")
             return None
 
-        counter = 0
+        if fetch:
+            self.fetchMissingStreams(user, id_list, fetch_data_types, progress)
+        _, polylines = self.mapPolyLines(user.athlete.id, id_list, fetch_data_types)
+        base_list.extend(polylines)
+        return base_list
+
+    def mapPolyLines(self, athlete_id, id_list, fetch_data_types=None, level=None, point_budget=MAP_POINT_BUDGET):
+        # The stored routes of these activities, all at the same level of detail: the given one, or else the most
+        # detailed one that fits the point budget. Returns the ids that have a route, and their polylines.
+        if fetch_data_types is None:
+            fetch_data_types = ['latlng']
+        found_id_list = []
+        level_lists = []
         for activity_id in id_list:
-            counter += 1
-            print("Making the map for activity # %d" % counter)
-            activity_stream = fun.getStream(_client=self.client, _fetch_data_types=fetch_data_types,
-                                            _activity_id=activity_id)
-            stream_df = fun.storeStream(fetch_data_types, activity_stream)
-            if stream_df.shape[0] != 0:
-                streamPoly = fun.makePolyLine(stream_df)
-                base_list.append(streamPoly)
+            activity_stream = self.store.loadStreams(athlete_id, activity_id, fetch_data_types)
+            activity_streams = fun.storeStream(fetch_data_types, activity_stream)
+            if len(activity_streams) != 0 and 'latlng' in activity_streams:
+                streamPoly = fun.makePolyLine(activity_streams)
+                found_id_list.append(activity_id)
+                level_lists.append(self.simplifiedPolyLines(athlete_id, activity_id, streamPoly))
                 # distanceList.append(activity_df.loc[counter - 1, 'distance'])
-        return base_list
+
+        metrics.count('map_routes', len(found_id_list))
+        if level is None:
+            level = simp.chooseLevel(level_lists, point_budget)
+        metrics.count('map_points', sum(len(x[level]) for x in level_lists))
+        return found_id_list, [x[level] for x in level_lists]
+
+    def recentMap(self, user, kind, map_src):
+        # The map with the most recent activities: the Folium document in an iframe, or in 'client' mode a graph that
+        # assets/geometry.js fills in with the routes from the /geometry route, a page at a time
+        if MAP_RENDER_MODE == 'client':
+            return html.Div([
+                dcc.Store(id='geometry_url', data=f"/geometry/{user.url_token}/{kind}/{MAP_PAYLOAD_FORMAT}.json"),
+                dcc.Store(id='geometry_state', data={'max_retries': MAP_PAGE_RETRIES}),
+                dcc.Interval(id='geometry_poll', interval=MAP_PAGE_INTERVAL, disabled=True),
+                dcc.Graph(id='geometry_map', style={'height': '1000px', 'width': '100%'},
+                          config={'scrollZoom': True}),
+            ])
+        return html.Iframe(src=map_src, style={'height': '1000px', 'width': '100%'})
+
+    def mapPage(self, athlete_id, kind, page, bbox=None, zoom=None):
+        # One page of the progressively loaded map: the routes of the page-th MAP_PAGE_SIZE activities (newest first)
+        # that pass through bbox (south, west, north, east), if given. Only activities with a stored route count, plus
+        # the recent ones a sync fetches the routes of. Culling goes by the spatial index's grid cells, so it can let
+        # through a route that only just misses the box; activities that aren't indexed yet always get through.
+        # Returns the ids and routes, the next page (None after the last one), and how many activities of this page
+        # are still waiting for their streams to be fetched by a sync.
+        if page >= MAP_MAX_PAGES:
+            return [], [], None, 0
+        candidates = None if bbox is None else self.spatial_index.boxCandidates(athlete_id, *bbox)
+        # One more than a page, to tell whether there's a next one
+        rows = self.store.streamPage(athlete_id, kind, MAP_STREAM_TYPES, MAP_STREAM_RESOLUTION, MAP_ACTIVITY_LIMIT,
+                                     page * MAP_PAGE_SIZE, MAP_PAGE_SIZE + 1, candidates)
+        next_page = page + 1 if len(rows) > MAP_PAGE_SIZE and page + 1 < MAP_MAX_PAGES else None
+        rows = rows[:MAP_PAGE_SIZE]
+
+        level = None
+        if zoom is not None:
+            level = simp.levelForZoom(zoom, 0.0 if bbox is None else (bbox[0] + bbox[2]) / 2)
+        found_id_list, polylines = self.mapPolyLines(athlete_id, [x[0] for x in rows if x[1]], level=level,
+                                                     point_budget=MAP_PAGE_POINT_BUDGET)
+        pending = len([x for x in rows if not x[1]])
+        return found_id_list, polylines, next_page, pending
+
+    def renderMap(self, user, kind, id_list, fetch_data_types, progress=None):
+        # URL of the map with these activities. The map only gets drawn if the render cache doesn't have it yet. The
+        # cache key covers everything that changes what the map looks like: the activities that have a route, their
+        # stream resolution, the simplification settings (which fix the level of detail for a given set of routes)
+        # and the map options.
+        id_list = list(id_list)
+        failed_id_list = self.fetchMissingStreams(user, id_list, fetch_data_types, progress)
+        key = self.render_cache.key('map', user.athlete.id, kind, [x for x in id_list if x not in failed_id_list],
+                                    MAP_STREAM_RESOLUTION, SIMPLIFY_TOLERANCES, MAP_POINT_BUDGET, MAP_OPTIONS)
+        if self.render_cache.get(key) is None:
+            # Loading the routes covers storeStream/makePolyLine and the simplification of every activity. The streams
+            # were fetched above already, and whatever failed there isn't retried.
+            with metrics.stage('polylines', athlete_id=user.athlete.id, kind=kind, activities=len(id_list)):
+                polylines = self.genPolyLineList(user=user, base_list=[], fetch_data_types=fetch_data_types,
+                                                 id_list=id_list, fetch=False)
+            with metrics.stage('plot_map', athlete_id=user.athlete.id, kind=kind):
+                activity_map = fun.plotMap(polylines)
+            if activity_map is None:
+                print(f"The {kind} map is empty")
+                return None
+            with metrics.stage('map_save', athlete_id=user.athlete.id, kind=kind):
+                self.render_cache.put(key, activity_map.get_root().render())
+        else:
+            print(f"Using the cached {kind} map")
+        user.map_urls[kind] = f"/maps/{user.url_token}/{key}.html"
+        return user.map_urls[kind]
+
+    def simplifiedPolyLines(self, athlete_id, activity_id, polyline) -> list:
+        # All levels of detail of an activity's polyline. They're computed once, then kept in the store.
+        polylines = self.store.loadSimplified(athlete_id, activity_id, SIMPLIFY_TOLERANCES, polyline)
+        if polylines is None:
+            polylines = simp.simplifyLevels(polyline)
+            self.store.saveSimplified(athlete_id, activity_id, SIMPLIFY_TOLERANCES, polylines)
+        return polylines
+
+    def updateHeatmaps(self, athlete_id, activity_df) -> None:
+        # Adds the activities that aren't in the heatmap yet, in batches. Activities without a stored route are left
+        # out for now, and get picked up once their streams have been fetched.
+        for kind in HEATMAP_KINDS:
+            done_id_set = self.store.heatmapActivityIds(athlete_id, kind)
+            id_list = [x for x in activity_df.loc[activity_df['type'] == kind, 'id'] if x not in done_id_set]
+            for batch_start in range(0, len(id_list), HEATMAP_BATCH_SIZE):
+                batch_id_list = []
+                polylines = []
+                for activity_id in id_list[batch_start:batch_start + HEATMAP_BATCH_SIZE]:
+                    activity_streams = self.store.loadStreams(athlete_id, activity_id, ['latlng'])
+                    if 'latlng' in activity_streams:
+                        batch_id_list.append(activity_id)
+                        polylines.append(activity_streams['latlng'])
+                if len(batch_id_list) > 0:
+                    tile_count = self.heatmap.addActivities(athlete_id, kind, polylines)
+                    self.store.markHeatmapActivities(athlete_id, kind, batch_id_list)
+                    print(f"Added {len(batch_id_list)} activities to the {kind} heatmap ({tile_count} tiles)")
+
+    def updateRouteIndexes(self, athlete_id, activity_df) -> None:
+        # Same idea as updateHeatmaps: add whatever has a stored route and isn't in the spatial index or the route
+        # signatures yet. Then re-cluster the repeated routes, which only needs the stored signatures.
+        spatial_id_set = self.store.spatialIndexedIds(athlete_id)
+        signature_id_set = self.store.routeSignatureIds(athlete_id)
+        counter = 0
+        for activity_id in activity_df['id']:
+            if activity_id in spatial_id_set and activity_id in signature_id_set:
+                continue
+            activity_streams = self.store.loadStreams(athlete_id, activity_id, ['latlng'])
+            if 'latlng' not in activity_streams:
+                continue
+            streamPoly = fun.makePolyLine(activity_streams)
+            if activity_id not in spatial_id_set:
+                self.spatial_index.addActivity(athlete_id, activity_id, streamPoly)
+            if activity_id not in signature_id_set:
+                self.route_clusterer.addActivity(athlete_id, activity_id, streamPoly)
+            counter += 1
+        if counter > 0:
+            print(f"Indexed the routes of {counter} activities")
+            self.route_clusterer.cluster(athlete_id)
+
+    def activityPage(self, user, kind, map_src):
+        # Heatmap of everything, next to the map with the most recent activities and a map of the activities that
+        # pass through an area of choice
+        center = self.store.latestStartLatLng(user.athlete.id, kind)
+        heatmap = fun.plotHeatmap(f"/heatmap/{user.url_token}/{kind}/{{z}}/{{x}}/{{y}}.png", center,
+                                  max(HEATMAP_ZOOMS))
+        return html.Div([
+            dcc.Store(id='page_kind', data=kind),
+            dbc.Tabs([
+                dbc.Tab(html.Iframe(srcDoc=heatmap.get_root().render(), style={'height': '1000px', 'width': '100%'}),
+                        label="Heatmap"),
+                dbc.Tab(self.recentMap(user, kind, map_src), label="Recent activities"),
+                dbc.Tab([
+                    dbc.Row([
+                        dbc.Col(dbc.Input(id='region_lat', type='number', placeholder="Latitude",
+                                          value=None if center is None else center[0])),
+                        dbc.Col(dbc.Input(id='region_lng', type='number', placeholder="Longitude",
+                                          value=None if center is None else center[1])),
+                        dbc.Col(dbc.Input(id='region_radius', type='number', placeholder="Radius (km)", value=1)),
+                        dbc.Col(dbc.Button("Find activities", id='region_filter')),
+                        dbc.Col(html.P(id='region_count')),
+                    ]),
+                    html.Iframe(id='region_map', style={'height': '1000px', 'width': '100%'}),
+                ], label="Search area"),
+                # Filled in from what the sync stored once the tab gets opened, see bestEffortsTab
+                dbc.Tab(dcc.Loading(dcc.Graph(id='best_efforts_graph')), label="Best efforts", tab_id='best_efforts'),
+                dbc.Tab(dcc.Loading(dcc.Graph(id='workout_classes_graph')), label="Workout types",
+                        tab_id='workout_classes'),
+                dbc.Tab(dcc.Loading(dcc.Graph(id='grade_adjusted_graph')), label="Grade adjusted pace",
+                        tab_id='grade_adjusted'),
+                dbc.Tab(dcc.Loading(html.Div(id='fitness_content')), label="Fitness", tab_id='fitness'),
+            ], id='activity_tabs')
+        ])
+
+    def gearPage(self, athlete_id):
+        # Built from the daily rollups, which the sync keeps up to date
+        usage_df = self.gear.usageFrame(athlete_id)
+        if len(usage_df) == 0:
+            return html.Div([html.P("No gear usage yet. Fetch the athlete data first.")])
+        total_df = usage_df.groupby('name', as_index=False).agg(
+            km=('total_km', 'last'), hours=('total_hours', 'last'), activities=('activity_count', 'sum'),
+            last_used=('day', 'last'))
+        total_df = pd.DataFrame({"Gear": total_df['name'], "Distance (km)": total_df['km'].round(1),
+                                 "Time (h)": total_df['hours'].round(1), "Activities": total_df['activities'],
+                                 "Last used": total_df['last_used'].dt.strftime('%Y-%m-%d')})
+        return html.Div([
+            dcc.Graph(figure=fun.plotGearUsage(usage_df[usage_df['gear_id'].str.startswith('g')], "Shoes")),
+            dcc.Graph(figure=fun.plotGearUsage(usage_df[usage_df['gear_id'].str.startswith('b')], "Bikes")),
+            dbc.Table.from_dataframe(total_df, striped=True, bordered=True),
+        ])
+
+    def updateBestEfforts(self, user, id_list, progress=None) -> int:
+        # Best efforts need high resolution distance and time streams. Like for the features, those only get fetched
+        # for the most recent activities (id_list is newest first) that don't have their best efforts yet; older ones
+        # get theirs once they have streams (e.g. from an archive import).
+        missing_id_list = self.store.missingBestEfforts(user.athlete.id, id_list, list(BEST_EFFORT_DISTANCES))
+        missing_id_set = set(missing_id_list)
+        self.fetchMissingStreams(user, [x for x in id_list[:MAP_ACTIVITY_LIMIT] if x in missing_id_set],
+                                 ANALYTICS_STREAM_TYPES, progress, resolution=ANALYTICS_STREAM_RESOLUTION)
+        best_effort_count = self.best_efforts.update(user.athlete.id, missing_id_list)
+        print(f"Worked out the best efforts of {best_effort_count} activities")
+        return best_effort_count
+
+    def updateFeatures(self, user, id_list, progress=None) -> int:
+        # Like the best efforts, the features need high resolution streams. Those only get fetched for the most recent
+        # activities (id_list is newest first), so a sync doesn't keep fetching further back in the history; older
+        # ones get their features once they have streams (e.g. from an archive import).
+        missing_id_list = self.store.missingFeatures(user.athlete.id, id_list, FEATURE_VERSION)
+        missing_id_set = set(missing_id_list)
+        self.fetchMissingStreams(user, [x for x in id_list[:MAP_ACTIVITY_LIMIT] if x in missing_id_set],
+                                 ANALYTICS_STREAM_TYPES, progress, resolution=ANALYTICS_STREAM_RESOLUTION)
+        # Streams that came from an import or a journal replay don't have their derived streams yet
+        self.derived.update(user.athlete.id, missing_id_list)
+        feature_count = self.features.update(user.athlete.id, missing_id_list)
+        print(f"Worked out the features of {feature_count} activities")
+        return feature_count
+
+    def addRoutes(self):
+        # Plain Flask routes next to the Dash app, for things that aren't page content
+        @self.app.server.route('/heatmap/<url_token>/<kind>/<int:z>/<int:x>/<int:y>.png')
+        def heatmapTile(url_token, kind, z, x, y):
+            # Like /geometry, only for the session the url_token belongs to
+            user = self.sessions.byToken(url_token)
+            if user is None or user.athlete is None:
+                flask.abort(403)
+            if kind not in HEATMAP_KINDS:
+                flask.abort(404)
+            return flask.Response(self.heatmap.tilePng(user.athlete.id, kind, z, x, y), mimetype='image/png')
+
+        @self.app.server.route('/metrics')
+        def metricsEndpoint():
+            # Stage timings, API calls and what's left of the quota, for this machine only
+            if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+                flask.abort(403)
+            snapshot = metrics.snapshot()
+            short_remaining, long_remaining = self.sessions.budget.remaining()
+            sync_count = snapshot['stages'].get('sync', {}).get('count', 0)
+            calls_per_sync = snapshot['counters'].get('sync_api_calls', 0) / sync_count if sync_count else 0
+            snapshot['quota'] = {'short_remaining': short_remaining, 'long_remaining': long_remaining,
+                                 'api_calls_per_sync': calls_per_sync,
+                                 'syncs_left_today': int(long_remaining // calls_per_sync) if calls_per_sync else None}
+            return flask.jsonify(snapshot)
+
+        @self.app.server.route('/maps/<url_token>/<key>.html')
+        def cachedMap(url_token, key):
+            # A rendered recent-activities map. Only the session it was rendered for gets to see it; anyone else gets
+            # the same 404 as for a map that doesn't exist.
+            user = self.sessions.byToken(url_token)
+            if user is None or f"/maps/{url_token}/{key}.html" not in user.map_urls.values():
+                flask.abort(404)
+            path = self.render_cache.get(key) if self.render_cache.validKey(key) else None
+            if path is None:
+                flask.abort(404)
+            return flask.send_file(os.path.abspath(path), mimetype='text/html')
+
+        @self.app.server.route('/geometry/<url_token>/<kind>/<payload_format>.json')
+        def recentGeometry(url_token, kind, payload_format):
+            # One page of routes, straight from the stream store, for the 'client' map mode (see mapPage). Optional
+            # query arguments: page, bbox=south,west,north,east and zoom. Gzipped whenever the browser accepts that,
+            # which is nearly always. Only the session the url_token belongs to gets to see its athlete's routes.
+            user = self.sessions.byToken(url_token)
+            if user is None or user.athlete is None:
+                flask.abort(403)
+            if kind not in HEATMAP_KINDS or payload_format not in ('polyline', 'geojson'):
+                flask.abort(404)
+            try:
+                page = flask.request.args.get('page', 0, type=int)
+                bbox = flask.request.args.get('bbox')
+                bbox = None if bbox is None else [float(x) for x in bbox.split(',')]
+                zoom = flask.request.args.get('zoom', None, type=float)
+            except ValueError:
+                flask.abort(400)
+            if page < 0 or (bbox is not None and len(bbox) != 4):
+                flask.abort(400)
+            id_list, polylines, next_page, pending = self.mapPage(user.athlete.id, kind, page, bbox, zoom)
+            if payload_format == 'polyline':
+                payload = geom.encodedPayload(id_list, polylines)
+            else:
+                payload = geom.geoJsonPayload(id_list, polylines)
+            payload.update({'page': page, 'next_page': next_page, 'pending': pending})
+
+            compress = 'gzip' in flask.request.headers.get('Accept-Encoding', '')
+            response = flask.Response(geom.payloadBytes(payload, compress), mimetype='application/json')
+            if compress:
+                response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+
+    def syncAndRender(self, user, progress):
+        # The whole "Fetch athlete data" pipeline. Runs as a background job; progress(stage, fraction) reports how far
+        # along it is. user is the UserSession of whoever asked for it.
+        # Timed as a whole as well as stage by stage, together with the number of API calls it took, which is what
+        # tells how many more syncs today's quota allows.
+        calls_before = user.api_calls
+        with metrics.stage('sync'):
+            result = self._syncAndRender(user, progress)
+        api_calls = user.api_calls - calls_before
+        metrics.count('sync_api_calls', api_calls)
+        metrics.log('sync', athlete_id=user.athlete.id, api_calls=api_calls)
+        return result
+
+    def fetchAthlete(self, user) -> None:
+        # Fetch the athlete, in case we want to do cool things with it. Once per session is enough.
+        if user.athlete is not None:
+            return
+        with metrics.stage('athlete_fetch'):
+            user.athlete = user.client.get_athlete()
+        athlete_dict = user.athlete.to_dict()
+        if self.journal is not None:
+            self.journal.record('athlete', user.athlete.id, user.athlete.id, athlete_dict)
+        self.store.saveAthlete(user.athlete.id, athlete_dict)
+
+    def _syncAndRender(self, user, progress):
+        user.ensureFresh()
+
+        progress("Fetching athlete", 0)
+        self.fetchAthlete(user)
+
+        # Page through the athlete's history, starting after the most recent activity we already have.
+        progress("Syncing activities", 0.05)
+        with metrics.stage('activity_listing', athlete_id=user.athlete.id):
+            new_activity_count = syncActivities(user.client, self.store, user.athlete.id, _journal=self.journal)
+        print(f"Synced {new_activity_count} new activities")
+
+        # Everything below only needs to know which activities there are
+        activity_df = self.store.activityFrame(user.athlete.id, columns=['id', 'type', 'start_date', 'gear_id'])
+
+        # Gear: the athlete's shoes and bikes, plus whatever the activities used (which includes retired gear). Only
+        # gear we haven't seen, or haven't fetched in a while, gets fetched.
+        progress("Fetching gear", 0.1)
+        shoe_id_list = [x.id for x in (getattr(user.athlete, 'shoes', None) or [])]
+        bike_id_list = [x.id for x in (getattr(user.athlete, 'bikes', None) or [])]
+        with metrics.stage('gear_fetch', athlete_id=user.athlete.id):
+            self.gear.refresh(user, shoe_id_list + bike_id_list + activity_df['gear_id'].dropna().tolist())
+        with metrics.stage('gear_rollups', athlete_id=user.athlete.id):
+            self.gear.updateRollups(user.athlete.id)
+
+        # Split the activity dataframe up by activity type (Run, Bike, other). The maps only show the most recent
+        # activities (activity_df is sorted newest first).
+        run_id_list = activity_df.loc[activity_df['type'] == 'Run']['id'].head(MAP_ACTIVITY_LIMIT)
+        ride_id_list = activity_df.loc[activity_df['type'] == 'Ride']['id'].head(MAP_ACTIVITY_LIMIT)
+
+        # Fetch the activity-streams the maps need (only the route, at low resolution). Everything else gets fetched
+        # when it's first needed.
+        type_list = MAP_STREAM_TYPES
+
+        # If nothing new came in and every stream is already stored, there's nothing to add to the heatmaps and such.
+        nothing_new = (new_activity_count == 0
+                       and len(self.store.missingStreams(user.athlete.id, pd.concat([run_id_list, ride_id_list]),
+                                                         type_list)) == 0)
+
+        def runProgress(done, total):
+            progress(f"Fetching runs ({done}/{total})", 0.15 + 0.3 * done / total)
+
+        def rideProgress(done, total):
+            progress(f"Fetching rides ({done}/{total})", 0.45 + 0.3 * done / total)
+
+        if MAP_RENDER_MODE == 'client':
+            # The browser draws the maps itself, it only needs the streams to be there
+            run_map_url = None
+            self.fetchMissingStreams(user, run_id_list, type_list, runProgress)
+            self.fetchMissingStreams(user, ride_id_list, type_list, rideProgress)
+        else:
+            # The maps come out of the render cache if these activities have been drawn before
+            run_map_url = self.renderMap(user, 'Run', run_id_list, type_list, runProgress)
+            self.renderMap(user, 'Ride', ride_id_list, type_list, rideProgress)
+
+        # The best efforts cover the whole history. The high resolution streams of the most recent activities get
+        # fetched here, so opening the chart never has to wait for Strava.
+        for kind_index, kind in enumerate(HEATMAP_KINDS):
+            def bestEffortProgress(done, total):
+                progress(f"Fetching streams for the best efforts ({done}/{total})",
+                         0.75 + 0.05 * (kind_index + done / total) / len(HEATMAP_KINDS))
+
+            with metrics.stage('best_efforts', athlete_id=user.athlete.id, kind=kind):
+                self.updateBestEfforts(user, activity_df.loc[activity_df['type'] == kind, 'id'].tolist(),
+                                       bestEffortProgress)
+
+        # The workout types get classified over the whole history, from the stored features
+        for kind_index, kind in enumerate(HEATMAP_KINDS):
+            def featureProgress(done, total):
+                progress(f"Fetching streams for the workout types ({done}/{total})",
+                         0.8 + 0.05 * (kind_index + done / total) / len(HEATMAP_KINDS))
+
+            with metrics.stage('features', athlete_id=user.athlete.id, kind=kind):
+                self.updateFeatures(user, activity_df.loc[activity_df['type'] == kind, 'id'].tolist(), featureProgress)
+
+        # Fitness goes after the features, which give it the heart rate of the activities. It only gets replayed from
+        # the first day that changed.
+        with metrics.stage('fitness', athlete_id=user.athlete.id):
+            replayed_from = self.fitness.update(user.athlete.id)
+        if replayed_from is not None:
+            print(f"Updated fitness from {replayed_from}")
+        if nothing_new:
+            return {'map_src': run_map_url, 'athlete_id': user.athlete.id}
+
+        # Add everything that has a stored route to the heatmaps, the spatial index and the route clusters
+        progress("Updating heatmaps and routes", 0.85)
+        with metrics.stage('heatmaps', athlete_id=user.athlete.id):
+            self.updateHeatmaps(user.athlete.id, activity_df)
+        with metrics.stage('route_indexes', athlete_id=user.athlete.id):
+            self.updateRouteIndexes(user.athlete.id, activity_df)
+
+        # activityJSON = activity_df.to_json(orient='index')
+        # parsed = json.loads(activityJSON)
+
+        # The main page shows a map with the fetched activities once this is done
+        return {'map_src': run_map_url, 'athlete_id': user.athlete.id}
 
     def addCallbacks(self):
         @self.app.callback(
@@ -129,12 +553,7 @@ class DashApp:
                 raise dash.exceptions.PreventUpdate
 
             # print("Processing OAUTH")
-            authorise_url = self.client.authorization_url(
-                client_id=self.client_id,
-                redirect_uri='http://127.0.0.1:8080/',
-                approval_prompt='auto',
-                scope=['read_all', 'profile:read_all', 'activity:read_all']
-            )
+            authorise_url = self.sessions.authorizationUrl(redirect_uri='http://127.0.0.1:8080/')
 
             # Need to implement a check for whether the access_token has expired and needs to be refreshed, which
             # shouldn't be all that complicated.
@@ -146,6 +565,7 @@ class DashApp:
                 Output('navbar_links', 'children'),
                 Output('current_url', 'href'),
                 Output('current_url', 'refresh'),
+                Output('session_id', 'data'),
             ],
             [
                 Input('init_load_timer', 'n_intervals'),
@@ -153,16 +573,18 @@ class DashApp:
             [
                 State('current_url', 'href'),
                 State('logged_in', 'data'),
+                State('session_id', 'data'),
             ],
             prevent_initial_call=True,
         )
-        def initialStateCheck(n_intervals, current_url, logged_in):
+        def initialStateCheck(n_intervals, current_url, logged_in, session_id):
             print("Checking whether this nonsense is getting triggered")
             # Failsafe, to make sure there's no random initial call.
-            # !! NB: The current code adds an HTML file with a map to the /assets/ folder, which triggers a
-            # hot reload. Had to disable that when running the app instance !!
+            # !! NB: The maps used to be written to the /assets/ folder, which triggers a hot reload. They're in the
+            # render cache now, but hot reload is still disabled when running the app instance !!
             trigger_id = ctx.triggered[0]['prop_id'].split(".")[0]
-            if trigger_id is None or logged_in:
+            user = self.sessions.get(session_id)
+            if trigger_id is None or (logged_in and user is not None):
                 print("Callback got triggered, but it ain't updating.")
                 raise dash.exceptions.PreventUpdate
 
@@ -172,9 +594,9 @@ class DashApp:
             else:
                 code_start = -1
 
-            # If there is no code in the URL, and we don't already have an access/refresh token, then we need to
+            # If there is no code in the URL, and this browser session doesn't have tokens yet, then we need to
             # go through an OAUTH step
-            if code_start == -1 and (self.access_token is None or self.refresh_token is None):
+            if code_start == -1 and user is None:
                 return [
                     dbc.Container([
                         html.Br(),
@@ -183,34 +605,24 @@ class DashApp:
                     ]),
                     navbar_links_init,
                     dash.no_update,
+                    dash.no_update,
                     dash.no_update
                 ]
 
             # If we got this far, and there is an auth-code in the URL, but we have no access/refresh token, then
             # we must've been redirected to the Dash app after going through OAUTH. Let's fetch the tokens.
-            if self.access_token is None:
+            if user is None:
                 # If there is a code in the current URL, we snag it and use it to get an access token and such.
                 code = current_url[code_start + 5:]
                 code_end = code.find("&")
                 code = code[0:code_end]
 
-                # Get an access token and a refresh token. This will let us access all the athlete information.
-                response = self.client.exchange_code_for_token(
-                    client_id=self.client_id,
-                    client_secret=self.client_secret,
-                    code=code
-                )
-                self.setTokens(response=response, request_type="authorise")
-            elif self.expires_in <= 0:
-                print("Access token has expired. Need to refresh it.")
-                header = {
-                    'client_id': self.client_id,
-                    'client_secret': self.client_secret,
-                    'grant_type': 'refresh_token',
-                    'refresh_token': self.refresh_token,
-                }
-                response = requests.post('https://www.strava.com/api/v3/oauth/token', data=header).json()
-                self.setTokens(response=response, request_type="refresh")
+                # Get an access token and a refresh token, in a session of its own. This will let us access all the
+                # athlete information.
+                session_id = self.sessions.login(code)
+            else:
+                # Normally already taken care of in the background
+                user.ensureFresh()
 
             return [
                 dbc.Container([
@@ -219,123 +631,210 @@ class DashApp:
                 ]),
                 navbar_links_logged_in,
                 "run",
-                False
+                False,
+                session_id
             ]
 
         # Add a callback here that fetches athlete data and stores it somewhere.
         # Could perhaps still use a dcc.Store for it, though it may become too much. Local storage possible, perhaps?
         # Or yeet it onto Firebase? Would be nice if it doesn't have to retrieve the data anew each time.
+        # The fetching itself runs as a background job (see syncAndRender); this only starts it. Clicking again while
+        # it's running just picks up the same job.
         @self.app.callback(
             Output('page_content', 'children', allow_duplicate=True),
-            Output('logged_in', 'data'),
             Input('get_data', 'n_clicks'),
+            State('session_id', 'data'),
             prevent_initial_call=True
         )
-        def getData(n_clicks):
-            if n_clicks is None:
+        def getData(n_clicks, session_id):
+            user = self.sessions.get(session_id)
+            if n_clicks is None or user is None:
                 raise dash.exceptions.PreventUpdate
 
-            # Fetch the athlete, in case we want to do cool things with it.
-            self.athlete = self.client.get_athlete()
-
-            # Get the gear, write the summary data to a JSON file and return a list of IDs (for a more detailed fetch)
-            shoe_id_list = defun.writeShoeData(self.athlete)
-            gear_list = []
-            for gear_id in shoe_id_list:
-                new_gear = self.client.get_gear(gear_id=gear_id)
-                gear_list.append(new_gear.to_dict())
+            # One sync per athlete at a time, also when they're logged in from two tabs or browsers (those syncs would
+            # write the same activities and heatmap tiles at once), but different athletes sync in parallel. The
+            # athlete id comes with the login; refreshing the token and fetching the athlete are left to the job, so
+            # this callback doesn't wait on Strava.
+            athlete_id = user.athlete.id if user.athlete is not None else user.athlete_id
+            job_key = f"sync-{athlete_id}" if athlete_id is not None else f"sync-{session_id}"
+            job_id = self.jobs.submit(job_key, self.syncAndRender, user)
+            return html.Div([
+                html.Br(),
+                dcc.Store(id='job_id', data=job_id),
+                dcc.Interval(id='job_poll', interval=JOB_POLL_INTERVAL, n_intervals=0),
+                html.P("Starting...", id='job_stage'),
+                dbc.Progress(id='job_progress', value=0, striped=True, animated=True),
+            ])
 
-            # Optionally: Write all the gear info to a file
-            with open("ref/gear_data.json", "w", encoding="utf-8") as file:
-                json.dump(gear_list, file, ensure_ascii=False, indent=4)
-
-
-            end_date = dt.datetime.now()
-            start_date = dt.datetime.now() - dt.timedelta(weeks=4)
-
-            # This code chunk fetches activities within from the start date till the end date.
-            activities = self.client.get_activities(after=start_date, before=end_date, limit=50)
-            activity_data = []
-            for activity in activities:
-                activity_dict = activity.to_dict()
-                new_data = [activity_dict.get(x) for x in activity_cols]
-                activity_data.append(new_data)
-
-            # Optional function call to write the activity data into a JSON file, for reference.
-            defun.writeActivityDict(activities)
-
-            activity_df = pd.DataFrame(activity_data, columns=activity_cols)
-            activity_df['distance'] = activity_df['distance'] / 1000
-            activity_df.to_csv("results/activities.csv", sep=';', encoding='utf-8')
-            activity_df = activity_df.loc[:, ~activity_df.columns.str.contains('^Unnamed')]
-
-            # Split the activity dataframe up by activity type (Run, Bike, other)
-            run_id_list = activity_df.loc[activity_df['type'] == 'Run']['id']
-            ride_id_list = activity_df.loc[activity_df['type'] == 'Ride']['id']
-
-            # Fetch the activity-streams (i.e. location coordinates and such)
-            type_list = ['distance', 'time', 'latlng', 'altitude', 'heartrate']
-
-            run_polyline_list = []
-            ride_polyline_list = []
-
-            run_polyline_list = self.genPolyLineList(base_list=run_polyline_list,
-                                                     fetch_data_types=type_list,
-                                                     id_list=run_id_list)
-            ride_polyline_list = self.genPolyLineList(base_list=ride_polyline_list,
-                                                      fetch_data_types=type_list,
-                                                      id_list=ride_id_list)
-
-            # Generate a map that displays medium-res polylines for all activities.
-            # This part is Folium-based, and I'm not sure whether I like that.
-            run_activity_map = fun.plotMap(run_polyline_list)
-            try:
-                run_activity_map.save('assets/run_example.html')
-            except:
-                print("run_activity_map is empty")
-
-            ride_activity_map = fun.plotMap(ride_polyline_list)
-            try:
-                ride_activity_map.save('assets/ride_example.html')
-            except:
-                print("ride_activity_map is empty")
-
-            # activityJSON = activity_df.to_json(orient='index')
-            # parsed = json.loads(activityJSON)
+        @self.app.callback(
+            Output('job_stage', 'children'),
+            Output('job_progress', 'value'),
+            Output('job_poll', 'disabled'),
+            Output('page_content', 'children', allow_duplicate=True),
+            Output('logged_in', 'data'),
+            Input('job_poll', 'n_intervals'),
+            State('job_id', 'data'),
+            State('session_id', 'data'),
+            prevent_initial_call=True
+        )
+        def jobStatus(n_intervals, job_id, session_id):
+            job_status = self.jobs.status(job_id)
+            user = self.sessions.get(session_id)
+            if job_status is None or user is None:
+                raise dash.exceptions.PreventUpdate
 
-            # Update the main page by showing a map with the fetched activities.
-            return (html.Div([html.Iframe(src='assets/run_example.html', style={'height': '1000px', 'width': '100%'})]),
-                    True)
-            # raise dash.exceptions.PreventUpdate
+            if job_status['status'] == 'done':
+                # Update the main page by showing a map with the fetched activities.
+                return (job_status['stage'], 100, True,
+                        html.Div([self.recentMap(user, 'Run', job_status['result']['map_src'])]),
+                        True)
+            elif job_status['status'] == 'failed':
+                return (f"Fetching data failed: {job_status['message']}", job_status['progress'] * 100, True,
+                        dash.no_update, dash.no_update)
+            return job_status['stage'], job_status['progress'] * 100, False, dash.no_update, dash.no_update
 
         @self.app.callback(
             Output('page_content', 'children', allow_duplicate=True),
             Input('current_url', 'pathname'),
             State('logged_in', 'data'),
+            State('session_id', 'data'),
             prevent_initial_call=True
         )
-        def navbarLinks(current_url, logged_in):
+        def navbarLinks(current_url, logged_in, session_id):
             trigger_id = ctx.triggered[0]['prop_id'].split(".")[0]
-            if trigger_id is None or not logged_in:
+            user = self.sessions.get(session_id)
+            if trigger_id is None or not logged_in or user is None or user.athlete is None:
                 raise dash.exceptions.PreventUpdate
 
             print(f"current_url: {current_url}")
 
             if current_url == "/runs":
-                return html.Div([
-                    html.Iframe(src='assets/run_example.html', style={'height': '1000px', 'width': '100%'})
-                ])
+                return self.activityPage(user, 'Run', user.map_urls.get('Run'))
             elif current_url == "/rides":
-                return html.Div([
-                    html.Iframe(src='assets/ride_example.html', style={'height': '1000px', 'width': '100%'})
-                ])
+                return self.activityPage(user, 'Ride', user.map_urls.get('Ride'))
             elif current_url == "/gear":
-                return html.Div([
-                    html.P("Work in progress.")
-                ])
+                return self.gearPage(user.athlete.id)
             else:
                 print("Invalid URL.")
                 return dash.no_update
 
+        @self.app.callback(
+            Output('best_efforts_graph', 'figure'),
+            Input('activity_tabs', 'active_tab'),
+            State('page_kind', 'data'),
+            State('session_id', 'data'),
+            prevent_initial_call=True
+        )
+        def bestEffortsTab(active_tab, kind, session_id):
+            user = self.sessions.get(session_id)
+            if active_tab != 'best_efforts' or user is None or user.athlete is None:
+                raise dash.exceptions.PreventUpdate
+
+            # The sync keeps the best efforts up to date
+            return fun.plotBestEfforts(self.store.bestEffortsFrame(user.athlete.id, kind))
+
+        @self.app.callback(
+            Output('workout_classes_graph', 'figure'),
+            Input('activity_tabs', 'active_tab'),
+            State('page_kind', 'data'),
+            State('session_id', 'data'),
+            prevent_initial_call=True
+        )
+        def workoutClassesTab(active_tab, kind, session_id):
+            user = self.sessions.get(session_id)
+            if active_tab != 'workout_classes' or user is None or user.athlete is None:
+                raise dash.exceptions.PreventUpdate
+
+            # From the features the sync stored
+            return fun.plotWorkoutClasses(self.features.classify(user.athlete.id, kind))
+
+        @self.app.callback(
+            Output('grade_adjusted_graph', 'figure'),
+            Input('activity_tabs', 'active_tab'),
+            State('page_kind', 'data'),
+            State('session_id', 'data'),
+            prevent_initial_call=True
+        )
+        def gradeAdjustedTab(active_tab, kind, session_id):
+            user = self.sessions.get(session_id)
+            if active_tab != 'grade_adjusted' or user is None or user.athlete is None:
+                raise dash.exceptions.PreventUpdate
+
+            # From the features the sync stored, which come from the derived speed and grade streams
+            return fun.plotGradeAdjusted(self.features.frame(user.athlete.id, kind))
+
+        @self.app.callback(
+            Output('fitness_content', 'children'),
+            Input('activity_tabs', 'active_tab'),
+            State('session_id', 'data'),
+            prevent_initial_call=True
+        )
+        def fitnessTab(active_tab, session_id):
+            user = self.sessions.get(session_id)
+            if active_tab != 'fitness' or user is None or user.athlete is None:
+                raise dash.exceptions.PreventUpdate
+
+            # Fitness covers every activity, up to the last sync, which also keeps the best efforts (for the race
+            # predictions) and the features (for the heart rate) up to date
+            prediction_df = self.fitness.predictions(user.athlete.id)
+            prediction_df = pd.DataFrame({
+                "Distance": prediction_df['name'],
+                "Riegel": [fun.formatDuration(x) for x in prediction_df['riegel']],
+                "Critical speed": [fun.formatDuration(x) for x in prediction_df['critical_speed']],
+            })
+            return [
+                dcc.Graph(figure=fun.plotFitness(self.store.fitnessFrame(user.athlete.id))),
+                html.H5(f"Race predictions (from the best efforts of the last {PREDICTION_WINDOW} days)"),
+                dbc.Table.from_dataframe(prediction_df, striped=True, bordered=True),
+            ]
+
+        # The progressive map: the first page as soon as the page is there, the next ones on every poll, and from the
+        # first page again (just what's in view) whenever the map gets moved
+        self.app.clientside_callback(
+            ClientsideFunction(namespace='geometry', function_name='loadPage'),
+            Output('geometry_map', 'figure'),
+            Output('geometry_state', 'data'),
+            Output('geometry_poll', 'disabled'),
+            Input('geometry_url', 'data'),
+            Input('geometry_poll', 'n_intervals'),
+            Input('geometry_map', 'relayoutData'),
+            State('geometry_state', 'data'),
+            State('geometry_map', 'figure'),
+        )
+
+        @self.app.callback(
+            Output('region_map', 'srcDoc'),
+            Output('region_count', 'children'),
+            Input('region_filter', 'n_clicks'),
+            State('page_kind', 'data'),
+            State('region_lat', 'value'),
+            State('region_lng', 'value'),
+            State('region_radius', 'value'),
+            State('session_id', 'data'),
+            prevent_initial_call=True
+        )
+        def regionFilter(n_clicks, kind, latitude, longitude, radius, session_id):
+            user = self.sessions.get(session_id)
+            if (n_clicks is None or latitude is None or longitude is None or not radius or user is None
+                    or user.athlete is None):
+                raise dash.exceptions.PreventUpdate
+
+            # Activities passing within the radius, newest first. Only the stored routes get drawn; fetching the
+            # missing ones is up to the sync.
+            found_id_set = self.spatial_index.queryRadius(user.athlete.id, latitude, longitude, radius * 1000)
+            id_list = [x for x in self.store.activityIdsByDate(user.athlete.id, kind) if x in found_id_set]
+            if len(id_list) == 0:
+                return dash.no_update, "No activities found in this area."
+
+            polyline_list = self.genPolyLineList(user=user, base_list=[], fetch_data_types=['latlng'],
+                                                 id_list=id_list[:MAP_ACTIVITY_LIMIT], fetch=False)
+            region_map = fun.plotMap(polyline_list)
+            if region_map is None:
+                return dash.no_update, "None of the activities in this area have a stored route yet."
+            folium.Circle(location=[latitude, longitude], radius=radius * 1000, color='#000000',
+                          fill=False).add_to(region_map)
+            shown = min(len(id_list), MAP_ACTIVITY_LIMIT)
+            return region_map.get_root().render(), f"{len(id_list)} activities found, showing the {shown} most recent."
+
     def runApp(self):
         self.app.run_server(debug=True, port=8080, dev_tools_hot_reload=False)
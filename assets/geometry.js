@@ -0,0 +1,154 @@
+// Client-side half of the 'client' map mode (see geometry.py): fetches the routes of the recent activities and draws
+// them in a dcc.Graph, instead of loading a whole Folium document into an iframe. The routes come a page at a time
+// (see mapPage in app_class.py), each page a trace of its own, so the newest activities show up straight away. Once
+// the map gets moved, it starts again from the first page, with only the activities that pass through the view.
+function decodePolyline(encoded, precision) {
+    // Google's encoded polyline format. Returns separate latitude and longitude arrays, which is what plotly wants.
+    const factor = Math.pow(10, precision);
+    const lat = [];
+    const lng = [];
+    let index = 0;
+    let latitude = 0;
+    let longitude = 0;
+    while (index < encoded.length) {
+        for (let coordinate = 0; coordinate < 2; coordinate++) {
+            let value = 0;
+            let shift = 0;
+            let chunk;
+            do {
+                chunk = encoded.charCodeAt(index++) - 63;
+                value |= (chunk & 0x1f) << shift;
+                shift += 5;
+            } while (chunk >= 0x20);
+            const delta = (value & 1) ? ~(value >> 1) : (value >> 1);
+            if (coordinate === 0) {
+                latitude += delta;
+            } else {
+                longitude += delta;
+            }
+        }
+        lat.push(latitude / factor);
+        lng.push(longitude / factor);
+    }
+    return {lat: lat, lng: lng};
+}
+
+function payloadRoutes(payload) {
+    // Both payload formats, as a list of {lat, lng}
+    if (payload.format === 'polyline') {
+        return payload.activities.map(x => decodePolyline(x.polyline, payload.precision));
+    }
+    return payload.features.map(x => ({
+        lat: x.geometry.coordinates.map(y => y[1]),
+        lng: x.geometry.coordinates.map(y => y[0]),
+    }));
+}
+
+function routesTrace(routes, name) {
+    // All routes of a page in a single trace, separated by nulls, which is a lot quicker to draw than a trace per route
+    const lat = [];
+    const lng = [];
+    for (const route of routes) {
+        Array.prototype.push.apply(lat, route.lat);
+        Array.prototype.push.apply(lng, route.lng);
+        lat.push(null);
+        lng.push(null);
+    }
+    return {type: 'scattermap', mode: 'lines', name: name, lat: lat, lon: lng, line: {width: 2, color: '#FF0000'},
+            hoverinfo: 'skip'};
+}
+
+function emptyFigure(routes) {
+    // Centred on the newest route. uirevision keeps the view where the user left it when pages get added.
+    const center = routes.length > 0 && routes[0].lat.length > 0
+        ? {lat: routes[0].lat[0], lon: routes[0].lng[0]} : {lat: 0, lon: 0};
+    return {
+        data: [],
+        layout: {map: {style: 'carto-positron', center: center, zoom: routes.length > 0 ? 12 : 1},
+                 margin: {l: 0, r: 0, t: 0, b: 0}, showlegend: false, uirevision: 'geometry'},
+    };
+}
+
+function relayoutViewport(relayout) {
+    // {bbox: [south, west, north, east], zoom} of the map after it got moved, or null if it didn't move. Uses the
+    // corners plotly reports where it does, and works them out from the centre and zoom (for a 1000px map) where not.
+    if (!relayout || relayout['map.center'] === undefined || relayout['map.zoom'] === undefined) {
+        return null;
+    }
+    const zoom = relayout['map.zoom'];
+    const derived = relayout['map._derived'];
+    if (derived && derived.coordinates) {
+        const lats = derived.coordinates.map(x => x[1]);
+        const lngs = derived.coordinates.map(x => x[0]);
+        return {bbox: [Math.min(...lats), Math.min(...lngs), Math.max(...lats), Math.max(...lngs)], zoom: zoom};
+    }
+    const center = relayout['map.center'];
+    const halfSpan = 500 * 360 / (512 * Math.pow(2, zoom));
+    return {bbox: [center.lat - halfSpan, center.lon - halfSpan, center.lat + halfSpan, center.lon + halfSpan],
+            zoom: zoom};
+}
+
+function pageUrl(url, page, viewport) {
+    let query = `?page=${page}`;
+    if (viewport) {
+        query += `&bbox=${viewport.bbox.map(x => x.toFixed(5)).join(',')}&zoom=${viewport.zoom.toFixed(2)}`;
+    }
+    return url + query;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    geometry: {
+        loadPage: async function (url, nIntervals, relayout, state, figure) {
+            // Returns [figure, state, whether to stop polling]. state holds the next page to load, the pages that
+            // had activities still being fetched (to load again later), and the viewport the pages are culled to.
+            const noUpdate = window.dash_clientside.no_update;
+            if (!url) {
+                return [noUpdate, noUpdate, true];
+            }
+            const triggered = window.dash_clientside.callback_context.triggered.map(x => x.prop_id);
+            const maxRetries = state ? state.max_retries : 0;
+            let page;
+            if (triggered.includes('geometry_url.data') || !state || state.page === undefined) {
+                state = {max_retries: maxRetries, page: 0, pending: [], retries: 0, viewport: null};
+                figure = null;
+            } else if (triggered.includes('geometry_map.relayoutData')) {
+                const viewport = relayoutViewport(relayout);
+                if (!viewport) {
+                    return [noUpdate, noUpdate, noUpdate];
+                }
+                state = {max_retries: maxRetries, page: 0, pending: [], retries: 0, viewport: viewport};
+                figure = figure ? {data: [], layout: figure.layout} : null;
+            }
+            state = Object.assign({}, state, {pending: state.pending.slice()});
+            if (state.page !== null) {
+                page = state.page;
+            } else if (state.pending.length > 0 && state.retries < state.max_retries) {
+                page = state.pending.shift();
+                state.retries += 1;
+            } else {
+                return [noUpdate, noUpdate, true];
+            }
+
+            const response = await fetch(pageUrl(url, page, state.viewport));
+            if (!response.ok) {
+                return [noUpdate, noUpdate, true];
+            }
+            const payload = await response.json();
+            const routes = payloadRoutes(payload);
+            figure = figure || emptyFigure(routes);
+            const name = `page-${page}`;
+            const data = figure.data.filter(x => x.name !== name);
+            data.push(routesTrace(routes, name));
+            figure = Object.assign({}, figure, {data: data});
+
+            if (payload.pending > 0) {
+                state.pending.push(page);
+            }
+            if (state.page === page) {
+                state.page = payload.next_page;
+            }
+            return [figure, state, state.page === null && (state.pending.length === 0 ||
+                                                            state.retries >= state.max_retries)];
+        },
+    },
+});
@@ -0,0 +1,182 @@
+import argparse
+import contextlib
+import datetime as dt
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from parameters import *
+
+
+# End-to-end benchmarks of the whole pipeline against the fake Strava client, so they run without an account or
+# network access and give the same data every time. Every case (number of activities x points per stream) runs in a
+# fresh process, in an empty working directory, so the timings and peak memory of one don't leak into the next.
+# The results go to BENCHMARK_RESULTS_PATH as JSON, named after the commit, to compare commits with --compare.
+#   python bench_pipeline.py                              all cases
+#   python bench_pipeline.py --activities 1000 --points 10000 --latency 0.05
+#   python bench_pipeline.py --compare old.json new.json
+ACTIVITY_COUNTS = [10, 1_000, 10_000]
+POINT_COUNTS = [1_000, 10_000, 100_000]
+BENCHMARK_RESULTS_PATH = 'benchmark_results'
+BENCHMARK_QUOTA = (10 ** 6, 10 ** 7)
+
+
+def peakRss() -> dict:
+    # Peak resident set size (MB) of this process, and of the largest child it waited for (the feature pool)
+    return {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def directorySize(_path) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(_path) for name in names)
+
+
+def runCase(n_activities, n_points, latency) -> dict:
+    # Runs in its own process. The imports happen here, so the app's module-level state starts fresh in every case.
+    import functions as fun
+    from app_class import DashApp
+    from fake_strava import FakeClient, makeStreams
+    from fetcher import RateLimitBudget, StreamFetcher
+    from metrics import metrics
+    from sessions import UserSession
+
+    results = {'n_activities': n_activities, 'n_points': n_points, 'latency': latency}
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as cwd, contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(cwd)
+        budget = RateLimitBudget(*BENCHMARK_QUOTA)
+        user = UserSession(0, 'benchmark', budget)
+        client = FakeClient(latency=latency, short_limit=BENCHMARK_QUOTA[0], long_limit=BENCHMARK_QUOTA[1],
+                            n_points=n_points, n_activities=n_activities, enforce_quota=True, cap_resolution=False,
+                            requests_session=user.http)
+        app = DashApp(0, 'benchmark', 'benchmark')
+        user.client = client
+        user.stream_fetcher = StreamFetcher(client, budget)
+        user.setTokens(client.refresh_access_token())
+
+        # A first sync fetches everything, a second one only checks for new activities
+        for name in ('sync_first', 'sync_repeat'):
+            calls = client.calls
+            start = time.perf_counter()
+            app.syncAndRender(user, lambda stage, fraction: None)
+            results[f"{name}_seconds"] = time.perf_counter() - start
+            results[f"{name}_api_calls"] = client.calls - calls
+        results['stream_api_bytes'] = client.stream_bytes
+        results['store_bytes'] = directorySize(STORE_PATH)
+
+        # The pieces of a map, one by one, on the streams the sync already stored
+        run_id_list = [x['id'] for x in client.activities[::-1] if x['type'] == 'Run'][:MAP_ACTIVITY_LIMIT]
+        start = time.perf_counter()
+        polylines = app.genPolyLineList(user, [], MAP_STREAM_TYPES, run_id_list)
+        results['gen_polyline_list_seconds'] = time.perf_counter() - start
+
+        activity_stream = makeStreams(run_id_list[0], n_points, MAP_STREAM_TYPES)
+        start = time.perf_counter()
+        streams = fun.storeStream(MAP_STREAM_TYPES, activity_stream)
+        results['store_stream_seconds'] = time.perf_counter() - start
+        start = time.perf_counter()
+        polyline = fun.makePolyLine(streams)
+        results['make_polyline_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        activity_map = fun.plotMap(polylines)
+        map_html = activity_map.get_root().render()
+        results['plot_map_seconds'] = time.perf_counter() - start
+        results['map_bytes'] = len(map_html.encode('utf-8'))
+
+        # What the progressive map sends first, which shouldn't depend on the size of the history
+        start = time.perf_counter()
+        app.mapPage(user.athlete.id, 'Run', 0)
+        results['first_map_page_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        distance = sum(fun.latlngDistance(tuple(a), tuple(b)) for a, b in zip(polyline[:-1], polyline[1:]))
+        results['latlng_distance_seconds'] = time.perf_counter() - start
+        results['track_metres'] = distance
+
+        user.close()
+        results['api_calls'] = client.calls
+        results['stages'] = {name: stage['total_seconds'] for name, stage in metrics.snapshot()['stages'].items()}
+    results.update(peakRss())
+    return results
+
+
+def gitCommit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def runSuite(activity_counts, point_counts, latency) -> dict:
+    suite = {'commit': gitCommit(), 'time': dt.datetime.now(dt.timezone.utc).isoformat(),
+             'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+             'cpu_count': os.cpu_count(),
+             'parameters': {'MAP_ACTIVITY_LIMIT': MAP_ACTIVITY_LIMIT, 'FETCH_WORKERS': FETCH_WORKERS,
+                            'FEATURE_WORKERS': FEATURE_WORKERS, 'MAP_STREAM_RESOLUTION': MAP_STREAM_RESOLUTION,
+                            'MAP_RENDER_MODE': MAP_RENDER_MODE},
+             'cases': []}
+    context = multiprocessing.get_context('spawn')
+    for n_activities in activity_counts:
+        for n_points in point_counts:
+            print(f"{n_activities} activities, {n_points} points...", flush=True)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                case = executor.submit(runCase, n_activities, n_points, latency).result()
+            suite['cases'].append(case)
+            print(f"  sync {case['sync_first_seconds']:.2f} s, repeat {case['sync_repeat_seconds']:.2f} s, "
+                  f"map {case['plot_map_seconds']:.2f} s, peak RSS {case['peak_rss_mb']:.0f} MB", flush=True)
+    return suite
+
+
+def saveSuite(_suite, _path=BENCHMARK_RESULTS_PATH) -> str:
+    os.makedirs(_path, exist_ok=True)
+    stamp = dt.datetime.now(dt.timezone.utc).strftime('%Y%m%dT%H%M%S')
+    file_path = os.path.join(_path, f"{stamp}-{_suite['commit']}.json")
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump(_suite, file, indent=2)
+    return file_path
+
+
+def compareSuites(_old_path, _new_path) -> None:
+    # new / old for every number the two runs both have, per case. Below 1 is better for times, sizes and memory.
+    with open(_old_path, encoding='utf-8') as file:
+        old = json.load(file)
+    with open(_new_path, encoding='utf-8') as file:
+        new = json.load(file)
+    print(f"{old['commit']} -> {new['commit']}")
+    old_cases = {(x['n_activities'], x['n_points']): x for x in old['cases']}
+    for case in new['cases']:
+        old_case = old_cases.get((case['n_activities'], case['n_points']))
+        if old_case is None:
+            continue
+        print(f"{case['n_activities']} activities, {case['n_points']} points")
+        for key, value in case.items():
+            if key in ('n_activities', 'n_points', 'latency') or not isinstance(value, (int, float)):
+                continue
+            if old_case.get(key):
+                print(f"  {key:<28}{old_case[key]:>14.4f}{value:>14.4f}{value / old_case[key]:>10.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmarks against a fake Strava")
+    parser.add_argument('--activities', type=int, nargs='+', default=ACTIVITY_COUNTS)
+    parser.add_argument('--points', type=int, nargs='+', default=POINT_COUNTS)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every fake API call")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        compareSuites(*args.compare)
+    else:
+        print(f"Saved to {saveSuite(runSuite(args.activities, args.points, args.latency))}")
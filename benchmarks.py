@@ -0,0 +1,174 @@
+import gzip
+import tempfile
+import time
+
+import numpy as np
+
+import functions as fun
+import geodesy as geo
+import geometry as geom
+import simplify as simp
+from fake_strava import FakeClient, makeActivities, makeStreams
+from features import FeatureEngine
+from fetcher import RateLimitBudget, StreamFetcher
+from store import ActivityStore
+from parameters import *
+
+
+# Micro-benchmarks for the heavier bits of the pipeline. Run with: python benchmarks.py
+def timeIt(_function, *args, repeat=3):
+    # Best of a few runs, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def randomTrack(n_points, seed=0) -> np.ndarray:
+    # A random walk of roughly 5m steps around Utrecht
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, 0.00005, size=(n_points, 2))
+    return np.array([52.09, 5.12]) + np.cumsum(steps, axis=0)
+
+
+def benchGeodesy(n_points=100_000) -> dict:
+    latlng = randomTrack(n_points)
+    latlng_tuples = [tuple(x) for x in latlng]
+
+    def scalarSegments():
+        return [fun.latlngDistance(latlng_tuples[i], latlng_tuples[i + 1]) for i in range(n_points - 1)]
+
+    def scalarDistancesTo():
+        return [fun.latlngDistance(x, latlng_tuples[0]) for x in latlng_tuples]
+
+    scalar_total = sum(scalarSegments())
+    vector_total = geo.alongTrackDistance(latlng)[-1]
+    assert abs(scalar_total - vector_total) < 1e-6 * max(scalar_total, 1)
+
+    results = {
+        'n_points': n_points,
+        'segments_scalar': timeIt(scalarSegments),
+        'segments_vector': timeIt(geo.segmentDistances, latlng),
+        'along_track_vector': timeIt(geo.alongTrackDistance, latlng),
+        'distances_to_scalar': timeIt(scalarDistancesTo),
+        'distances_to_vector': timeIt(geo.distancesTo, latlng, latlng[0]),
+        'bearings_vector': timeIt(geo.bearings, latlng),
+    }
+    results['segments_speedup'] = results['segments_scalar'] / results['segments_vector']
+    results['distances_to_speedup'] = results['distances_to_scalar'] / results['distances_to_vector']
+    return results
+
+
+def benchSimplify(n_activities=100, n_points=5000) -> dict:
+    # Map size and render time at every level of detail, for a map with n_activities activities
+    polylines = [randomTrack(n_points, seed=i) for i in range(n_activities)]
+    start = time.perf_counter()
+    level_lists = [simp.simplifyLevels(x) for x in polylines]
+    results = {'n_activities': n_activities, 'n_points': n_points,
+               'simplify_time': time.perf_counter() - start}
+    for level, tolerance in enumerate(simp.SIMPLIFY_TOLERANCES):
+        start = time.perf_counter()
+        html = fun.plotMap([x[level] for x in level_lists]).get_root().render()
+        results[f"level_{level}_tolerance"] = tolerance
+        results[f"level_{level}_points"] = sum(len(x[level]) for x in level_lists)
+        results[f"level_{level}_bytes"] = len(html.encode('utf-8'))
+        results[f"level_{level}_render_time"] = time.perf_counter() - start
+    return results
+
+
+def benchMapPayload(n_activities=50, n_points=5000) -> dict:
+    # What it takes to get a map of n_activities activities to the browser: the Folium document that goes into an
+    # iframe, against the encoded polyline and GeoJSON payloads of the 'client' map mode. Sizes are in bytes, as sent
+    # (gzipped) and before compression. All three use the level of detail the app would pick.
+    level_lists = [simp.simplifyLevels(randomTrack(n_points, seed=i)) for i in range(n_activities)]
+    level = simp.chooseLevel(level_lists)
+    polylines = [x[level] for x in level_lists]
+    id_list = list(range(n_activities))
+    results = {'n_activities': n_activities, 'n_points': sum(len(x) for x in polylines)}
+
+    def folium():
+        return fun.plotMap(polylines).get_root().render().encode('utf-8')
+
+    def encoded():
+        return geom.payloadBytes(geom.encodedPayload(id_list, polylines), False)
+
+    def geoJson():
+        return geom.payloadBytes(geom.geoJsonPayload(id_list, polylines), False)
+
+    for name, function in (('folium', folium), ('polyline', encoded), ('geojson', geoJson)):
+        document = function()
+        start = time.perf_counter()
+        compressed = gzip.compress(document, compresslevel=6)
+        compress_time = time.perf_counter() - start
+        results[f"{name}_bytes"] = len(document)
+        results[f"{name}_gzip_bytes"] = len(compressed)
+        results[f"{name}_build_time"] = timeIt(function) + compress_time
+    results['polyline_size_ratio'] = results['folium_gzip_bytes'] / results['polyline_gzip_bytes']
+    results['geojson_size_ratio'] = results['folium_gzip_bytes'] / results['geojson_gzip_bytes']
+    return results
+
+
+def benchStreamTiers(n_activities=200, n_points=4000) -> dict:
+    # API calls and stream bytes for the maps of one sync (MAP_ACTIVITY_LIMIT runs and rides), fetched the way it used
+    # to be done (every stream type at medium resolution) against just the low resolution routes. Then what opening
+    # the best efforts tab adds: high resolution streams of the recent runs. Uses the fake client, which gives the
+    # same data every time.
+    activities = FakeClient(n_activities=n_activities).activities[::-1]
+    run_id_list = [x['id'] for x in activities if x['type'] == 'Run'][:MAP_ACTIVITY_LIMIT]
+    ride_id_list = [x['id'] for x in activities if x['type'] == 'Ride'][:MAP_ACTIVITY_LIMIT]
+    results = {'n_activities': len(run_id_list) + len(ride_id_list), 'n_points': n_points}
+    for name, id_list, type_list, resolution in (
+            ('untiered', run_id_list + ride_id_list, ['distance', 'time', 'latlng', 'altitude', 'heartrate'], 'medium'),
+            ('map_tier', run_id_list + ride_id_list, MAP_STREAM_TYPES, MAP_STREAM_RESOLUTION),
+            ('analytics_tier', run_id_list, ANALYTICS_STREAM_TYPES, ANALYTICS_STREAM_RESOLUTION)):
+        client = FakeClient(n_points=n_points, short_limit=10 ** 6, long_limit=10 ** 6)
+        StreamFetcher(client, RateLimitBudget(10 ** 6, 10 ** 6)).fetchStreams(id_list, type_list, resolution)
+        results[f"{name}_calls"] = client.calls
+        results[f"{name}_bytes"] = client.stream_bytes
+    results['map_bytes_saving'] = 1 - results['map_tier_bytes'] / results['untiered_bytes']
+    return results
+
+
+def benchFeatures(n_activities=1000, n_points=4000) -> dict:
+    # Feature extraction over a whole (fake) history, in one process and in the pool, and then classifying all of it
+    # again from the stored features
+    results = {'n_activities': n_activities, 'n_points': n_points}
+    with tempfile.TemporaryDirectory() as root:
+        store = ActivityStore(root)
+        activities = makeActivities(n_activities)
+        store.saveActivities(1, activities)
+        for activity in activities:
+            store.saveStreams(1, activity['id'], ANALYTICS_STREAM_TYPES,
+                              makeStreams(activity['id'], n_points, ANALYTICS_STREAM_TYPES), 'high')
+        id_list = [x['id'] for x in activities]
+        for name, max_workers in (('serial', 1), ('pool', FEATURE_WORKERS)):
+            start = time.perf_counter()
+            FeatureEngine(store, max_workers=max_workers).update(1, id_list)
+            results[f"{name}_seconds"] = time.perf_counter() - start
+            with store._connect() as conn:
+                conn.execute("DELETE FROM activity_features")
+        engine = FeatureEngine(store)
+        engine.update(1, id_list)
+        results['classify_seconds'] = timeIt(engine.classify, 1, 'Run')
+    return results
+
+
+def printResults(_name, _results) -> None:
+    print(_name)
+    for key, value in _results.items():
+        if isinstance(value, float):
+            print(f"  {key:<24}{value:.6f}")
+        else:
+            print(f"  {key:<24}{value}")
+
+
+if __name__ == '__main__':
+    for n in (100_000, 1_000_000):
+        printResults(f"Geodesy, {n} points", benchGeodesy(n))
+    printResults("Polyline simplification", benchSimplify())
+    printResults("Map payload", benchMapPayload())
+    printResults("Stream resolution tiers", benchStreamTiers())
+    printResults("Workout features", benchFeatures())
@@ -0,0 +1,61 @@
+import numpy as np
+
+from parameters import *
+
+
+# Fastest time over each of BEST_EFFORT_DISTANCES within an activity, from its distance and time streams.
+# For every possible start point, the end point is the first one that's at least the target distance further along.
+# Both pointers only ever move forward, so this is the two-pointer sliding window, done for all start points at once
+# with searchsorted on the (sorted) distance stream. The end time is interpolated to the exact target distance.
+def bestEffort(_distance, _time, _target):
+    # Returns (elapsed time in seconds, start index, end index), or None if the activity is too short
+    _distance = np.maximum.accumulate(np.asarray(_distance, dtype=np.float64))
+    _time = np.asarray(_time, dtype=np.float64)
+    if len(_distance) < 2 or _distance[-1] - _distance[0] < _target:
+        return None
+    _end = np.searchsorted(_distance, _distance + _target, side='left')
+    _valid = _end < len(_distance)
+    _start = np.nonzero(_valid)[0]
+    _end = _end[_valid]
+
+    # Interpolate the time at which the target distance is reached, between end - 1 and end (end is always past start)
+    _before = _end - 1
+    _span = _distance[_end] - _distance[_before]
+    _fraction = np.divide(_distance[_start] + _target - _distance[_before], _span,
+                          out=np.ones_like(_span), where=_span > 0)
+    _end_time = _time[_before] + _fraction * (_time[_end] - _time[_before])
+    _elapsed = _end_time - _time[_start]
+
+    _best = int(np.argmin(_elapsed))
+    return float(_elapsed[_best]), int(_start[_best]), int(_end[_best])
+
+
+def bestEfforts(_activity_streams, _targets=BEST_EFFORT_DISTANCES) -> dict:
+    # {name: (elapsed, start, end) or None} for every target distance
+    if 'distance' not in _activity_streams or 'time' not in _activity_streams:
+        return {name: None for name in _targets}
+    return {name: bestEffort(_activity_streams['distance'], _activity_streams['time'], target)
+            for name, target in _targets.items()}
+
+
+class BestEffortsEngine:
+    def __init__(self, store, targets=BEST_EFFORT_DISTANCES):
+        self.store = store
+        self.targets = targets
+
+    def update(self, athlete_id, id_list, resolution=ANALYTICS_STREAM_RESOLUTION) -> int:
+        # Works out the best efforts of the activities that don't have a result for every target distance yet.
+        # Activities that are too short still get a row (without a time), so they aren't looked at again.
+        # Activities without streams yet are left for later, after the next sync
+        missing_id_list = self.store.missingBestEfforts(athlete_id, id_list, list(self.targets))
+        no_streams = set(self.store.missingStreams(athlete_id, missing_id_list, ['distance', 'time'], resolution))
+        missing_id_list = [x for x in missing_id_list if x not in no_streams]
+        counter = 0
+        for activity_id in missing_id_list:
+            activity_streams = self.store.loadStreams(athlete_id, activity_id, ['distance', 'time'], resolution)
+            if 'distance' not in activity_streams or 'time' not in activity_streams:
+                continue
+            results = bestEfforts(activity_streams, self.targets)
+            self.store.saveBestEfforts(athlete_id, activity_id, self.targets, results)
+            counter += 1
+        return counter
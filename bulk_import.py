@@ -0,0 +1,303 @@
+import argparse
+import csv
+import datetime as dt
+import gzip
+import io
+import struct
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from parameters import *
+import geodesy as geo
+from derived import DerivedEngine
+from store import ActivityStore
+
+
+# Imports the archive you get from Strava's "Download your data" (Settings > My Account), without going through the
+# API: activities.csv has the summaries, and activities/ has the recording of every activity as GPX, TCX or FIT,
+# often gzipped. Files are read straight out of the zip and parsed in a process pool. Everything goes into the same
+# store the API sync uses, with the recordings as high resolution streams, so a sync afterwards only fetches what's
+# newer than the archive.
+FIT_EPOCH = 631065600  # 1989-12-31 00:00 UTC, where FIT timestamps start
+FIT_RECORD = 20
+FIT_INVALID = {1: 0xff, 2: 0x7f, 0x83: 0x7fff, 0x84: 0xffff, 0x85: 0x7fffffff, 0x86: 0xffffffff}
+FIT_FORMATS = {0: 'B', 1: 'b', 2: 'B', 0x83: 'h', 0x84: 'H', 0x85: 'i', 0x86: 'I', 0x88: 'f', 0x89: 'd',
+               0x8b: 'H', 0x8c: 'I', 0x0a: 'B', 0x8e: 'q', 0x8f: 'Q'}
+
+
+def _localName(tag) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _isoTime(text):
+    return dt.datetime.fromisoformat(text.strip().replace('Z', '+00:00'))
+
+
+def parseGpx(data) -> list:
+    # Track points as (time, lat, lng, altitude, distance, heartrate), with None for whatever is missing
+    points = []
+    for element in ET.fromstring(data.lstrip()).iter():
+        if _localName(element.tag) != 'trkpt':
+            continue
+        values = {_localName(x.tag): x.text for x in element.iter()}
+        points.append((_isoTime(values['time']) if values.get('time') else None,
+                       float(element.get('lat')), float(element.get('lon')),
+                       float(values['ele']) if values.get('ele') else None,
+                       None,
+                       float(values['hr']) if values.get('hr') else None))
+    return points
+
+
+def parseTcx(data) -> list:
+    points = []
+    for element in ET.fromstring(data.lstrip()).iter():
+        if _localName(element.tag) != 'Trackpoint':
+            continue
+        values = {}
+        for child in element.iter():
+            name = _localName(child.tag)
+            # HeartRateBpm wraps its number in a Value element
+            values['HeartRateBpm' if name == 'Value' else name] = child.text
+        latitude = values.get('LatitudeDegrees')
+        longitude = values.get('LongitudeDegrees')
+        points.append((_isoTime(values['Time']) if values.get('Time') else None,
+                       float(latitude) if latitude else None, float(longitude) if longitude else None,
+                       float(values['AltitudeMeters']) if values.get('AltitudeMeters') else None,
+                       float(values['DistanceMeters']) if values.get('DistanceMeters') else None,
+                       float(values['HeartRateBpm']) if values.get('HeartRateBpm') else None))
+    return points
+
+
+def parseFit(data) -> list:
+    # Just enough of the FIT protocol for the record messages: definition and data messages, compressed timestamp
+    # headers and developer fields (skipped). Positions are in semicircles, altitude in 1/5 m with a 500 m offset,
+    # distance in cm.
+    header_size = data[0]
+    data_end = header_size + struct.unpack_from('<I', data, 4)[0]
+    definitions = {}
+    points = []
+    timestamp = None
+    offset = header_size
+    while offset < data_end:
+        record_header = data[offset]
+        offset += 1
+        if record_header & 0x80:
+            # Compressed timestamp: the low 5 bits of the time, relative to the last full timestamp. Without one of
+            # those yet, the record has no time.
+            local_type = (record_header >> 5) & 0x03
+            time_offset = record_header & 0x1f
+            if timestamp is not None:
+                timestamp = (timestamp & ~0x1f) + time_offset + (0x20 if time_offset < (timestamp & 0x1f) else 0)
+        elif record_header & 0x40:
+            local_type = record_header & 0x0f
+            endian = '>' if data[offset + 1] else '<'
+            global_type, n_fields = struct.unpack_from(endian + 'HB', data, offset + 2)
+            offset += 5
+            fields = [tuple(data[offset + 3 * i:offset + 3 * i + 3]) for i in range(n_fields)]
+            offset += 3 * n_fields
+            developer_size = 0
+            if record_header & 0x20:
+                n_developer_fields = data[offset]
+                developer_size = sum(data[offset + 1 + 3 * i + 1] for i in range(n_developer_fields))
+                offset += 1 + 3 * n_developer_fields
+            definitions[local_type] = (endian, global_type, fields, developer_size)
+            continue
+        else:
+            local_type = record_header & 0x0f
+
+        endian, global_type, fields, developer_size = definitions[local_type]
+        values = {}
+        for number, size, base_type in fields:
+            fmt = FIT_FORMATS.get(base_type)
+            if fmt is not None and struct.calcsize(fmt) == size:
+                value = struct.unpack_from(endian + fmt, data, offset)[0]
+                if value != FIT_INVALID.get(base_type):
+                    values[number] = value
+            offset += size
+        offset += developer_size
+
+        if 253 in values:
+            timestamp = values[253]
+        if global_type != FIT_RECORD:
+            continue
+        altitude = values.get(78, values.get(2))
+        points.append((None if timestamp is None else
+                       dt.datetime.fromtimestamp(timestamp + FIT_EPOCH, dt.timezone.utc),
+                       values[0] * 180 / 2 ** 31 if 0 in values else None,
+                       values[1] * 180 / 2 ** 31 if 1 in values else None,
+                       None if altitude is None else altitude / 5 - 500,
+                       values[5] / 100 if 5 in values else None,
+                       values.get(3)))
+    return points
+
+
+def _fill(values):
+    # Column of floats with NaN for missing values, or None if it's missing everywhere. Gaps get the nearest earlier
+    # value (or the first one, at the start).
+    column = np.array([np.nan if x is None else x for x in values], dtype=np.float64)
+    known = ~np.isnan(column)
+    if not known.any():
+        return None
+    index = np.where(known, np.arange(len(column)), 0)
+    np.maximum.accumulate(index, out=index)
+    column = column[index]
+    column[:np.argmax(known)] = column[np.argmax(known)]
+    return column
+
+
+def pointsToStreams(points) -> dict:
+    # Streams like the API gives them. Points without a position are left out, unless none of them has one.
+    if any(x[1] is not None for x in points):
+        points = [x for x in points if x[1] is not None and x[2] is not None]
+    if len(points) < 2:
+        return {}
+    streams = {}
+    if points[0][1] is not None:
+        streams['latlng'] = np.array([(x[1], x[2]) for x in points], dtype=np.float64)
+    if points[0][0] is not None and all(x[0] is not None for x in points):
+        streams['time'] = np.round([(x[0] - points[0][0]).total_seconds() for x in points])
+    distance = _fill(x[4] for x in points)
+    if distance is None and 'latlng' in streams:
+        distance = geo.alongTrackDistance(streams['latlng'])
+    if distance is not None:
+        streams['distance'] = distance
+    for item, index in (('altitude', 3), ('heartrate', 5)):
+        column = _fill(x[index] for x in points)
+        if column is not None:
+            streams[item] = column
+    return streams
+
+
+_archives = {}
+
+
+def _parseMember(archive_path, member_name):
+    # Runs in the worker processes, which each keep their own handle on the archive
+    if archive_path not in _archives:
+        _archives[archive_path] = zipfile.ZipFile(archive_path)
+    name = member_name.lower()
+    try:
+        # A damaged member (bad CRC, corrupt deflate stream) only costs that one activity
+        data = _archives[archive_path].read(member_name)
+        if name.endswith('.gz'):
+            data = gzip.decompress(data)
+            name = name[:-3]
+        if name.endswith('.gpx'):
+            points = parseGpx(data)
+        elif name.endswith('.tcx'):
+            points = parseTcx(data)
+        elif name.endswith('.fit'):
+            points = parseFit(data)
+        else:
+            return None
+    except (ET.ParseError, struct.error, KeyError, ValueError, IndexError, gzip.BadGzipFile, EOFError,
+            zlib.error, zipfile.BadZipFile) as error:
+        print(f"Couldn't read {member_name}: {error}")
+        return None
+
+    streams = pointsToStreams(points)
+    if len(streams) == 0:
+        return None
+    return {'streams': streams,
+            'start_date': None if points[0][0] is None else points[0][0].isoformat(),
+            'start_latlng': streams['latlng'][0].tolist() if 'latlng' in streams else [],
+            'end_latlng': streams['latlng'][-1].tolist() if 'latlng' in streams else []}
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def activityFromCsv(row) -> dict:
+    # A row of activities.csv as an activity dict shaped like the API's, with the fields of activity_cols. Some column
+    # names appear twice, first in display units and then in SI units; csv.DictReader keeps the last, SI, one.
+    start_date = dt.datetime.strptime(row['Activity Date'], '%b %d, %Y, %I:%M:%S %p').replace(tzinfo=dt.timezone.utc)
+    activity = {col: None for col in activity_cols}
+    activity.update({
+        'id': int(row['Activity ID']),
+        'name': row.get('Activity Name'),
+        'description': row.get('Activity Description') or None,
+        'type': ''.join(row.get('Activity Type', '').split()) or None,
+        'distance': _number(row.get('Distance')),
+        'moving_time': _number(row.get('Moving Time')),
+        'total_elevation_gain': _number(row.get('Elevation Gain')),
+        'elev_high': _number(row.get('Elevation High')),
+        'elev_low': _number(row.get('Elevation Low')),
+        'average_speed': _number(row.get('Average Speed')),
+        'max_speed': _number(row.get('Max Speed')),
+        'has_heartrate': _number(row.get('Max Heart Rate')) is not None,
+        'calories': _number(row.get('Calories')),
+        'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'start_latlng': [],
+        'end_latlng': [],
+    })
+    return activity
+
+
+def readAthleteId(archive):
+    if 'profile.csv' not in archive.namelist():
+        return None
+    with archive.open('profile.csv') as file:
+        rows = list(csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig')))
+    return int(rows[0]['Athlete ID']) if len(rows) > 0 and rows[0].get('Athlete ID') else None
+
+
+def importArchive(archive_path, store, athlete_id=None, max_workers=IMPORT_WORKERS) -> dict:
+    start = time.perf_counter()
+    with zipfile.ZipFile(archive_path) as archive:
+        if athlete_id is None:
+            athlete_id = readAthleteId(archive)
+        if athlete_id is None:
+            raise ValueError("No athlete id given, and the archive has no profile.csv to take it from")
+        with archive.open('activities.csv') as file:
+            rows = list(csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig')))
+        member_names = set(archive.namelist())
+
+    activities = [activityFromCsv(x) for x in rows]
+    file_names = [x.get('Filename') or None for x in rows]
+
+    # Activities that already have high resolution streams (e.g. from an earlier import) are skipped
+    todo_id_set = set(store.missingStreams(athlete_id, [x['id'] for x in activities], ['latlng'],
+                                           ANALYTICS_STREAM_RESOLUTION))
+    todo = [(x, y) for x, y in zip(activities, file_names) if x['id'] in todo_id_set and y in member_names]
+
+    stream_count = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parsed_list = executor.map(_parseMember, repeat(archive_path), [x[1] for x in todo], chunksize=8)
+        for (activity, _), parsed in zip(todo, parsed_list):
+            if parsed is None:
+                continue
+            activity['start_latlng'] = parsed['start_latlng']
+            activity['end_latlng'] = parsed['end_latlng']
+            # The recording is all there is, so streams that aren't in it don't exist. Record the full request, like
+            # saveStreams does for the API, so nothing gets fetched for them later.
+            store.saveStreams(athlete_id, activity['id'], ANALYTICS_STREAM_TYPES, parsed['streams'],
+                              ANALYTICS_STREAM_RESOLUTION)
+            stream_count += 1
+
+    store.saveActivities(athlete_id, activities)
+    DerivedEngine(store).update(athlete_id, [x[0]['id'] for x in todo], ANALYTICS_STREAM_RESOLUTION)
+    elapsed = time.perf_counter() - start
+    results = {'athlete_id': athlete_id, 'activities': len(activities), 'recordings': stream_count,
+               'seconds': elapsed, 'activities_per_second': len(activities) / elapsed if elapsed > 0 else 0}
+    print(f"Imported {len(activities)} activities ({stream_count} recordings) in {elapsed:.1f}s, "
+          f"{results['activities_per_second']:.1f} activities/s")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import a Strava account export archive into the local store")
+    parser.add_argument('archive', help="Path of the export .zip")
+    parser.add_argument('--athlete-id', type=int, default=None, help="Only needed if the archive has no profile.csv")
+    parser.add_argument('--workers', type=int, default=IMPORT_WORKERS)
+    arguments = parser.parse_args()
+    importArchive(arguments.archive, ActivityStore(), arguments.athlete_id, arguments.workers)
@@ -0,0 +1,90 @@
+import numpy as np
+
+from parameters import *
+from streams import ActivityStreams
+
+
+# Streams derived from the ones we fetch: smoothed altitude, grade, speed, grade-adjusted speed, a moving mask and the
+# heart rate zone of every point. They're worked out once per activity, right after its streams come in, over whole
+# arrays at once, and stored as extra columns next to the streams, so charts and analyses just load them.
+# Windows are taken around every point by distance (altitude, grade) or by time (speed), with prefix sums and
+# np.interp rather than a number of points, so they work the same whatever the sampling rate of the recording.
+DERIVED_INPUT_TYPES = ['distance', 'time', 'altitude', 'heartrate']
+# Energy cost of running (J/kg/m) as a function of grade, from Minetti et al. (2002). Highest power first.
+MINETTI_COEFFICIENTS = [155.4, -30.4, -43.3, 46.3, 19.5, 3.6]
+
+
+def windowMean(_x, _values, _width) -> np.ndarray:
+    # Mean of _values over the points within _width / 2 of every point, along the increasing _x
+    _cumulative = np.concatenate(([0], np.cumsum(_values, dtype=np.float64)))
+    _lo = np.searchsorted(_x, _x - _width / 2, side='left')
+    _hi = np.searchsorted(_x, _x + _width / 2, side='right')
+    return (_cumulative[_hi] - _cumulative[_lo]) / (_hi - _lo)
+
+
+def centralRate(_x, _y, _width) -> np.ndarray:
+    # dy/dx around every point, over _width (less at the ends of the activity)
+    _lo = np.maximum(_x - _width / 2, _x[0])
+    _hi = np.minimum(_x + _width / 2, _x[-1])
+    _span = _hi - _lo
+    _rise = np.interp(_hi, _x, _y) - np.interp(_lo, _x, _y)
+    return np.divide(_rise, _span, out=np.zeros_like(_rise), where=_span > 0)
+
+
+def gapFactor(_grade) -> np.ndarray:
+    # How much harder running at this grade is than on the flat, so speed * factor is the equivalent flat speed
+    return np.polyval(MINETTI_COEFFICIENTS, _grade) / MINETTI_COEFFICIENTS[-1]
+
+
+def hrZones(_heartrate, _max_hr=HR_MAX, _fractions=HR_ZONE_FRACTIONS) -> np.ndarray:
+    # Zone of every point, 0 for zone 1 up to len(_fractions) for the top one, -1 where there's no heart rate
+    _zones = np.searchsorted(_max_hr * np.asarray(_fractions), _heartrate, side='right').astype(np.int8)
+    _zones[~(np.asarray(_heartrate) > 0)] = -1
+    return _zones
+
+
+def zoneTimes(_zones, _time, _n_zones=len(HR_ZONE_FRACTIONS) + 1) -> np.ndarray:
+    # Seconds in every zone. Every point counts for the time since the previous one, capped at FEATURE_WINDOW so
+    # pauses don't count, and points without heart rate don't count at all.
+    _valid = _zones >= 0
+    _time = np.asarray(_time, dtype=np.float64)[_valid]
+    _weights = np.minimum(np.diff(_time, prepend=_time[0] if len(_time) > 0 else 0), FEATURE_WINDOW)
+    return np.bincount(_zones[_valid], weights=_weights, minlength=_n_zones)
+
+
+def derivedStreams(_activity_streams) -> dict:
+    # {type: array} for DERIVED_STREAM_TYPES, as far as the streams allow: nothing without distance and time, no
+    # altitude or grade columns without altitude, no zones without heart rate
+    if 'distance' not in _activity_streams or 'time' not in _activity_streams:
+        return {}
+    _distance = np.maximum.accumulate(np.asarray(_activity_streams['distance'], dtype=np.float64))
+    _time = np.asarray(_activity_streams['time'], dtype=np.float64)
+    if len(_distance) < 2 or len(_distance) != len(_time):
+        return {}
+
+    _speed = centralRate(_time, _distance, FEATURE_WINDOW)
+    columns = {'speed': _speed.astype(np.float32), 'is_moving': _speed >= MOVING_SPEED}
+    if 'altitude' in _activity_streams and len(_activity_streams['altitude']) == len(_distance):
+        _altitude = windowMean(_distance, np.asarray(_activity_streams['altitude'], dtype=np.float64), GRADE_STEP)
+        _grade = np.clip(centralRate(_distance, _altitude, GRADE_STEP), -DERIVED_MAX_GRADE, DERIVED_MAX_GRADE)
+        columns['altitude_smooth'] = _altitude.astype(np.float32)
+        columns['grade'] = _grade.astype(np.float32)
+        columns['gap_speed'] = (_speed * gapFactor(_grade)).astype(np.float32)
+    if 'heartrate' in _activity_streams and len(_activity_streams['heartrate']) == len(_distance):
+        columns['hr_zone'] = hrZones(np.asarray(_activity_streams['heartrate'], dtype=np.float64))
+    return columns
+
+
+class DerivedEngine:
+    def __init__(self, store):
+        self.store = store
+
+    def update(self, athlete_id, id_list, resolution=ANALYTICS_STREAM_RESOLUTION) -> int:
+        # Works out the derived streams of the activities that have distance and time streams at this resolution, but
+        # no derived streams of this DERIVED_VERSION yet. Returns how many it did.
+        missing_id_list = self.store.missingDerived(athlete_id, id_list, resolution, DERIVED_VERSION)
+        for activity_id in missing_id_list:
+            activity_streams = self.store.tierStreams(athlete_id, activity_id, resolution, DERIVED_INPUT_TYPES)
+            self.store.saveDerived(athlete_id, activity_id, resolution, DERIVED_VERSION,
+                                   ActivityStreams(derivedStreams(activity_streams)))
+        return len(missing_id_list)
@@ -0,0 +1,174 @@
+import datetime as dt
+import json
+import threading
+import time
+
+import numpy as np
+from stravalib.exc import RateLimitExceeded
+
+import geodesy as geo
+
+
+# A stand-in for stravalib's Client, so the fetch code can be run without network access or a Strava account.
+# It only implements the calls the app makes, and reports rate limit headers the same way the real API does.
+# Streams come back at most at the number of points Strava gives for each resolution (unless cap_resolution is off,
+# for benchmarking with bigger streams), and the client keeps count of the bytes the real API would have sent for them.
+# With enforce_quota, requests past the limits fail like they would on Strava, instead of only being reported.
+# Given a requests_session (as stravalib's Client takes one), its response hooks see every call, like real responses.
+RESOLUTION_POINTS = {'low': 100, 'medium': 1000, 'high': 10000}
+
+
+class FakeStream:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeModel:
+    # Just enough of a stravalib model: the fields as attributes, and to_dict()
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def to_dict(self) -> dict:
+        return {key: [x.to_dict() for x in value] if isinstance(value, list) else value
+                for key, value in self.__dict__.items()}
+
+
+class FakeProtocol:
+    def __init__(self, client):
+        self.client = client
+        self.rate_limiter = None
+
+    def get(self, url, check_for_errors=True, **kwargs):
+        if url == '/athlete/activities':
+            return self.client.listActivities(**kwargs)
+        raise NotImplementedError(f"FakeProtocol does not know {url}")
+
+
+class FakeClient:
+    def __init__(self, latency=0.0, short_limit=100, long_limit=1000, fail_ids=(), n_points=500, n_activities=100,
+                 enforce_quota=False, cap_resolution=True, count_bytes=True, requests_session=None):
+        self.protocol = FakeProtocol(self)
+        self.requests_session = requests_session
+        self.activities = makeActivities(n_activities)
+        self.latency = latency
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.fail_ids = set(fail_ids)
+        self.n_points = n_points
+        self.enforce_quota = enforce_quota
+        self.cap_resolution = cap_resolution
+        self.count_bytes = count_bytes
+        self.access_token = None
+        self.refresh_token = None
+
+        self.calls = 0
+        self.stream_bytes = 0
+        self._lock = threading.Lock()
+
+    def _respond(self, path, status) -> None:
+        if self.requests_session is None:
+            return
+        response = FakeModel(request=FakeModel(method='GET'), url=f"https://www.strava.com/api/v3{path}",
+                             status_code=status, elapsed=dt.timedelta(seconds=self.latency))
+        for hook in self.requests_session.hooks['response']:
+            hook(response)
+
+    def _request(self, path, activity_id=None):
+        with self._lock:
+            self.calls += 1
+            calls = self.calls
+        if self.latency:
+            time.sleep(self.latency)
+        if self.protocol.rate_limiter is not None:
+            self.protocol.rate_limiter({'X-RateLimit-Limit': f"{self.short_limit},{self.long_limit}",
+                                        'X-RateLimit-Usage': f"{calls},{calls}"}, 'GET')
+        if self.enforce_quota and (calls > self.short_limit or calls > self.long_limit):
+            self._respond(path, 429)
+            raise RateLimitExceeded("Rate limit exceeded", limit=min(self.short_limit, self.long_limit))
+        if activity_id in self.fail_ids:
+            raise ConnectionError(f"Fake failure for activity {activity_id}")
+        self._respond(path, 200)
+
+    def listActivities(self, after=0, page=1, per_page=30):
+        # Like the real API when "after" is given: oldest first, paged
+        self._request('/athlete/activities')
+        activities = [x for x in self.activities if x['_timestamp'] > after]
+        return activities[(page - 1) * per_page:page * per_page]
+
+    def get_activity_streams(self, activity_id, types=None, resolution='medium', series_type='distance'):
+        self._request(f"/activities/{activity_id}/streams", activity_id)
+        n_points = min(self.n_points, RESOLUTION_POINTS[resolution]) if self.cap_resolution else self.n_points
+        streams = makeStreams(activity_id, n_points, types)
+        if self.count_bytes:
+            n_bytes = len(json.dumps([{'type': key, 'data': value.data.tolist()} for key, value in streams.items()]))
+            with self._lock:
+                self.stream_bytes += n_bytes
+        return streams
+
+    def get_athlete(self):
+        self._request('/athlete')
+        return FakeModel(id=1, firstname="Fake", lastname="Athlete",
+                         shoes=[FakeModel(id='g1', name="Fake shoe", primary=True)],
+                         bikes=[FakeModel(id='b1', name="Fake bike", primary=True)])
+
+    def get_gear(self, gear_id):
+        self._request(f"/gear/{gear_id}")
+        distance = sum(x['distance'] for x in self.activities if x['gear_id'] == gear_id)
+        return FakeModel(id=gear_id, name=f"Fake gear {gear_id}", brand_name="Fake", distance=distance)
+
+    def refresh_access_token(self, client_id=None, client_secret=None, refresh_token=None):
+        # Not rate limited on Strava either
+        return {'access_token': 'fake-access', 'refresh_token': 'fake-refresh',
+                'expires_at': int(time.time()) + 6 * 3600}
+
+
+def makeActivities(n_activities) -> list:
+    # Raw activity dicts, shaped like the /athlete/activities response, one every day or so
+    start = dt.datetime(2020, 1, 1, 7, tzinfo=dt.timezone.utc)
+    activities = []
+    for i in range(n_activities):
+        start_date = start + dt.timedelta(hours=26 * i)
+        activity_type = 'Ride' if i % 4 == 3 else 'Run'
+        distance = (25000.0 if activity_type == 'Ride' else 8000.0) + (i % 7) * 500
+        activities.append({
+            'id': 1000 + i,
+            'name': f"{activity_type} #{i}",
+            'type': activity_type,
+            'distance': distance,
+            'moving_time': int(distance / (7.0 if activity_type == 'Ride' else 3.0)),
+            'total_elevation_gain': float(i % 50),
+            'average_speed': 7.0 if activity_type == 'Ride' else 3.0,
+            'max_speed': 12.0 if activity_type == 'Ride' else 5.0,
+            'gear_id': 'g1' if activity_type == 'Run' else 'b1',
+            'has_heartrate': True,
+            'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'start_latlng': [52.0, 5.0],
+            'end_latlng': [52.0, 5.0],
+            'map': {'id': f"a{1000 + i}", 'summary_polyline': ''},
+            '_timestamp': int(start_date.timestamp()),
+        })
+    return activities
+
+
+def makeStreams(activity_id, n_points, types=None) -> dict:
+    # A wobbly loop (a few km around) of a point that depends on the activity id, so every activity gets its own
+    # reproducible route, with altitude and heart rate to match. Everything is a function of how far along the
+    # activity a point is, so the resolutions of one activity are samples of the same recording.
+    rng = np.random.default_rng(activity_id)
+    phases = rng.uniform(0, 2 * np.pi, size=4)
+    along = np.arange(n_points) / max(n_points, 1)
+    angle = 2 * np.pi * along
+    radius = 0.01 * (1 + 0.15 * np.sin(7 * angle + phases[0]) + 0.05 * np.sin(23 * angle + phases[1]))
+    lat0 = 52.0 + (activity_id % 100) * 0.001
+    lng0 = 5.0 + (activity_id % 37) * 0.001
+    latlng = np.column_stack([lat0 + radius * np.sin(angle), lng0 + 1.5 * radius * np.cos(angle)])
+    streams = {
+        'latlng': latlng,
+        'distance': geo.alongTrackDistance(latlng) if n_points > 0 else np.zeros(0),
+        'time': np.round(along * 3600).astype(np.int64),
+        'altitude': 10 + 5 * np.sin(5 * angle + phases[2]),
+        'heartrate': np.round(140 + 15 * np.sin(3 * angle + phases[3])).astype(np.int64),
+    }
+    if types is not None:
+        streams = {key: value for key, value in streams.items() if key in types}
+    return {key: FakeStream(value) for key, value in streams.items()}
@@ -0,0 +1,194 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from parameters import *
+from derived import derivedStreams, zoneTimes
+from store import ActivityStore
+
+
+# Features of a workout, from its distance, time and heartrate streams and the streams derived from them (see
+# derived.py): how much the pace varies, surges (stretches well above the activity's median speed, like the reps of an
+# interval session), time moving, time in each heart rate zone, grade statistics and the grade-adjusted speed. They're
+# worked out once per activity, in batches spread over a process pool, and stored, so classifying the whole history
+# again only needs the stored features, never the streams.
+FEATURE_NAMES = ['distance', 'moving_time', 'mean_speed', 'speed_cv', 'surge_count', 'surge_fraction', 'hr_mean',
+                 'hr_z1', 'hr_z2', 'hr_z3', 'hr_z4', 'hr_z5', 'grade_abs_mean', 'grade_std', 'climb_per_km',
+                 'gap_speed']
+# The raw altitude is only there for streams that don't have their derived streams yet
+FEATURE_STREAM_TYPES = ['distance', 'time', 'heartrate', 'altitude'] + DERIVED_STREAM_TYPES
+
+
+def _runs(_mask):
+    # (start, end) indices of the stretches where _mask is True, end exclusive
+    _changes = np.diff(np.concatenate(([0], _mask.astype(np.int8), [0])))
+    return np.nonzero(_changes == 1)[0], np.nonzero(_changes == -1)[0]
+
+
+def windowSpeeds(_time, _speed, _window=FEATURE_WINDOW, _smoothing=FEATURE_SMOOTHING) -> np.ndarray:
+    # The derived speed (m/s, over _window seconds around every point) in the middle of consecutive _window second
+    # windows, as a moving average over _smoothing windows. Going by time rather than by point means recordings with
+    # different sampling rates give comparable numbers.
+    _grid = np.arange(_time[0], _time[-1], _window, dtype=np.float64)
+    if len(_grid) < 2:
+        return np.zeros(0)
+    _speed = np.interp(_grid[:-1] + _window / 2, _time, _speed)
+    if _smoothing > 1 and len(_speed) >= _smoothing:
+        _speed = np.convolve(_speed, np.ones(_smoothing) / _smoothing, mode='same')
+    return _speed
+
+
+def gradeStats(_distance, _altitude, _grade, _step=GRADE_STEP):
+    # (mean absolute grade, standard deviation of the grade, metres climbed per km), from the derived grade and
+    # smoothed altitude, in the middle of and over _step metre stretches
+    _grid = np.arange(_distance[0], _distance[-1], _step, dtype=np.float64)
+    if len(_grid) < 2:
+        return None, None, None
+    _rise = np.diff(np.interp(_grid, _distance, _altitude))
+    _grade = np.interp(_grid[:-1] + _step / 2, _distance, _grade)
+    _km = (_grid[-1] - _grid[0]) / 1000
+    return float(np.abs(_grade).mean()), float(_grade.std()), float(_rise[_rise > 0].sum() / _km)
+
+
+def workoutFeatures(_activity_streams) -> dict:
+    # {name: value} for FEATURE_NAMES, with None for the ones the streams don't allow (no heartrate, no altitude).
+    # Empty if the activity has no usable distance and time streams.
+    if 'distance' not in _activity_streams or 'time' not in _activity_streams:
+        return {}
+    _distance = np.maximum.accumulate(np.asarray(_activity_streams['distance'], dtype=np.float64))
+    _time = np.asarray(_activity_streams['time'], dtype=np.float64)
+    if len(_distance) < 2 or len(_distance) != len(_time):
+        return {}
+    # The derived streams are normally stored already
+    _derived = _activity_streams if 'speed' in _activity_streams else derivedStreams(_activity_streams)
+    _speed = windowSpeeds(_time, np.asarray(_derived['speed'], dtype=np.float64))
+    _moving = _speed >= MOVING_SPEED
+    # Time moving: every moving point counts for the time since the previous one, capped at FEATURE_WINDOW like in
+    # zoneTimes
+    _is_moving = np.asarray(_derived['is_moving'], dtype=bool)
+    _weights = np.minimum(np.diff(_time, prepend=_time[0]), FEATURE_WINDOW)[_is_moving]
+    _moving_time = float(_weights.sum())
+    if not _moving.any() or _moving_time <= 0:
+        return {}
+
+    _moving_speed = _speed[_moving]
+    _starts, _ends = _runs(_moving & (_speed >= SURGE_SPEED_FACTOR * np.median(_moving_speed)))
+    _surge_lengths = (_ends - _starts) * FEATURE_WINDOW
+    _surge_lengths = _surge_lengths[_surge_lengths >= SURGE_MIN_DURATION]
+    features = {name: None for name in FEATURE_NAMES}
+    features.update({
+        'distance': float(_distance[-1] - _distance[0]),
+        'moving_time': _moving_time,
+        'mean_speed': float(_distance[-1] - _distance[0]) / _moving_time,
+        'speed_cv': float(_moving_speed.std() / _moving_speed.mean()),
+        'surge_count': int(len(_surge_lengths)),
+        'surge_fraction': float(_surge_lengths.sum()) / _moving_time,
+    })
+
+    if 'heartrate' in _activity_streams and len(_activity_streams['heartrate']) == len(_time):
+        _heartrate = np.asarray(_activity_streams['heartrate'], dtype=np.float64)
+        _valid = _heartrate > 0
+        if _valid.any():
+            features['hr_mean'] = float(_heartrate[_valid].mean())
+        if _valid.any() and 'hr_zone' in _derived:
+            _zone_times = zoneTimes(np.asarray(_derived['hr_zone']), _time)
+            for zone, fraction in enumerate(_zone_times / max(_zone_times.sum(), 1e-9)):
+                features[f"hr_z{zone + 1}"] = float(fraction)
+    if 'grade' in _derived:
+        features['grade_abs_mean'], features['grade_std'], features['climb_per_km'] = \
+            gradeStats(_distance, np.asarray(_derived['altitude_smooth'], dtype=np.float64),
+                       np.asarray(_derived['grade'], dtype=np.float64))
+        # The flat speed that would have taken the same effort, over the time spent moving
+        features['gap_speed'] = float(np.average(np.asarray(_derived['gap_speed'], dtype=np.float64)[_is_moving],
+                                                 weights=_weights))
+    return features
+
+
+_stores = {}
+
+
+def _extractBatch(_root, _athlete_id, _id_list, _resolution):
+    # Runs in the worker processes, which each open the store once. The streams are memory-mapped, so only the worker
+    # that needs them reads them.
+    if _root not in _stores:
+        _stores[_root] = ActivityStore(_root)
+    _store = _stores[_root]
+    return [workoutFeatures(_store.loadStreams(_athlete_id, x, FEATURE_STREAM_TYPES, _resolution)) for x in _id_list]
+
+
+def classifyWorkouts(_feature_df) -> pd.Series:
+    # One of WORKOUT_CLASSES for every activity (None if it has no features), by rules on the stored features:
+    # - intervals: several surges, and a pace that varies a lot
+    # - long: a lot further than usual
+    # - tempo: a steady pace, mostly in zones 3-4 (or without heartrate, quicker than usual)
+    # - easy: everything else
+    # "Usual" is the median over the CLASSIFY_WINDOW before the activity, or over all of them if there's nothing before.
+    _df = _feature_df.sort_values('start_date')
+    _indexed = _df.set_index('start_date')
+    _trailing = _indexed[['distance', 'mean_speed']].rolling(CLASSIFY_WINDOW, closed='left').median()
+    _usual_distance = _trailing['distance'].fillna(_df['distance'].median()).to_numpy()
+    _usual_speed = _trailing['mean_speed'].fillna(_df['mean_speed'].median()).to_numpy()
+
+    _speed_cv = _df['speed_cv'].to_numpy(dtype=np.float64)
+    _zone_fraction = (_df['hr_z3'] + _df['hr_z4']).to_numpy(dtype=np.float64)
+    _intervals = (_df['surge_count'].to_numpy(dtype=np.float64) >= INTERVAL_MIN_SURGES) & \
+                 (_speed_cv >= INTERVAL_MIN_SPEED_CV)
+    _long = _df['distance'].to_numpy(dtype=np.float64) >= np.maximum(LONG_DISTANCE_FACTOR * _usual_distance,
+                                                                      LONG_MIN_DISTANCE)
+    _tempo = (_speed_cv < INTERVAL_MIN_SPEED_CV) & np.where(
+        np.isnan(_zone_fraction),
+        _df['mean_speed'].to_numpy(dtype=np.float64) >= TEMPO_SPEED_FACTOR * _usual_speed,
+        _zone_fraction >= TEMPO_ZONE_FRACTION)
+    _classes = np.select([_intervals, _long, _tempo], ['intervals', 'long', 'tempo'], 'easy').astype(object)
+    _classes[_df['distance'].isna().to_numpy()] = None
+    return pd.Series(_classes, index=_df.index).reindex(_feature_df.index)
+
+
+class FeatureEngine:
+    def __init__(self, store, max_workers=FEATURE_WORKERS, batch_size=FEATURE_BATCH_SIZE):
+        self.store = store
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+
+    def update(self, athlete_id, id_list, resolution=ANALYTICS_STREAM_RESOLUTION) -> int:
+        # Works out the features of the activities that don't have them (for this FEATURE_VERSION) yet. Activities
+        # without streams at this resolution are left for later; ones whose streams are no use (manual entries, no
+        # movement) get an empty row, so they aren't looked at again.
+        missing_id_list = self.store.missingFeatures(athlete_id, id_list, FEATURE_VERSION)
+        no_streams = set(self.store.missingStreams(athlete_id, missing_id_list, ['distance', 'time'], resolution))
+        todo_id_list = [x for x in missing_id_list if x not in no_streams]
+        batches = [todo_id_list[i:i + self.batch_size] for i in range(0, len(todo_id_list), self.batch_size)]
+        if len(batches) == 0:
+            return 0
+
+        args = (repeat(self.store.root), repeat(athlete_id), batches, repeat(resolution))
+        if len(batches) == 1 or self.max_workers <= 1:
+            # Not worth starting processes for
+            self._saveBatches(athlete_id, batches, map(_extractBatch, *args))
+        else:
+            # Spawned rather than forked: this runs in a job thread of the (threaded) web server, and forking a
+            # process with other threads running can leave the workers stuck on a lock one of those held
+            with ProcessPoolExecutor(max_workers=self.max_workers,
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                self._saveBatches(athlete_id, batches, executor.map(_extractBatch, *args))
+        return len(todo_id_list)
+
+    def _saveBatches(self, athlete_id, batches, results) -> None:
+        for id_list, features in zip(batches, results):
+            self.store.saveFeatures(athlete_id, FEATURE_VERSION, list(zip(id_list, features)))
+
+    def frame(self, athlete_id, activity_type) -> pd.DataFrame:
+        # The stored features of every activity of this type, oldest first, a float column per feature
+        feature_df = self.store.featuresFrame(athlete_id, activity_type, FEATURE_VERSION)
+        feature_df = feature_df.reindex(columns=['activity_id', 'start_date'] + FEATURE_NAMES)
+        feature_df[FEATURE_NAMES] = feature_df[FEATURE_NAMES].astype(np.float64)
+        return feature_df
+
+    def classify(self, athlete_id, activity_type) -> pd.DataFrame:
+        # The stored features of every activity of this type, oldest first, with its workout class
+        feature_df = self.frame(athlete_id, activity_type)
+        feature_df['workout_class'] = classifyWorkouts(feature_df) if len(feature_df) > 0 else None
+        return feature_df
@@ -0,0 +1,193 @@
+import datetime as dt
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stravalib.exc import AccessUnauthorized, ObjectNotFound
+
+from parameters import *
+import functions as fun
+from metrics import metrics
+
+
+# Strava counts requests in two windows: one that resets every quarter hour (on the clock, UTC) and one that resets
+# at midnight UTC. The limits and the current usage come back with every response as "short,long" header pairs.
+# Read-only calls (which is all we do) have their own, lower, read limits on newer API versions.
+def parseRateHeader(_headers, _name):
+    for prefix in ('X-ReadRateLimit-', 'X-RateLimit-'):
+        value = _headers.get(prefix + _name)
+        if value:
+            short_value, long_value = value.split(',')[:2]
+            return int(short_value), int(long_value)
+    return None
+
+
+def secondsUntilNextQuarter(_now: dt.datetime) -> float:
+    quarter_start = _now.replace(minute=(_now.minute // 15) * 15, second=0, microsecond=0)
+    return (quarter_start + dt.timedelta(minutes=15) - _now).total_seconds()
+
+
+def secondsUntilNextDay(_now: dt.datetime) -> float:
+    day_start = _now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (day_start + dt.timedelta(days=1) - _now).total_seconds()
+
+
+class RateLimitBudget:
+    # Keeps track of how much of the 15-minute and daily quota is left, and hands out request slots.
+    # An instance can be installed as the rate limiter of a stravalib Client, in which case it gets called with the
+    # headers of every response and keeps its counters in sync with what Strava reports.
+    def __init__(self, short_limit=RATE_LIMIT_SHORT, long_limit=RATE_LIMIT_LONG, reserve=RATE_LIMIT_RESERVE,
+                 _clock=None, _sleep=time.sleep):
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.reserve = reserve
+        self.short_usage = 0
+        self.long_usage = 0
+
+        self._clock = _clock or (lambda: dt.datetime.now(dt.timezone.utc))
+        self._sleep = _sleep
+        self._lock = threading.Lock()
+        self._short_window, self._long_window = self._windows(self._clock())
+        self._blocked_until = None
+        self._last_request = None
+
+    @staticmethod
+    def _windows(_now):
+        return (_now.date(), _now.hour, _now.minute // 15), _now.date()
+
+    def _rollWindows(self, _now):
+        short_window, long_window = self._windows(_now)
+        if short_window != self._short_window:
+            self._short_window = short_window
+            self.short_usage = 0
+        if long_window != self._long_window:
+            self._long_window = long_window
+            self.long_usage = 0
+
+    def __call__(self, headers, method=None):
+        limits = parseRateHeader(headers, 'Limit')
+        usage = parseRateHeader(headers, 'Usage')
+        with self._lock:
+            self._rollWindows(self._clock())
+            if limits is not None:
+                self.short_limit, self.long_limit = limits
+            if usage is not None:
+                # Other requests may still be in flight, so never count lower than what we've handed out ourselves.
+                self.short_usage = max(self.short_usage, usage[0])
+                self.long_usage = max(self.long_usage, usage[1])
+            quota = (self.short_limit, self.short_usage, self.long_limit, self.long_usage)
+        metrics.quota(*quota)
+
+    def _waitTime(self, _now) -> float:
+        if self._blocked_until is not None and _now < self._blocked_until:
+            return (self._blocked_until - _now).total_seconds()
+        if self.long_usage >= self.long_limit - self.reserve:
+            return secondsUntilNextDay(_now)
+        if self.short_usage >= self.short_limit - self.reserve:
+            return secondsUntilNextQuarter(_now)
+
+        # Past half of the short window, spread the remaining requests out over what's left of the quarter hour
+        # instead of burning through them and then stalling for up to 15 minutes.
+        remaining = self.short_limit - self.reserve - self.short_usage
+        if self._last_request is not None and self.short_usage * 2 >= self.short_limit:
+            spacing = secondsUntilNextQuarter(_now) / remaining
+            elapsed = (_now - self._last_request).total_seconds()
+            if elapsed < spacing:
+                return spacing - elapsed
+        return 0
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._rollWindows(now)
+                wait = self._waitTime(now)
+                if wait <= 0:
+                    self.short_usage += 1
+                    self.long_usage += 1
+                    self._last_request = now
+                    return
+            self._sleep(min(wait, RATE_LIMIT_MAX_SLEEP))
+
+    def backOff(self, attempt, error=None) -> None:
+        # If Strava told us how long to wait (rate limit exceeded), hold back every request until then. Any other
+        # failure only delays the request that failed, with exponential backoff and jitter.
+        timeout = getattr(error, 'timeout', None)
+        if timeout:
+            with self._lock:
+                blocked_until = self._clock() + dt.timedelta(seconds=timeout)
+                if self._blocked_until is None or blocked_until > self._blocked_until:
+                    self._blocked_until = blocked_until
+        else:
+            self._sleep(RETRY_BASE_DELAY * (2 ** attempt) * (1 + random.random()))
+
+    def remaining(self) -> tuple:
+        with self._lock:
+            self._rollWindows(self._clock())
+            return self.short_limit - self.short_usage, self.long_limit - self.long_usage
+
+
+class StreamFetcher:
+    # Fetches activity streams on a small thread pool, with every request going through a shared RateLimitBudget.
+    # Results always come back in the same order as the requested id list; failed fetches show up as None.
+    def __init__(self, client, budget=None, max_workers=FETCH_WORKERS, max_retries=FETCH_RETRIES):
+        self.client = client
+        self.budget = budget or RateLimitBudget()
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+
+        # Let the client report the rate limit headers of every response straight to the budget.
+        self.client.protocol.rate_limiter = self.budget
+
+    def _withRetries(self, function, description):
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire()
+            try:
+                return function()
+            except (ObjectNotFound, AccessUnauthorized) as error:
+                # Retrying won't help with these.
+                print(f"Could not fetch {description}: {error}")
+                return None
+            except Exception as error:
+                if attempt == self.max_retries:
+                    print(f"Giving up on {description} after {attempt + 1} attempts: {error}")
+                    return None
+                self.budget.backOff(attempt, error)
+        return None
+
+    def fetchOne(self, activity_id, fetch_data_types, resolution='medium'):
+        def getStream():
+            with metrics.stage('get_stream', activity_id=activity_id, resolution=resolution):
+                return fun.getStream(_client=self.client, _fetch_data_types=fetch_data_types,
+                                     _activity_id=activity_id, _resolution=resolution)
+        return self._withRetries(getStream, f"the stream for activity {activity_id}")
+
+    def fetchGear(self, gear_id_list) -> list:
+        # Gear details, on the same pool and budget as the streams. Same order as gear_id_list, None where it failed.
+        gear_id_list = list(gear_id_list)
+        if len(gear_id_list) == 0:
+            return []
+
+        def getGear(gear_id):
+            with metrics.stage('get_gear', gear_id=gear_id):
+                return self.client.get_gear(gear_id=gear_id)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(gear_id_list))) as executor:
+            return list(executor.map(lambda x: self._withRetries(lambda: getGear(x), f"gear {x}"), gear_id_list))
+
+    def iterStreams(self, id_list, fetch_data_types, resolution='medium', progress=None):
+        # Yields the streams in the order of id_list, each one as soon as it (and the ones before it) came in, so they
+        # can be stored while the rest are still on their way. progress, if given, gets called as progress(done, total).
+        id_list = list(id_list)
+        if len(id_list) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(id_list))) as executor:
+            done = 0
+            for activity_stream in executor.map(lambda x: self.fetchOne(x, fetch_data_types, resolution), id_list):
+                done += 1
+                if progress is not None:
+                    progress(done, len(id_list))
+                yield activity_stream
+
+    def fetchStreams(self, id_list, fetch_data_types, resolution='medium', progress=None) -> list:
+        return list(self.iterStreams(id_list, fetch_data_types, resolution, progress))
@@ -0,0 +1,130 @@
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from parameters import *
+
+
+# Training load, fitness and fatigue, and race predictions.
+# Every activity gets a training load (TRIMP) from its moving time and average heart rate. Fitness and fatigue are
+# exponentially weighted averages of the daily load, over FITNESS_DAYS and FATIGUE_DAYS; form is the difference.
+# The state at the end of every day is stored, so an update only has to replay the days from the earliest one whose
+# load changed (a new or edited activity, or one that just got its heart rate from the features), starting from the
+# stored state of the day before.
+def trimp(_minutes, _hr_mean, _hr_rest=HR_REST, _hr_max=HR_MAX) -> np.ndarray:
+    # Banister's TRIMP: minutes times the heart rate reserve, weighted exponentially so hard efforts count for more
+    _hrr = np.clip((np.asarray(_hr_mean, dtype=np.float64) - _hr_rest) / (_hr_max - _hr_rest), 0, 1)
+    _hrr = np.where(np.isnan(_hrr), TRIMP_DEFAULT_HRR, _hrr)
+    return np.asarray(_minutes, dtype=np.float64) * _hrr * 0.64 * np.exp(1.92 * _hrr)
+
+
+def replayFitness(_daily_load, _fitness=0.0, _fatigue=0.0, _fitness_days=FITNESS_DAYS, _fatigue_days=FATIGUE_DAYS):
+    # Fitness and fatigue at the end of every day, starting from the state at the end of the day before
+    _fitness_decay = 1 - np.exp(-1 / _fitness_days)
+    _fatigue_decay = 1 - np.exp(-1 / _fatigue_days)
+    fitness = np.empty(len(_daily_load))
+    fatigue = np.empty(len(_daily_load))
+    for i, load in enumerate(_daily_load):
+        _fitness += (load - _fitness) * _fitness_decay
+        _fatigue += (load - _fatigue) * _fatigue_decay
+        fitness[i] = _fitness
+        fatigue[i] = _fatigue
+    return fitness, fatigue
+
+
+def riegelFit(_distances, _times):
+    # (coefficient, exponent) of time = coefficient * distance ^ exponent, by least squares in log-log space
+    _log_distances = np.log(np.asarray(_distances, dtype=np.float64))
+    _log_times = np.log(np.asarray(_times, dtype=np.float64))
+    exponent = RIEGEL_EXPONENT
+    if len(np.unique(_log_distances)) >= 2:
+        exponent = float(np.clip(np.polyfit(_log_distances, _log_times, 1)[0], *RIEGEL_EXPONENT_BOUNDS))
+    return float(np.exp(np.mean(_log_times - exponent * _log_distances))), exponent
+
+
+def criticalSpeedFit(_distances, _times):
+    # (critical speed, D') of distance = critical speed * time + D', or None if there aren't efforts of at least two
+    # durations within CRITICAL_SPEED_DURATIONS, or they don't give a sensible fit
+    _distances = np.asarray(_distances, dtype=np.float64)
+    _times = np.asarray(_times, dtype=np.float64)
+    _valid = (_times >= CRITICAL_SPEED_DURATIONS[0]) & (_times <= CRITICAL_SPEED_DURATIONS[1])
+    if len(np.unique(_times[_valid])) < 2:
+        return None
+    critical_speed, d_prime = np.polyfit(_times[_valid], _distances[_valid], 1)
+    if critical_speed <= 0 or d_prime < 0:
+        return None
+    return float(critical_speed), float(d_prime)
+
+
+def racePredictions(_best_effort_df, _today=None, _targets=RACE_DISTANCES) -> pd.DataFrame:
+    # Predicted time (seconds) for every target distance, from the fastest effort over each distance in the last
+    # PREDICTION_WINDOW days. Empty if there are no recent efforts.
+    _today = pd.Timestamp(_today or dt.datetime.now(dt.timezone.utc))
+    _today = _today.tz_localize('UTC') if _today.tzinfo is None else _today
+    _start_dates = pd.to_datetime(_best_effort_df['start_date'], utc=True)
+    _recent = _best_effort_df[_start_dates >= _today - pd.Timedelta(days=PREDICTION_WINDOW)]
+    _best = _recent.groupby('distance')['elapsed_time'].min()
+    if len(_best) == 0:
+        return pd.DataFrame(columns=['name', 'distance', 'riegel', 'critical_speed'])
+
+    coefficient, exponent = riegelFit(_best.index, _best.values)
+    critical_speed = criticalSpeedFit(_best.index, _best.values)
+    rows = []
+    for name, distance in _targets.items():
+        rows.append({'name': name, 'distance': distance,
+                     'riegel': coefficient * distance ** exponent,
+                     'critical_speed': None if critical_speed is None or distance <= critical_speed[1]
+                     else (distance - critical_speed[1]) / critical_speed[0]})
+    return pd.DataFrame(rows)
+
+
+class FitnessEngine:
+    def __init__(self, store):
+        self.store = store
+
+    def activityLoads(self, athlete_id) -> pd.DataFrame:
+        # Training load and (UTC) day of every activity. The average heart rate comes from the workout features, for
+        # the activities that have them.
+        activity_df = self.store.activityFrame(athlete_id, columns=['id', 'start_date', 'moving_time'])
+        if len(activity_df) == 0:
+            return pd.DataFrame({'activity_id': pd.Series(dtype=np.int64), 'day': pd.Series(dtype=object),
+                                 'load': pd.Series(dtype=np.float64)})
+        feature_df = self.store.featuresFrame(athlete_id, None, FEATURE_VERSION)
+        hr_mean = np.nan
+        if 'hr_mean' in feature_df:
+            hr_mean = activity_df['id'].map(pd.Series(feature_df['hr_mean'].to_numpy(dtype=np.float64),
+                                                      index=feature_df['activity_id']))
+        return pd.DataFrame({'activity_id': activity_df['id'].astype(np.int64),
+                             'day': activity_df['start_date'].dt.strftime('%Y-%m-%d'),
+                             'load': trimp(activity_df['moving_time'].fillna(0) / 60, hr_mean)})
+
+    def update(self, athlete_id, today=None):
+        # Brings the daily state up to today. Returns the first day that was replayed, or None if nothing changed.
+        today = (today or dt.datetime.now(dt.timezone.utc).date()).isoformat()
+        load_df = self.activityLoads(athlete_id)
+        merged = load_df.merge(self.store.trainingLoads(athlete_id), on='activity_id', how='outer',
+                               suffixes=('', '_stored'))
+        changed = (merged['day'] != merged['day_stored']) | ~np.isclose(
+            merged['load'].to_numpy(dtype=np.float64), merged['load_stored'].to_numpy(dtype=np.float64))
+        changed_days = list(merged.loc[changed, 'day'].dropna()) + list(merged.loc[changed, 'day_stored'].dropna())
+
+        last_day = self.store.lastFitnessDay(athlete_id)
+        if last_day is not None:
+            changed_days.append((dt.date.fromisoformat(last_day) + dt.timedelta(days=1)).isoformat())
+        if len(changed_days) == 0 or min(changed_days) > today:
+            return None
+        start_day = min(changed_days)
+
+        changed_id_list = merged.loc[changed, 'activity_id']
+        self.store.saveTrainingLoads(athlete_id, load_df[load_df['activity_id'].isin(changed_id_list)],
+                                     merged.loc[changed & merged['day'].isna(), 'activity_id'].tolist())
+        fitness, fatigue = self.store.fitnessState(athlete_id, start_day)
+        days = pd.date_range(start_day, today, freq='D').strftime('%Y-%m-%d')
+        daily_load = load_df[load_df['day'] >= start_day].groupby('day')['load'].sum().reindex(days, fill_value=0)
+        fitness, fatigue = replayFitness(daily_load.to_numpy(), fitness, fatigue)
+        self.store.saveFitnessDays(athlete_id, start_day, zip(days, daily_load.to_numpy(), fitness, fatigue))
+        return start_day
+
+    def predictions(self, athlete_id, today=None) -> pd.DataFrame:
+        return racePredictions(self.store.bestEffortsFrame(athlete_id, 'Run'), today)
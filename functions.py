@@ -1,43 +1,42 @@
-import pandas as pd
+import numpy as np
 import folium
+import plotly.graph_objects as go
 import random
 import math
 
 import constants as const
+from parameters import *
+from streams import ActivityStreams
 
 
-def getStream(_client, _fetch_data_types, _activity_id, _activity_type='Run'):
+def getStream(_client, _fetch_data_types, _activity_id, _activity_type='Run', _resolution='medium'):
     _activity_stream = _client.get_activity_streams(_activity_id,
                                                     types=_fetch_data_types,
-                                                    resolution='medium',
+                                                    resolution=_resolution,
                                                     series_type='distance')
     return _activity_stream
 
 
-def storeStream(_type_list, _activity_stream) -> pd.DataFrame:
-    df = pd.DataFrame()
-    if _activity_stream is not None:
-        for item in _type_list:
-            if item in _activity_stream.keys():
-                df[item] = pd.Series(_activity_stream[item].data, index=None)
-    return df
+def storeStream(_type_list, _activity_stream) -> ActivityStreams:
+    # Accepts both the stravalib stream dict and an ActivityStreams coming out of the local store
+    if isinstance(_activity_stream, ActivityStreams):
+        return _activity_stream
+    return ActivityStreams.fromStrava(_type_list, _activity_stream)
 
 
-def makePolyLine(df) -> list:
-    lat_long_list = []
-    for x in df['latlng']:
-        lat_long_list.append(tuple(x))
-    return lat_long_list
+def makePolyLine(_streams) -> np.ndarray:
+    # (N, 2) array of (latitude, longitude) pairs. This is a view on the stream, not a copy.
+    return _streams['latlng']
 
 
-def plotMap(_activity_polyline):
-    if _activity_polyline is None:
-        print("Received None argument. Terminating function.")
+def plotMap(_activity_polyline, _options=MAP_OPTIONS):
+    if _activity_polyline is None or len(_activity_polyline) == 0:
+        print("Received no polylines. Terminating function.")
         return None
-    activityMap = folium.Map(location=[_activity_polyline[0][0][0], _activity_polyline[0][0][1]], zoom_start=14,
-                             width='100%')
-    folium.TileLayer('cartodbpositron').add_to(activityMap)
-    folium.TileLayer('cartodbdark_matter').add_to(activityMap)
+    activityMap = folium.Map(location=[_activity_polyline[0][0][0], _activity_polyline[0][0][1]],
+                             zoom_start=_options['zoom_start'], width='100%')
+    for tiles in _options['tiles']:
+        folium.TileLayer(tiles).add_to(activityMap)
 
     if len(_activity_polyline) == 1:
         folium.PolyLine(_activity_polyline).add_to(activityMap)
@@ -53,6 +52,89 @@ def plotMap(_activity_polyline):
     return activityMap
 
 
+def plotHeatmap(_tile_url, _center=None, _max_native_zoom=14):
+    # Small, fixed-size map document: all the activity data is in the tiles behind _tile_url
+    if _center is None:
+        heatMap = folium.Map(location=[0, 0], zoom_start=2, width='100%')
+    else:
+        heatMap = folium.Map(location=[_center[0], _center[1]], zoom_start=12, width='100%')
+    folium.TileLayer('cartodbdark_matter').add_to(heatMap)
+    folium.TileLayer(tiles=_tile_url, attr='Strava activities', name='Heatmap', overlay=True,
+                     max_native_zoom=_max_native_zoom).add_to(heatMap)
+    folium.LayerControl(collapsed=False).add_to(heatMap)
+    return heatMap
+
+
+def plotBestEfforts(_best_effort_df):
+    # One line per distance with the time of every effort, plus a step line with the best time so far
+    figure = go.Figure()
+    for name, effort_df in _best_effort_df.groupby('name', sort=False):
+        minutes = effort_df['elapsed_time'] / 60
+        figure.add_trace(go.Scatter(x=effort_df['start_date'], y=minutes, mode='markers', name=name,
+                                    legendgroup=name))
+        figure.add_trace(go.Scatter(x=effort_df['start_date'], y=minutes.cummin(), mode='lines', line_shape='hv',
+                                    name=f"{name} (best so far)", legendgroup=name))
+    figure.update_layout(yaxis_title="Time (minutes)", yaxis_type='log', height=800)
+    return figure
+
+
+def plotWorkoutClasses(_feature_df):
+    # Distance of every activity over time, coloured by its workout class
+    figure = go.Figure()
+    for workout_class in WORKOUT_CLASSES:
+        class_df = _feature_df[_feature_df['workout_class'] == workout_class]
+        figure.add_trace(go.Scatter(x=class_df['start_date'], y=class_df['distance'] / 1000, mode='markers',
+                                    name=workout_class.capitalize(),
+                                    customdata=np.stack([class_df['speed_cv'], class_df['surge_count']], axis=-1),
+                                    hovertemplate="%{y:.1f} km<br>Pace variation %{customdata[0]:.2f}<br>"
+                                                  "%{customdata[1]} surges"))
+    figure.update_layout(yaxis_title="Distance (km)", height=800)
+    return figure
+
+
+def plotGradeAdjusted(_feature_df):
+    # Pace of every activity next to its grade-adjusted pace (the pace on the flat for the same effort), over time.
+    # The further apart the two, the hillier the activity.
+    _feature_df = _feature_df[_feature_df['gap_speed'].notna()]
+    figure = go.Figure()
+    for name, col in (("Pace", 'mean_speed'), ("Grade adjusted pace", 'gap_speed')):
+        figure.add_trace(go.Scatter(x=_feature_df['start_date'], y=1000 / 60 / _feature_df[col], mode='markers',
+                                    name=name, customdata=_feature_df['climb_per_km'],
+                                    hovertemplate="%{y:.2f} min/km<br>%{customdata:.0f} m climbed per km"))
+    figure.update_layout(yaxis_title="Pace (min/km)", yaxis_autorange='reversed', height=800)
+    return figure
+
+
+def plotFitness(_fitness_df):
+    # Daily load as bars, with fitness, fatigue and form (fitness - fatigue) as lines
+    figure = go.Figure()
+    figure.add_trace(go.Bar(x=_fitness_df['day'], y=_fitness_df['load'], name="Load", marker_color='lightgray'))
+    figure.add_trace(go.Scatter(x=_fitness_df['day'], y=_fitness_df['fitness'], mode='lines', name="Fitness"))
+    figure.add_trace(go.Scatter(x=_fitness_df['day'], y=_fitness_df['fatigue'], mode='lines', name="Fatigue"))
+    figure.add_trace(go.Scatter(x=_fitness_df['day'], y=_fitness_df['fitness'] - _fitness_df['fatigue'], mode='lines',
+                                name="Form"))
+    figure.update_layout(yaxis_title="Training load (TRIMP)", height=600)
+    return figure
+
+
+def plotGearUsage(_usage_df, _title):
+    # Cumulative distance of every piece of gear, as a step line (it only changes on days it was used)
+    figure = go.Figure()
+    for name, gear_df in _usage_df.groupby('name'):
+        figure.add_trace(go.Scatter(x=gear_df['day'], y=gear_df['total_km'], mode='lines', line_shape='hv',
+                                    name=name))
+    figure.update_layout(title=_title, yaxis_title="Distance (km)", height=500)
+    return figure
+
+
+def formatDuration(_seconds) -> str:
+    if _seconds is None or np.isnan(_seconds):
+        return "-"
+    _minutes, _seconds = divmod(int(round(_seconds)), 60)
+    _hours, _minutes = divmod(_minutes, 60)
+    return f"{_hours}:{_minutes:02d}:{_seconds:02d}"
+
+
 def latlngDistance(_latlng_origin: tuple, _latlng_destination: tuple) -> float:
     # Tuple format should be (latitude, longitude)
     _lat1 = math.radians(_latlng_origin[0])
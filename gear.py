@@ -0,0 +1,83 @@
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from parameters import *
+
+
+# Gear details and usage.
+# Details (name, brand, the total distance Strava keeps) are cached in the store and only fetched again once they're
+# older than GEAR_TTL, all at once on the stream fetcher's pool.
+# Usage is a daily rollup of distance and moving time per gear_id, made from the activity table. The activities that
+# went into it are kept alongside, so an update only recomputes the (gear, day) pairs whose activities changed, and
+# the gear page never has to go through the raw activities.
+class GearTracker:
+    def __init__(self, store, ttl=GEAR_TTL, journal=None):
+        self.store = store
+        self.ttl = ttl
+        self.journal = journal
+
+    def staleGearIds(self, athlete_id, gear_id_list) -> list:
+        # The gear we have no details for, or only ones older than the TTL
+        fetched_at = self.store.gearFetchedAt(athlete_id)
+        cutoff = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=self.ttl)).isoformat()
+        return [x for x in dict.fromkeys(gear_id_list) if x is not None and (fetched_at.get(x) or '') < cutoff]
+
+    def refresh(self, user, gear_id_list) -> int:
+        stale_id_list = self.staleGearIds(user.athlete.id, gear_id_list)
+        gear_count = 0
+        for gear in user.stream_fetcher.fetchGear(stale_id_list):
+            if gear is not None:
+                gear_dict = gear.to_dict()
+                if self.journal is not None:
+                    self.journal.record('gear', user.athlete.id, gear_dict['id'], gear_dict)
+                self.store.saveGear(user.athlete.id, gear_dict)
+                gear_count += 1
+        return gear_count
+
+    def updateRollups(self, athlete_id) -> int:
+        # Returns the number of (gear, day) pairs that had to be recomputed
+        activity_df = self.store.activityFrame(athlete_id, columns=['id', 'gear_id', 'start_date', 'distance',
+                                                                    'moving_time'])
+        activity_df = activity_df[activity_df['gear_id'].notna()]
+        current_df = pd.DataFrame({'activity_id': activity_df['id'].astype(np.int64),
+                                   'gear_id': activity_df['gear_id'],
+                                   'day': activity_df['start_date'].dt.strftime('%Y-%m-%d'),
+                                   'distance': activity_df['distance'].fillna(0).astype(np.float64),
+                                   'moving_time': activity_df['moving_time'].fillna(0).astype(np.float64)})
+
+        merged = current_df.merge(self.store.activityGear(athlete_id), on='activity_id', how='outer',
+                                  suffixes=('', '_stored'))
+        changed = (merged['gear_id'] != merged['gear_id_stored']) | (merged['day'] != merged['day_stored'])
+        for col in ('distance', 'moving_time'):
+            changed |= ~np.isclose(merged[col].to_numpy(dtype=np.float64),
+                                   merged[f"{col}_stored"].to_numpy(dtype=np.float64))
+        if not changed.any():
+            return 0
+
+        # Every (gear, day) that gained or lost an activity, or where one of them changed, gets summed up again
+        merged = merged[changed]
+        affected = set(zip(merged['gear_id'], merged['day'])) | set(zip(merged['gear_id_stored'], merged['day_stored']))
+        affected = {x for x in affected if isinstance(x[0], str)}
+        in_affected = pd.Series([x in affected for x in zip(current_df['gear_id'], current_df['day'])],
+                                index=current_df.index, dtype=bool)
+        gear_day_df = current_df[in_affected].groupby(['gear_id', 'day'], as_index=False).agg(
+            distance=('distance', 'sum'), moving_time=('moving_time', 'sum'), activity_count=('activity_id', 'size'))
+        emptied_days = affected - set(zip(gear_day_df['gear_id'], gear_day_df['day']))
+
+        self.store.saveGearRollups(athlete_id, current_df[current_df['activity_id'].isin(merged['activity_id'])],
+                                   merged.loc[merged['gear_id'].isna(), 'activity_id'].tolist(), gear_day_df,
+                                   emptied_days)
+        return len(affected)
+
+    def usageFrame(self, athlete_id) -> pd.DataFrame:
+        # Cumulative distance (km) and moving time (h) per gear over time, from the daily rollups, with the gear's name
+        gear_day_df = self.store.gearDaysFrame(athlete_id)
+        gear_day_df[['distance', 'moving_time']] = gear_day_df[['distance', 'moving_time']].astype(np.float64)
+        grouped = gear_day_df.groupby('gear_id')
+        gear_day_df['total_km'] = grouped['distance'].cumsum() / 1000
+        gear_day_df['total_hours'] = grouped['moving_time'].cumsum() / 3600
+        names = {x['id']: x.get('name') or x['id'] for x in self.store.loadGear(athlete_id)}
+        gear_day_df['name'] = gear_day_df['gear_id'].map(lambda x: names.get(x, x))
+        return gear_day_df
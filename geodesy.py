@@ -0,0 +1,68 @@
+import numpy as np
+
+import constants as const
+
+
+# Vectorised versions of functions.latlngDistance and friends. They all take latlng as an (N, 2) array of
+# (latitude, longitude) pairs in degrees, like the latlng column of an ActivityStreams, and return distances in metres.
+def _haversine(_lat1, _lng1, _lat2, _lng2) -> np.ndarray:
+    # All angles in radians
+    _A = (np.sin((_lat2 - _lat1) / 2) ** 2 +
+          np.sin((_lng2 - _lng1) / 2) ** 2 * np.cos(_lat1) * np.cos(_lat2))
+    return 2 * const.EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(_A, 0, 1)))
+
+
+def segmentDistances(_latlng) -> np.ndarray:
+    # Distance between consecutive points: N points give N - 1 distances
+    _rad = np.asarray(_latlng, dtype=np.float64) * const.RADIAN
+    return _haversine(_rad[:-1, 0], _rad[:-1, 1], _rad[1:, 0], _rad[1:, 1])
+
+
+def alongTrackDistance(_latlng) -> np.ndarray:
+    # Cumulative distance from the first point, so the same length as _latlng and starting at 0
+    _distance = np.zeros(len(_latlng), dtype=np.float64)
+    if len(_latlng) > 1:
+        np.cumsum(segmentDistances(_latlng), out=_distance[1:])
+    return _distance
+
+
+def distancesTo(_latlng, _point) -> np.ndarray:
+    # Distance from every point in _latlng to a single (latitude, longitude) point
+    _rad = np.asarray(_latlng, dtype=np.float64) * const.RADIAN
+    _lat0 = _point[0] * const.RADIAN
+    _lng0 = _point[1] * const.RADIAN
+    return _haversine(_rad[:, 0], _rad[:, 1], _lat0, _lng0)
+
+
+def bearings(_latlng) -> np.ndarray:
+    # Initial bearing (degrees clockwise from north, 0-360) from every point to the next one. The last point has no
+    # next one, so it keeps the bearing of the segment leading up to it.
+    _rad = np.asarray(_latlng, dtype=np.float64) * const.RADIAN
+    _bearing = np.zeros(len(_rad), dtype=np.float64)
+    if len(_rad) < 2:
+        return _bearing
+    _lat1, _lat2 = _rad[:-1, 0], _rad[1:, 0]
+    _delta_lng = _rad[1:, 1] - _rad[:-1, 1]
+    _y = np.sin(_delta_lng) * np.cos(_lat2)
+    _x = np.cos(_lat1) * np.sin(_lat2) - np.sin(_lat1) * np.cos(_lat2) * np.cos(_delta_lng)
+    _bearing[:-1] = np.degrees(np.arctan2(_y, _x)) % 360
+    _bearing[-1] = _bearing[-2]
+    return _bearing
+
+
+def pairwiseDistances(_latlng_a, _latlng_b) -> np.ndarray:
+    # (len(_latlng_a), len(_latlng_b)) matrix of distances between every point of one track and every point of another.
+    # Also works on stacks of tracks, (K, N, 2) and (K, M, 2), giving K matrices.
+    _rad_a = np.asarray(_latlng_a, dtype=np.float64) * const.RADIAN
+    _rad_b = np.asarray(_latlng_b, dtype=np.float64) * const.RADIAN
+    return _haversine(_rad_a[..., :, None, 0], _rad_a[..., :, None, 1],
+                      _rad_b[..., None, :, 0], _rad_b[..., None, :, 1])
+
+
+def resample(_latlng, _n_points) -> np.ndarray:
+    # _n_points points, evenly spaced along the track
+    _latlng = np.asarray(_latlng, dtype=np.float64)
+    _distance = alongTrackDistance(_latlng)
+    _targets = np.linspace(0, _distance[-1], _n_points)
+    return np.column_stack([np.interp(_targets, _distance, _latlng[:, 0]),
+                            np.interp(_targets, _distance, _latlng[:, 1])])
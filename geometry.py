@@ -0,0 +1,63 @@
+import gzip
+import json
+
+import numpy as np
+
+from parameters import *
+
+
+# Compact ways of shipping activity routes to the browser, as an alternative to a full Folium document: Google's
+# encoded polyline format, or GeoJSON with the coordinates rounded to the same precision. Either one gets gzipped on
+# the way out. assets/geometry.js decodes them and draws them in a dcc.Graph.
+def encodePolyline(_latlng, _precision=POLYLINE_PRECISION) -> str:
+    # Same output as the usual per-point implementations, but done for all coordinates at once: round, take the
+    # differences between consecutive points, zigzag the signs away, then split every value into 5-bit chunks (lowest
+    # first). Every chunk except the last of its value gets the continuation bit, and everything is offset by 63.
+    _ints = np.round(np.asarray(_latlng, dtype=np.float64) * 10 ** _precision).astype(np.int64)
+    if len(_ints) == 0:
+        return ''
+    _deltas = np.diff(_ints, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    _values = np.where(_deltas < 0, ~(_deltas << 1), _deltas << 1)
+
+    _shifts = 5 * np.arange(7, dtype=np.int64)
+    _chunks = (_values[:, None] >> _shifts[None, :]) & 0x1f
+    _n_chunks = 1 + ((_values[:, None] >> _shifts[None, 1:]) > 0).sum(axis=1)
+    _index = np.arange(len(_shifts))[None, :]
+    _chars = _chunks + 63 + 0x20 * (_index < _n_chunks[:, None] - 1)
+    return _chars[_index < _n_chunks[:, None]].astype(np.uint8).tobytes().decode('ascii')
+
+
+def decodePolyline(_encoded, _precision=POLYLINE_PRECISION) -> np.ndarray:
+    # Inverse of encodePolyline, one character at a time. Only used to check the encoder, the browser does the decoding.
+    _values = []
+    _value = 0
+    _shift = 0
+    for _char in _encoded:
+        _chunk = ord(_char) - 63
+        _value |= (_chunk & 0x1f) << _shift
+        _shift += 5
+        if _chunk < 0x20:
+            _values.append(~(_value >> 1) if _value & 1 else _value >> 1)
+            _value = 0
+            _shift = 0
+    return np.cumsum(np.array(_values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** _precision
+
+
+def encodedPayload(_id_list, _polylines, _precision=POLYLINE_PRECISION) -> dict:
+    return {'format': 'polyline', 'precision': _precision,
+            'activities': [{'id': int(x), 'polyline': encodePolyline(y, _precision)}
+                           for x, y in zip(_id_list, _polylines)]}
+
+
+def geoJsonPayload(_id_list, _polylines, _precision=POLYLINE_PRECISION) -> dict:
+    # GeoJSON wants (longitude, latitude)
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'properties': {'id': int(x)},
+                          'geometry': {'type': 'LineString',
+                                       'coordinates': np.round(np.asarray(y)[:, ::-1], _precision).tolist()}}
+                         for x, y in zip(_id_list, _polylines)]}
+
+
+def payloadBytes(_payload, _compress=True) -> bytes:
+    _data = json.dumps(_payload, separators=(',', ':')).encode('utf-8')
+    return gzip.compress(_data, compresslevel=6) if _compress else _data
@@ -0,0 +1,131 @@
+import math
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from parameters import *
+
+
+# Heatmap of all activities as a pyramid of Web Mercator tiles, one set per athlete and activity type.
+# For every zoom level in HEATMAP_ZOOMS, each tile keeps a 256x256 array with the number of activities that pass
+# through each pixel, next to a PNG rendered from it. Adding an activity only touches the tiles it crosses, so the
+# pyramid can be kept up to date after every sync, and serving a tile doesn't depend on the number of activities.
+TILE_SIZE = 256
+
+# Colour ramp for the PNG tiles: (intensity, red, green, blue)
+HEATMAP_COLOURS = np.array([
+    [0.0, 40, 0, 160],
+    [0.4, 220, 20, 60],
+    [0.8, 255, 160, 0],
+    [1.0, 255, 255, 180],
+])
+
+
+def pixelCoords(_latlng, _zoom) -> tuple:
+    # Global Web Mercator pixel coordinates of every point at this zoom level
+    _latlng = np.asarray(_latlng, dtype=np.float64)
+    _scale = TILE_SIZE * 2 ** _zoom
+    _lat = np.clip(_latlng[:, 0], -85.0511, 85.0511) * math.pi / 180
+    _px = (_latlng[:, 1] + 180) / 360 * _scale
+    _py = (1 - np.log(np.tan(_lat) + 1 / np.cos(_lat)) / math.pi) / 2 * _scale
+    return _px, _py
+
+
+def rasterize(_latlng, _zoom) -> tuple:
+    # All pixels the polyline passes through, each one only once. Segments get filled in at (at most) one pixel
+    # steps. Very long segments are jumps in the recording (GPS lost, paused on a train), so those are skipped.
+    _px, _py = pixelCoords(_latlng, _zoom)
+    if len(_px) > 1:
+        _dx = np.diff(_px)
+        _dy = np.diff(_py)
+        _steps = np.ceil(np.maximum(np.abs(_dx), np.abs(_dy))).astype(np.int64)
+        _steps = np.where(_steps > HEATMAP_MAX_GAP, 1, np.maximum(_steps, 1))
+        _segment = np.repeat(np.arange(len(_steps)), _steps)
+        _t = (np.arange(len(_segment)) - np.repeat(np.cumsum(_steps) - _steps, _steps)) / _steps[_segment]
+        _px = np.append(_px[:-1][_segment] + _t * _dx[_segment], _px[-1])
+        _py = np.append(_py[:-1][_segment] + _t * _dy[_segment], _py[-1])
+
+    _size = TILE_SIZE * 2 ** _zoom
+    _ix = np.clip(np.floor(_px).astype(np.int64), 0, _size - 1)
+    _iy = np.clip(np.floor(_py).astype(np.int64), 0, _size - 1)
+    _key = np.unique(_ix * _size + _iy)
+    return _key // _size, _key % _size
+
+
+def encodePng(_rgba) -> bytes:
+    # Minimal PNG writer (8-bit RGBA, no filtering), so we don't need an imaging library just for this
+    _height, _width = _rgba.shape[:2]
+    _raw = np.concatenate([np.zeros((_height, 1), dtype=np.uint8), _rgba.reshape(_height, _width * 4)], axis=1)
+
+    def chunk(_type, _data):
+        return struct.pack('>I', len(_data)) + _type + _data + struct.pack('>I', zlib.crc32(_type + _data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', _width, _height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(_raw.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+
+def renderTile(_counts) -> bytes:
+    # Log scale, saturating at HEATMAP_SATURATION activities, so every tile uses the same scale and doesn't need
+    # re-rendering when another tile changes
+    _intensity = np.clip(np.log1p(_counts) / math.log1p(HEATMAP_SATURATION), 0, 1)
+    _rgba = np.zeros(_counts.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        _rgba[..., channel] = np.interp(_intensity, HEATMAP_COLOURS[:, 0], HEATMAP_COLOURS[:, channel + 1])
+    _rgba[..., 3] = np.where(_counts > 0, 90 + 165 * _intensity, 0)
+    return encodePng(_rgba)
+
+
+class HeatmapTiles:
+    def __init__(self, root=os.path.join(STORE_PATH, 'tiles'), zooms=HEATMAP_ZOOMS):
+        self.root = root
+        self.zooms = list(zooms)
+        self.blank_tile = renderTile(np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint16))
+
+    def tilePath(self, athlete_id, kind, z, x, y, extension='npy') -> str:
+        return os.path.join(self.root, str(athlete_id), kind, str(z), str(x), f"{y}.{extension}")
+
+    def _loadCounts(self, path) -> np.ndarray:
+        if os.path.exists(path):
+            return np.load(path).astype(np.uint32)
+        return np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint32)
+
+    def addActivities(self, athlete_id, kind, polylines) -> int:
+        # Adds a batch of latlng arrays to the pyramid. Every touched tile is read and written once per batch.
+        # Returns the number of tiles written.
+        tiles_written = 0
+        for zoom in self.zooms:
+            touched = {}
+            for latlng in polylines:
+                if len(latlng) == 0:
+                    continue
+                ix, iy = rasterize(latlng, zoom)
+                tile_key = (ix // TILE_SIZE) * (2 ** zoom) + iy // TILE_SIZE
+                order = np.argsort(tile_key, kind='stable')
+                keys, starts = np.unique(tile_key[order], return_index=True)
+                for key, in_tile in zip(keys, np.split(order, starts[1:])):
+                    tx, ty = divmod(int(key), 2 ** zoom)
+                    if (tx, ty) not in touched:
+                        touched[(tx, ty)] = self._loadCounts(self.tilePath(athlete_id, kind, zoom, tx, ty))
+                    # Pixels are unique within an activity, so there are no duplicate indices here
+                    touched[(tx, ty)][iy[in_tile] % TILE_SIZE, ix[in_tile] % TILE_SIZE] += 1
+
+            for (tx, ty), counts in touched.items():
+                counts = np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16)
+                path = self.tilePath(athlete_id, kind, zoom, tx, ty)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                np.save(path, counts)
+                with open(self.tilePath(athlete_id, kind, zoom, tx, ty, 'png'), 'wb') as file:
+                    file.write(renderTile(counts))
+            tiles_written += len(touched)
+        return tiles_written
+
+    def tilePng(self, athlete_id, kind, z, x, y) -> bytes:
+        path = self.tilePath(athlete_id, kind, z, x, y, 'png')
+        if not os.path.exists(path):
+            return self.blank_tile
+        with open(path, 'rb') as file:
+            return file.read()
@@ -0,0 +1,97 @@
+import datetime as dt
+import json
+import os
+import sqlite3
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from parameters import *
+
+
+# Runs long jobs (sync, rendering) on a small worker pool instead of inside a Dash callback, so the page stays
+# responsive. Every job is a row in an SQLite table with its status and progress, which the page polls.
+# Submitting a job with the same key as one that's still queued or running gives back that job instead of starting a
+# second one. Jobs that were still running when the app stopped are marked as interrupted on the next start.
+class JobRunner:
+    def __init__(self, db_path=os.path.join(STORE_PATH, 'jobs.db'), max_workers=JOB_WORKERS):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    key TEXT,
+                    status TEXT,
+                    stage TEXT,
+                    progress REAL,
+                    message TEXT,
+                    result TEXT,
+                    created_at TEXT,
+                    updated_at TEXT
+                )
+            """)
+            conn.execute("UPDATE jobs SET status = 'failed', message = 'Interrupted' "
+                         "WHERE status IN ('queued', 'running')")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _update(self, job_id, **fields) -> None:
+        fields['updated_at'] = dt.datetime.now(dt.timezone.utc).isoformat()
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(x + ' = ?' for x in fields)} WHERE id = ?",
+                         list(fields.values()) + [job_id])
+
+    def submit(self, key, function, *args) -> str:
+        # function gets called as function(*args, progress=...), where progress(stage, fraction) reports how far
+        # along it is. Whatever it returns has to be JSON serialisable.
+        with self._lock:
+            with self._connect() as conn:
+                row = conn.execute("SELECT id FROM jobs WHERE key = ? AND status IN ('queued', 'running')",
+                                   (key,)).fetchone()
+                if row is not None:
+                    print(f"Job {key} is already running")
+                    return row[0]
+                job_id = uuid.uuid4().hex
+                now = dt.datetime.now(dt.timezone.utc).isoformat()
+                conn.execute("INSERT INTO jobs (id, key, status, stage, progress, created_at, updated_at) "
+                             "VALUES (?, ?, 'queued', 'Waiting to start', 0, ?, ?)", (job_id, key, now, now))
+        self._executor.submit(self._run, job_id, function, args)
+        return job_id
+
+    def _run(self, job_id, function, args) -> None:
+        self._update(job_id, status='running')
+
+        def progress(stage, fraction=None):
+            if fraction is None:
+                self._update(job_id, stage=stage)
+            else:
+                self._update(job_id, stage=stage, progress=min(max(fraction, 0), 1))
+
+        try:
+            result = function(*args, progress=progress)
+            self._update(job_id, status='done', stage='Done', progress=1, result=json.dumps(result))
+        except Exception as error:
+            traceback.print_exc()
+            self._update(job_id, status='failed', message=str(error))
+
+    def status(self, job_id) -> dict:
+        with self._connect() as conn:
+            row = conn.execute("SELECT status, stage, progress, message, result FROM jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {'status': row[0], 'stage': row[1], 'progress': row[2], 'message': row[3],
+                'result': None if row[4] is None else json.loads(row[4])}
@@ -0,0 +1,198 @@
+import argparse
+import datetime as dt
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+from parameters import *
+from metrics import metrics
+
+
+# Journal of the raw responses the app gets from Strava: athletes, activity pages, streams and gear, as they came in.
+# Every response is one JSON line, gzip-compressed on its own and appended to the file of the day (so the files are
+# valid .ndjson.gz, and zcat works on them). An SQLite index keeps where every record starts and how long it is, so
+# a single one can be read back without going through the file.
+# Replaying the journal into an empty store rebuilds it without a single API call. Whatever is derived from the
+# store (features, fitness, gear rollups, heatmaps) gets worked out again on the next sync.
+JOURNAL_KINDS = ['athlete', 'activities', 'streams', 'gear']
+
+
+def streamPayload(_activity_stream) -> dict:
+    # {type: list of values} from what get_activity_streams returns (stream objects with .data, or arrays)
+    payload = {}
+    for item, data in (_activity_stream or {}).items():
+        data = data if isinstance(data, np.ndarray) else getattr(data, 'data', data)
+        payload[item] = data.tolist() if isinstance(data, np.ndarray) else list(data)
+    return payload
+
+
+class ResponseJournal:
+    def __init__(self, root=JOURNAL_PATH, compression_level=JOURNAL_COMPRESSION_LEVEL):
+        self.root = root
+        self.compression_level = compression_level
+        self.db_path = os.path.join(root, 'index.db')
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._createTables()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _createTables(self):
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    athlete_id INTEGER,
+                    key TEXT,
+                    file TEXT NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    recorded_at TEXT
+                );
+                CREATE INDEX IF NOT EXISTS entries_key ON entries (kind, athlete_id, key);
+            """)
+
+    def record(self, kind, athlete_id, key, data, params=None) -> None:
+        recorded_at = dt.datetime.now(dt.timezone.utc)
+        line = json.dumps({'kind': kind, 'athlete_id': athlete_id, 'key': key, 'recorded_at': recorded_at.isoformat(),
+                           'params': params or {}, 'data': data}, default=str) + '\n'
+        member = gzip.compress(line.encode('utf-8'), compresslevel=self.compression_level, mtime=0)
+        file_name = f"{recorded_at:%Y-%m-%d}.ndjson.gz"
+        # The index row goes in after the bytes are on disk, so it never points at a record that isn't there
+        with self._lock:
+            with open(os.path.join(self.root, file_name), 'ab') as file:
+                offset = file.seek(0, os.SEEK_END)
+                file.write(member)
+            with self._connect() as conn:
+                conn.execute("INSERT INTO entries (kind, athlete_id, key, file, offset, length, recorded_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", (kind, athlete_id, str(key), file_name, offset,
+                                                              len(member), recorded_at.isoformat()))
+        metrics.count('journal_bytes', len(member))
+
+    def entries(self, athlete_id=None, kinds=None) -> list:
+        # (seq, kind, athlete_id, key, file, offset, length) of the records, oldest first
+        query = "SELECT seq, kind, athlete_id, key, file, offset, length FROM entries WHERE 1 = 1"
+        params = []
+        if athlete_id is not None:
+            query += " AND athlete_id = ?"
+            params.append(athlete_id)
+        if kinds is not None:
+            query += f" AND kind IN ({','.join('?' * len(kinds))})"
+            params.extend(kinds)
+        with self._connect() as conn:
+            return conn.execute(query + " ORDER BY seq", params).fetchall()
+
+    def latest(self, kind, athlete_id, key):
+        # The most recent record of one response (e.g. the streams of one activity), or None
+        with self._connect() as conn:
+            row = conn.execute("SELECT file, offset, length FROM entries WHERE kind = ? AND athlete_id = ? AND key = ? "
+                               "ORDER BY seq DESC LIMIT 1", (kind, athlete_id, str(key))).fetchone()
+        if row is None:
+            return None
+        with open(os.path.join(self.root, row[0]), 'rb') as file:
+            file.seek(row[1])
+            return json.loads(gzip.decompress(file.read(row[2])))
+
+    def records(self, athlete_id=None, kinds=None):
+        # Every record, oldest first. Keeps one file open at a time, since the records of a file come together.
+        file_name, file = None, None
+        try:
+            for _, _, _, _, entry_file, offset, length in self.entries(athlete_id, kinds):
+                if entry_file != file_name:
+                    if file is not None:
+                        file.close()
+                    file_name, file = entry_file, open(os.path.join(self.root, entry_file), 'rb')
+                file.seek(offset)
+                yield json.loads(gzip.decompress(file.read(length)))
+        finally:
+            if file is not None:
+                file.close()
+
+    def rebuildIndex(self) -> int:
+        # Indexes the journal files from scratch, e.g. after losing index.db. Returns the number of records.
+        rows = []
+        for file_name in sorted(x for x in os.listdir(self.root) if x.endswith('.ndjson.gz')):
+            with open(os.path.join(self.root, file_name), 'rb') as file:
+                content = file.read()
+            # Every record is its own gzip member. They get fed to the decompressor a block at a time, so finding the
+            # end of one doesn't copy the rest of the file.
+            content = memoryview(content)
+            offset = 0
+            while offset < len(content):
+                decompressor = zlib.decompressobj(wbits=31)
+                chunks = []
+                end = offset
+                while not decompressor.eof and end < len(content):
+                    chunks.append(decompressor.decompress(content[end:end + JOURNAL_READ_BLOCK]))
+                    end += JOURNAL_READ_BLOCK
+                if not decompressor.eof:
+                    raise ValueError(f"Truncated journal record in {file_name} at offset {offset}")
+                record = json.loads(b''.join(chunks))
+                length = min(end, len(content)) - offset - len(decompressor.unused_data)
+                rows.append((record['kind'], record['athlete_id'], str(record['key']), file_name, offset, length,
+                             record['recorded_at']))
+                offset += length
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries")
+            conn.executemany("INSERT INTO entries (kind, athlete_id, key, file, offset, length, recorded_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+
+def replayJournal(_journal, _store, _athlete_id=None, _kinds=None) -> dict:
+    # Feeds the recorded responses to the store, in the order they came in, like a sync would have. Returns how many
+    # records of each kind were replayed.
+    counts = dict.fromkeys(JOURNAL_KINDS, 0)
+    for record in _journal.records(_athlete_id, _kinds):
+        kind, athlete_id, data = record['kind'], record['athlete_id'], record['data']
+        if kind == 'athlete':
+            _store.saveAthlete(athlete_id, data)
+        elif kind == 'activities':
+            _store.saveActivities(athlete_id, [{col: x.get(col) for col in activity_cols} for x in data])
+        elif kind == 'streams':
+            _store.saveStreams(athlete_id, int(record['key']), record['params']['types'],
+                               {key: np.asarray(value) for key, value in data.items()},
+                               record['params']['resolution'])
+        elif kind == 'gear':
+            _store.saveGear(athlete_id, data)
+        counts[kind] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    from store import ActivityStore
+
+    parser = argparse.ArgumentParser(description="Inspect or replay the raw API response journal")
+    parser.add_argument('command', choices=['list', 'show', 'replay', 'reindex'])
+    parser.add_argument('--journal', default=JOURNAL_PATH)
+    parser.add_argument('--store', default=STORE_PATH, help="Store to replay into")
+    parser.add_argument('--athlete', type=int, default=None)
+    parser.add_argument('--kind', choices=JOURNAL_KINDS, default=None)
+    parser.add_argument('--key', default=None, help="Activity id, gear id or page, for show")
+    args = parser.parse_args()
+
+    journal = ResponseJournal(args.journal)
+    kinds = None if args.kind is None else [args.kind]
+    if args.command == 'list':
+        for seq, kind, athlete_id, key, file_name, offset, length in journal.entries(args.athlete, kinds):
+            print(f"{seq:>8}  {kind:<12}{athlete_id!s:<12}{key:<16}{file_name}@{offset} ({length} bytes)")
+    elif args.command == 'show':
+        print(json.dumps(journal.latest(args.kind, args.athlete, args.key), indent=2))
+    elif args.command == 'replay':
+        print(replayJournal(journal, ActivityStore(args.store), args.athlete, kinds))
+    else:
+        print(f"Indexed {journal.rebuildIndex()} records")
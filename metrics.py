@@ -0,0 +1,129 @@
+import collections
+import datetime as dt
+import json
+import logging
+import logging.handlers
+import os
+import re
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+import numpy as np
+
+from parameters import *
+
+
+# Instrumentation: how long every stage of the pipeline takes, and how many Strava API calls go where.
+# Every timed stage and every API call becomes a JSON line in METRICS_LOG_PATH, for finding regressions after the
+# fact. Running totals (count, mean, max, and percentiles of the recent timings) plus what's left of the API quota are
+# kept in memory and served as JSON on /metrics.
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        payload = {'time': dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(),
+                   'event': record.getMessage()}
+        payload.update(getattr(record, 'fields', {}))
+        return json.dumps(payload, default=str)
+
+
+def apiEndpoint(url) -> str:
+    # The path of an API call with the ids taken out, so all calls to the same endpoint count together. Gear ids are
+    # numbers too, after a 'b' (bikes) or a 'g' (shoes).
+    return re.sub(r'/[bg]?\d+(?=/|$)', '/{id}', urllib.parse.urlparse(url).path)
+
+
+class Metrics:
+    def __init__(self, log_path=METRICS_LOG_PATH, max_samples=METRICS_SAMPLES, log_max_bytes=METRICS_LOG_MAX_BYTES,
+                 log_backups=METRICS_LOG_BACKUPS):
+        self.log_path = log_path
+        self.log_max_bytes = log_max_bytes
+        self.log_backups = log_backups
+        self.max_samples = max_samples
+        self._timers = {}
+        self._counters = collections.Counter()
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._logger = None
+
+    @property
+    def logger(self) -> logging.Logger:
+        # Set up on first use, so importing this module doesn't create any files. The log rolls over to
+        # metrics.log.1, .2, ... once it reaches log_max_bytes, and only the last log_backups of those are kept.
+        if self._logger is None:
+            logger = logging.getLogger(f"stravadash.metrics.{id(self)}")
+            os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(self.log_path, maxBytes=self.log_max_bytes,
+                                                           backupCount=self.log_backups, encoding='utf-8')
+            handler.setFormatter(JsonFormatter())
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            self._logger = logger
+        return self._logger
+
+    def log(self, event, **fields) -> None:
+        self.logger.info(event, extra={'fields': fields})
+
+    @contextmanager
+    def stage(self, name, **fields):
+        # Times the block, and logs it with fields (e.g. the athlete or activity id). A stage that raises still gets
+        # recorded, with the error.
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as exception:
+            error = repr(exception)
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, error=error, **fields)
+
+    def record(self, name, seconds, **fields) -> None:
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                              'samples': collections.deque(maxlen=self.max_samples)}
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            timer['samples'].append(seconds)
+        self.log('stage', stage=name, seconds=round(seconds, 6),
+                 **{key: value for key, value in fields.items() if value is not None})
+
+    def count(self, name, n=1) -> None:
+        with self._lock:
+            self._counters[name] += n
+
+    def gauge(self, name, value) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def apiCall(self, method, url, status, seconds) -> None:
+        endpoint = apiEndpoint(url)
+        self.count(f"api_calls {method} {endpoint}")
+        if status >= 400:
+            self.count(f"api_errors {status}")
+        self.record(f"api {method} {endpoint}", seconds, status=status)
+
+    def quota(self, short_limit, short_usage, long_limit, long_usage) -> None:
+        # What Strava says is left, after every response
+        with self._lock:
+            self._gauges.update({'quota_short_limit': short_limit, 'quota_short_remaining': short_limit - short_usage,
+                                 'quota_long_limit': long_limit, 'quota_long_remaining': long_limit - long_usage})
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {}
+            for name, timer in sorted(self._timers.items()):
+                samples = np.array(timer['samples'])
+                stages[name] = {'count': timer['count'], 'total_seconds': timer['total'],
+                                'mean_seconds': timer['total'] / timer['count'], 'max_seconds': timer['max'],
+                                'p50_seconds': float(np.percentile(samples, 50)),
+                                'p95_seconds': float(np.percentile(samples, 95))}
+            return {'stages': stages, 'counters': dict(self._counters), 'gauges': dict(self._gauges)}
+
+
+# One instance for the whole app, like the rate limit budget every session shares
+metrics = Metrics()
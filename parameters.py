@@ -20,4 +20,184 @@ activity_cols = ['id',
                 "map",
                 'start_latlng',
                 'end_latlng'
-                ]
\ No newline at end of file
+                ]
+
+# Strava API rate limits (requests per 15 minutes, requests per day). These are only the defaults: the actual limits
+# are read from the response headers once the first request has gone through.
+RATE_LIMIT_SHORT = 100
+RATE_LIMIT_LONG = 1000
+# Number of requests to keep in hand in each window, so other calls (athlete, gear, token refresh) don't get blocked.
+RATE_LIMIT_RESERVE = 5
+RATE_LIMIT_MAX_SLEEP = 60
+
+# Concurrent stream fetching
+FETCH_WORKERS = 8
+FETCH_RETRIES = 3
+RETRY_BASE_DELAY = 0.5
+
+# Local activity/stream store
+STORE_PATH = 'data'
+
+# Activity sync: page size of the activity list (Strava's maximum is 200), and the number of most recent activities
+# of each type that go on the maps
+SYNC_PAGE_SIZE = 200
+MAP_ACTIVITY_LIMIT = 50
+
+# How the activity maps are drawn. These are part of the render cache key, so changing them redraws the maps.
+MAP_OPTIONS = {'zoom_start': 14, 'tiles': ['cartodbpositron', 'cartodbdark_matter']}
+
+# Polyline simplification: Douglas-Peucker tolerances in metres for each level of detail (0 means all points), and the
+# maximum number of points we want to put on a single map
+SIMPLIFY_TOLERANCES = [0, 2, 5, 15, 40]
+MAP_POINT_BUDGET = 100_000
+
+# Heatmap tile pyramid: zoom levels to precompute (Leaflet scales up the highest one beyond that), number of
+# activities at which a pixel reaches full colour, and the longest jump (in pixels) still drawn as a line
+HEATMAP_ZOOMS = range(5, 15)
+HEATMAP_SATURATION = 30
+HEATMAP_MAX_GAP = 2000
+HEATMAP_KINDS = ['Run', 'Ride']
+HEATMAP_BATCH_SIZE = 200
+
+# Spatial index: grid cell sizes in degrees (roughly 11km and 1km), and the most cells a query may look up at the
+# finer level before it falls back to the coarser one
+SPATIAL_CELL_SIZES = [0.1, 0.01]
+SPATIAL_MAX_QUERY_CELLS = 400
+
+# Repeated-route detection: grid cell size (degrees) for the route signatures, MinHash signature length and number of
+# LSH bands (more bands finds more candidate pairs), points per resampled track, the largest Frechet distance (m)
+# between two runs of the same route, and the largest relative difference in length
+ROUTE_CELL_SIZE = 0.002
+ROUTE_MINHASH_SIZE = 64
+ROUTE_LSH_BANDS = 16
+ROUTE_SAMPLE_POINTS = 64
+ROUTE_MAX_FRECHET = 150
+ROUTE_MAX_LENGTH_DIFFERENCE = 0.15
+ROUTE_BATCH_SIZE = 1000
+
+# Best efforts: target distances in metres
+BEST_EFFORT_DISTANCES = {
+    '400m': 400,
+    '1k': 1000,
+    '5k': 5000,
+    '10k': 10000,
+    'Half marathon': 21097.5,
+}
+
+# Background jobs: number of jobs that can run at once, and how often (ms) the page checks on a running job
+JOB_WORKERS = 4
+JOB_POLL_INTERVAL = 500
+
+# Per-user Strava sessions: refresh the access token this many seconds before it runs out (and retry after
+# TOKEN_REFRESH_RETRY seconds if that fails), and keep up to HTTP_POOL_SIZE connections alive per user
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_RETRY = 60
+HTTP_POOL_SIZE = FETCH_WORKERS
+# Sessions nobody used for SESSION_IDLE_TIMEOUT seconds get logged out (checked every SESSION_SWEEP_INTERVAL seconds)
+SESSION_IDLE_TIMEOUT = 12 * 3600
+SESSION_SWEEP_INTERVAL = 600
+
+# Rendered maps are cached on disk, up to this many bytes; the least recently used ones get removed first
+RENDER_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# Recent-activity maps: 'folium' renders a full Folium document per map (served from the render cache), 'client'
+# sends just the routes, as encoded polylines ('polyline') or GeoJSON ('geojson'), and draws them in the browser.
+# POLYLINE_PRECISION is the number of decimals kept (5 is about a metre).
+MAP_RENDER_MODE = 'client'
+MAP_PAYLOAD_FORMAT = 'polyline'
+POLYLINE_PRECISION = 5
+# The client map loads a page of MAP_PAGE_SIZE activities at a time, newest first, one page every MAP_PAGE_INTERVAL ms,
+# up to MAP_MAX_PAGES. Every page is a layer of its own, within MAP_PAGE_POINT_BUDGET points (or at the level of
+# detail for the zoom level, once the map has been moved). Pages with activities that are still being fetched get
+# asked for again, up to MAP_PAGE_RETRIES times.
+MAP_PAGE_SIZE = 10
+MAP_MAX_PAGES = 50
+MAP_PAGE_INTERVAL = 1000
+MAP_PAGE_POINT_BUDGET = 25_000
+MAP_PAGE_RETRIES = 30
+
+# Stream resolution tiers, coarsest first (Strava gives up to 100, 1000 and 10000 points). Maps only need a low
+# resolution route; the analytics get everything at high resolution, fetched the first time they need it.
+STREAM_RESOLUTIONS = ['low', 'medium', 'high']
+MAP_STREAM_RESOLUTION = 'low'
+MAP_STREAM_TYPES = ['latlng']
+ANALYTICS_STREAM_RESOLUTION = 'high'
+ANALYTICS_STREAM_TYPES = ['distance', 'time', 'latlng', 'altitude', 'heartrate']
+# Streams derived from those (derived.py), stored next to them: altitude smoothed over GRADE_STEP metres, the grade
+# (capped at DERIVED_MAX_GRADE), speed over FEATURE_WINDOW seconds and its grade-adjusted equivalent, whether the
+# athlete was moving (MOVING_SPEED or faster), and the heart rate zone. Bump DERIVED_VERSION when any of that changes.
+DERIVED_VERSION = 1
+DERIVED_STREAM_TYPES = ['altitude_smooth', 'grade', 'speed', 'gap_speed', 'is_moving', 'hr_zone']
+DERIVED_MAX_GRADE = 0.45
+
+# Offline import of the Strava account export (bulk_import.py): number of processes parsing the GPX/TCX/FIT files
+IMPORT_WORKERS = 4
+
+# Heart rate zones: upper bounds of zones 1-4 as a fraction of HR_MAX (zone 5 is everything above)
+HR_MAX = 190
+HR_ZONE_FRACTIONS = [0.6, 0.7, 0.8, 0.9]
+
+# Workout features (features.py). Bump FEATURE_VERSION when the extraction changes, so the stored features get
+# worked out again. Speeds are taken over FEATURE_WINDOW seconds, smoothed over FEATURE_SMOOTHING windows; below
+# MOVING_SPEED (m/s) counts as stopped. Grades are taken over GRADE_STEP metres.
+FEATURE_VERSION = 2
+FEATURE_WORKERS = 4
+FEATURE_BATCH_SIZE = 50
+FEATURE_WINDOW = 10
+FEATURE_SMOOTHING = 3
+MOVING_SPEED = 1.0
+GRADE_STEP = 50
+# A surge is at least SURGE_MIN_DURATION seconds at SURGE_SPEED_FACTOR times the activity's median speed or faster
+SURGE_SPEED_FACTOR = 1.15
+SURGE_MIN_DURATION = 40
+
+# Workout classification, against the athlete's median distance and speed over the CLASSIFY_WINDOW before each
+# activity (of the same type)
+CLASSIFY_WINDOW = '42D'
+INTERVAL_MIN_SURGES = 3
+INTERVAL_MIN_SPEED_CV = 0.15
+LONG_DISTANCE_FACTOR = 1.4
+LONG_MIN_DISTANCE = 12000
+TEMPO_ZONE_FRACTION = 0.5
+TEMPO_SPEED_FACTOR = 1.08
+WORKOUT_CLASSES = ['intervals', 'tempo', 'long', 'easy']
+
+# Training load and fitness (fitness.py). Load is Banister's TRIMP, from the heart rate reserve between HR_REST and
+# HR_MAX (TRIMP_DEFAULT_HRR for activities without heart rate). Fitness and fatigue are exponentially weighted averages
+# of the daily load, with time constants (days) FITNESS_DAYS and FATIGUE_DAYS.
+HR_REST = 50
+TRIMP_DEFAULT_HRR = 0.6
+FITNESS_DAYS = 42
+FATIGUE_DAYS = 7
+
+# Race predictions, from the best efforts of the last PREDICTION_WINDOW days. The Riegel exponent is fitted if there
+# are efforts over two or more distances (within the given bounds), and RIEGEL_EXPONENT otherwise. Critical speed is
+# fitted on efforts between CRITICAL_SPEED_DURATIONS seconds long.
+RACE_DISTANCES = {
+    '5k': 5000,
+    '10k': 10000,
+    'Half marathon': 21097.5,
+    'Marathon': 42195,
+}
+PREDICTION_WINDOW = 90
+RIEGEL_EXPONENT = 1.06
+RIEGEL_EXPONENT_BOUNDS = (1.01, 1.15)
+CRITICAL_SPEED_DURATIONS = (120, 1800)
+
+# Gear details get fetched again once they're older than GEAR_TTL seconds (for the distance Strava keeps per item)
+GEAR_TTL = 7 * 24 * 3600
+
+# Instrumentation (metrics.py): stage timings and API calls go to METRICS_LOG_PATH as JSON lines, and the last
+# METRICS_SAMPLES timings of every stage are kept for the percentiles on /metrics. The log rotates at
+# METRICS_LOG_MAX_BYTES, keeping METRICS_LOG_BACKUPS old files.
+METRICS_LOG_PATH = f"{STORE_PATH}/metrics.log"
+METRICS_LOG_MAX_BYTES = 20 * 1024 * 1024
+METRICS_LOG_BACKUPS = 5
+METRICS_SAMPLES = 500
+
+# Raw API response journal (journal.py): every response from Strava, as gzip-compressed JSON lines under JOURNAL_PATH
+# (a file per day), for debugging and for rebuilding the store without the API
+JOURNAL_ENABLED = True
+JOURNAL_PATH = f"{STORE_PATH}/journal"
+JOURNAL_COMPRESSION_LEVEL = 3
+JOURNAL_READ_BLOCK = 64 * 1024
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import threading
+
+from parameters import *
+
+
+# Rendered map documents, keyed by a fingerprint of everything that goes into them (which activities, at which level
+# of detail, with which map options). Unchanged maps are served straight from disk instead of being drawn by Folium
+# again. The files live under the data folder rather than assets/, so writing them doesn't set off Dash's hot reload,
+# and they get served through their own route.
+# The cache is bounded in size: once it grows past max_bytes, the least recently used documents go first. Every hit
+# touches the file, so its modification time doubles as the last-used time.
+class RenderCache:
+    def __init__(self, root=os.path.join(STORE_PATH, 'renders'), max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        # parts have to be JSON serialisable; numpy/pandas ids get turned into plain ints first
+        payload = json.dumps(parts, sort_keys=True, default=lambda x: x.item() if hasattr(x, 'item') else str(x))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def validKey(key) -> bool:
+        return len(key) == 32 and all(x in '0123456789abcdef' for x in key)
+
+    def path(self, key) -> str:
+        return os.path.join(self.root, f"{key}.html")
+
+    def get(self, key):
+        # Path of the cached document, or None on a miss
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, document) -> str:
+        # Write to a temporary file first, so a half-written document never gets served
+        path = self.path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(document)
+        os.replace(temp_path, path)
+        self.evict(_keep=path)
+        return path
+
+    def evict(self, _keep=None) -> int:
+        # Removes the least recently used documents until the cache fits in max_bytes again. _keep (the document that
+        # was just written) always stays, even if it's bigger than the whole cache.
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.root):
+                if entry.name.endswith('.html'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(x[1] for x in entries)
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == _keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+        return removed
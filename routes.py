@@ -0,0 +1,131 @@
+import numpy as np
+
+from parameters import *
+import geodesy as geo
+from spatial_index import cellIds
+
+
+# Finds routes that get run (or ridden) over and over, and groups those activities together.
+# Comparing every pair of routes properly is far too slow, so every route is first reduced to a MinHash signature of
+# the grid cells it visits. Locality-sensitive hashing over bands of that signature gives the pairs that are likely to
+# be the same route, and only those get checked against the discrete Frechet distance between the actual tracks.
+# Signatures and resampled tracks are kept in the store, so re-clustering doesn't need to read any streams.
+MINHASH_PRIME = (1 << 31) - 1
+_hash_rng = np.random.default_rng(1234)
+MINHASH_A = _hash_rng.integers(1, MINHASH_PRIME, size=ROUTE_MINHASH_SIZE, dtype=np.int64)
+MINHASH_B = _hash_rng.integers(0, MINHASH_PRIME, size=ROUTE_MINHASH_SIZE, dtype=np.int64)
+
+
+def minhashSignature(_cells) -> np.ndarray:
+    _cells = np.asarray(_cells, dtype=np.int64) % MINHASH_PRIME
+    return ((MINHASH_A[:, None] * _cells[None, :] + MINHASH_B[:, None]) % MINHASH_PRIME).min(axis=1)
+
+
+def frechetWithin(_distances, _max_distance) -> np.ndarray:
+    # Decision version of the discrete Frechet distance, for a stack of K pairs of tracks at once: can both tracks be
+    # walked from start to end, never more than _max_distance apart? _distances holds the (K, N, M) matrices of
+    # distances between their points. Goes through the matrices one row at a time; within a row, a cell is reachable
+    # if it's close enough and there's an unbroken run of close-enough cells back to one reachable from the row above.
+    _close = _distances <= _max_distance
+    _k, _n, _m = _close.shape
+    _index = np.arange(_m)
+    _reach = np.logical_and.accumulate(_close[:, 0, :], axis=1)
+    for i in range(1, _n):
+        _from_above = _reach.copy()
+        _from_above[:, 1:] |= _reach[:, :-1]
+        _seeds = _close[:, i, :] & _from_above
+        _last_seed = np.maximum.accumulate(np.where(_seeds, _index, -1), axis=1)
+        _last_blocked = np.maximum.accumulate(np.where(_close[:, i, :], -1, _index), axis=1)
+        _reach = _close[:, i, :] & (_last_seed > _last_blocked)
+        # Pairs that aren't the same route usually drop out within a few rows
+        if not _reach.any():
+            break
+    return _reach[:, -1]
+
+
+def sameRoute(_samples_a, _samples_b, _max_distance=ROUTE_MAX_FRECHET) -> np.ndarray:
+    # For stacks of resampled tracks (K, N, 2). The same loop, run the other way round, is still the same route.
+    _distances = geo.pairwiseDistances(_samples_a, _samples_b)
+    return frechetWithin(_distances, _max_distance) | frechetWithin(_distances[:, :, ::-1], _max_distance)
+
+
+class RouteClusterer:
+    def __init__(self, store, bands=ROUTE_LSH_BANDS, max_distance=ROUTE_MAX_FRECHET):
+        self.store = store
+        self.bands = bands
+        self.max_distance = max_distance
+
+    def addActivity(self, athlete_id, activity_id, latlng) -> None:
+        # latlng is the makePolyLine output of the activity
+        if len(latlng) < 2:
+            return
+        length = geo.alongTrackDistance(latlng)[-1]
+        signature = minhashSignature(cellIds(latlng, ROUTE_CELL_SIZE))
+        samples = geo.resample(latlng, ROUTE_SAMPLE_POINTS)
+        self.store.saveRouteSignature(athlete_id, activity_id, length, signature, samples)
+
+    def _candidateBuckets(self, signatures) -> list:
+        # Activities whose signatures agree on all rows of at least one band end up in the same bucket
+        rows = signatures.shape[1] // self.bands
+        buckets = {}
+        for band in range(self.bands):
+            band_rows = signatures[:, band * rows:(band + 1) * rows]
+            for index, key in enumerate(map(bytes, band_rows)):
+                buckets.setdefault((band, key), []).append(index)
+        return [x for x in buckets.values() if len(x) > 1]
+
+    def cluster(self, athlete_id) -> dict:
+        # Returns {activity_id: cluster_id}, for the activities that share their route with at least one other one.
+        # Cluster ids are the id of the oldest activity in the cluster, so they stay put when new activities come in.
+        id_list, lengths, signatures, samples = self.store.loadRouteSignatures(athlete_id)
+        if len(id_list) < 2:
+            return {}
+        parent = list(range(len(id_list)))
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        # Every round, each bucket compares its first route with the others that aren't known to be the same route
+        # yet, and all those comparisons run as one batch. Routes that turned out different from it get their own
+        # turn in the next round. That way, a bucket with hundreds of runs of the same loop costs one comparison per
+        # run rather than one per pair.
+        buckets = self._candidateBuckets(signatures)
+        comparisons = 0
+        while len(buckets) > 0:
+            pairs = set()
+            for bucket in buckets:
+                leader = find(bucket[0])
+                for index in bucket[1:]:
+                    other = find(index)
+                    length_difference = abs(lengths[other] - lengths[leader])
+                    if other != leader and length_difference <= ROUTE_MAX_LENGTH_DIFFERENCE * lengths[leader]:
+                        pairs.add((leader, other))
+
+            pairs = sorted(pairs)
+            comparisons += len(pairs)
+            for start in range(0, len(pairs), ROUTE_BATCH_SIZE):
+                batch = np.array(pairs[start:start + ROUTE_BATCH_SIZE])
+                matches = sameRoute(samples[batch[:, 0]], samples[batch[:, 1]], self.max_distance)
+                for leader, other in batch[matches]:
+                    parent[find(other)] = find(leader)
+
+            # Whatever didn't turn out to be the same route as its bucket's first route gets another round
+            buckets = [x for x in ([y for y in bucket if find(y) != find(bucket[0])] for bucket in buckets)
+                       if len(x) > 1]
+
+        groups = {}
+        for index in range(len(id_list)):
+            groups.setdefault(find(index), []).append(id_list[index])
+        clusters = {}
+        for members in groups.values():
+            if len(members) > 1:
+                cluster_id = min(members)
+                clusters.update({x: cluster_id for x in members})
+
+        print(f"Route clustering: {len(id_list)} routes, {comparisons} exact comparisons, "
+              f"{len(set(clusters.values()))} repeated routes")
+        self.store.saveRouteClusters(athlete_id, clusters)
+        return clusters
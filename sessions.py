@@ -0,0 +1,198 @@
+import datetime as dt
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from stravalib import Client
+
+from parameters import *
+from fetcher import RateLimitBudget, StreamFetcher
+from metrics import metrics
+
+
+# Everything that belongs to one logged-in user: their tokens, their athlete and a stravalib Client on top of a
+# requests.Session of their own. The session keeps its connections to Strava alive, so only the first call pays for
+# the TLS handshake, and its pool is big enough for all the stream fetcher's workers at once.
+# The access token gets refreshed TOKEN_REFRESH_MARGIN seconds before it runs out, on a timer, so no request ever has
+# to wait for a refresh first.
+class UserSession:
+    def __init__(self, client_id, client_secret, budget, pool_size=HTTP_POOL_SIZE):
+        self.client_id = client_id
+        self.client_secret = client_secret
+
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        # Every call to Strava gets counted, per endpoint, with its latency. api_calls counts the calls of this session
+        # alone that count towards the rate limits, which the shared budget's usage can't tell: that includes everyone
+        # else's calls, and goes back to 0 every day.
+        self.api_calls = 0
+        self._calls_lock = threading.Lock()
+        self.http.hooks['response'].append(self._recordResponse)
+        self.client = Client(requests_session=self.http)
+        self.stream_fetcher = StreamFetcher(self.client, budget)
+        self.athlete = None
+        # Known from the login already, before the athlete itself gets fetched
+        self.athlete_id = None
+        # URL of the latest recent-activities map of each activity type
+        self.map_urls = {}
+        # Goes into the URLs of the routes that serve this user's data, which can't be told apart from anyone else's
+        # requests otherwise. It's not the session id, so those URLs (which end up in logs) don't give the session away.
+        self.url_token = uuid.uuid4().hex
+        # time.monotonic() of the last time the page or one of the routes asked for this session
+        self.last_seen = time.monotonic()
+
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = None
+
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def _recordResponse(self, response, *args, **kwargs) -> None:
+        if '/oauth/' not in response.url:
+            with self._calls_lock:
+                self.api_calls += 1
+        metrics.apiCall(response.request.method, response.url, response.status_code,
+                        response.elapsed.total_seconds())
+
+    def setTokens(self, access_info) -> None:
+        # access_info is what exchange_code_for_token and refresh_access_token return. expires_at is a Unix timestamp.
+        self.access_token = access_info['access_token']
+        self.refresh_token = access_info['refresh_token']
+        self.expires_at = dt.datetime.fromtimestamp(access_info['expires_at'], dt.timezone.utc)
+        self.client.access_token = self.access_token
+        self.client.refresh_token = self.refresh_token
+        self._scheduleRefresh()
+
+    def expiresIn(self) -> float:
+        # Seconds until the access token runs out
+        if self.expires_at is None:
+            return 0
+        return (self.expires_at - dt.datetime.now(dt.timezone.utc)).total_seconds()
+
+    def _scheduleRefresh(self, delay=None) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        if delay is None:
+            delay = max(self.expiresIn() - TOKEN_REFRESH_MARGIN, 0)
+        self._timer = threading.Timer(delay, self._refreshInBackground)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refreshInBackground(self) -> None:
+        try:
+            self.refresh()
+        except Exception as error:
+            # Try again in a bit. ensureFresh still catches it if the token runs out before then.
+            print(f"Refreshing the access token failed: {error}")
+            self._scheduleRefresh(TOKEN_REFRESH_RETRY)
+
+    def refresh(self, margin=None) -> None:
+        # Refreshes right away, or, given a margin, only if the token runs out within that many seconds. The check is
+        # done under the lock, so two jobs finding an expiring token at once only refresh it once.
+        with self._lock:
+            if margin is not None and self.expiresIn() > margin:
+                return
+            access_info = self.client.refresh_access_token(client_id=self.client_id,
+                                                           client_secret=self.client_secret,
+                                                           refresh_token=self.refresh_token)
+            self.setTokens(access_info)
+        print("Refreshed the access token")
+
+    def ensureFresh(self) -> None:
+        # Fallback for when the timer didn't get to it (e.g. the machine was asleep)
+        self.refresh(TOKEN_REFRESH_MARGIN)
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self.http.close()
+
+
+class SessionRegistry:
+    # Maps the session id kept in the browser's dcc.Store to that user's UserSession, so several athletes can use the
+    # same app at once without sharing tokens or data. All sessions share one RateLimitBudget, because Strava's rate
+    # limits count against the app as a whole rather than per user.
+    # There's no telling when a browser tab gets closed, so sessions that haven't been used in a while get logged out,
+    # which also stops their refresh timers.
+    def __init__(self, client_id, client_secret, budget=None, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.budget = budget or RateLimitBudget()
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self._scheduleSweep()
+
+    def _scheduleSweep(self) -> None:
+        self._timer = threading.Timer(SESSION_SWEEP_INTERVAL, self._sweep)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _sweep(self) -> None:
+        try:
+            expired_count = self.expireIdle()
+            if expired_count > 0:
+                print(f"Logged out {expired_count} idle sessions")
+        finally:
+            self._scheduleSweep()
+
+    def expireIdle(self) -> int:
+        # Logs out the sessions that have been idle for longer than idle_timeout. Returns how many.
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            session_id_list = [key for key, user in self._sessions.items() if user.last_seen < cutoff]
+        for session_id in session_id_list:
+            self.logout(session_id)
+        return len(session_id_list)
+
+    def authorizationUrl(self, redirect_uri) -> str:
+        return Client().authorization_url(
+            client_id=self.client_id,
+            redirect_uri=redirect_uri,
+            approval_prompt='auto',
+            scope=['read_all', 'profile:read_all', 'activity:read_all']
+        )
+
+    def login(self, code) -> str:
+        # Swaps the auth-code from the OAUTH redirect for tokens, and returns the id of the new session
+        user = UserSession(self.client_id, self.client_secret, self.budget)
+        # The token response has the athlete summary in it, so the sync can be keyed on the athlete without another call
+        access_info, athlete = user.client.exchange_code_for_token(client_id=self.client_id,
+                                                                   client_secret=self.client_secret,
+                                                                   code=code, return_athlete=True)
+        user.setTokens(access_info)
+        if athlete is not None:
+            user.athlete_id = athlete.id
+
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[session_id] = user
+        return session_id
+
+    def get(self, session_id):
+        # None if the session is unknown, e.g. because the app restarted since the user logged in
+        if session_id is None:
+            return None
+        with self._lock:
+            user = self._sessions.get(session_id)
+        if user is not None:
+            user.last_seen = time.monotonic()
+        return user
+
+    def byToken(self, url_token):
+        # The session with this url_token, or None
+        with self._lock:
+            user = next((x for x in self._sessions.values() if x.url_token == url_token), None)
+        if user is not None:
+            user.last_seen = time.monotonic()
+        return user
+
+    def logout(self, session_id) -> None:
+        with self._lock:
+            user = self._sessions.pop(session_id, None)
+        if user is not None:
+            user.close()
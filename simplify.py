@@ -0,0 +1,97 @@
+import math
+
+import numpy as np
+
+from parameters import *
+import constants as const
+
+
+# Level-of-detail versions of activity polylines, so a map with hundreds of activities doesn't have to carry every
+# single GPS point. Level 0 is the full polyline; every next level in SIMPLIFY_TOLERANCES throws away more detail.
+def projectLocal(_latlng) -> np.ndarray:
+    # Equirectangular projection around the middle of the track, in metres. Plenty accurate over the size of an
+    # activity, and it lets the simplification work with plain planar distances.
+    _latlng = np.asarray(_latlng, dtype=np.float64)
+    _lat0 = (_latlng[:, 0].min() + _latlng[:, 0].max()) / 2
+    _xy = np.empty_like(_latlng)
+    _xy[:, 0] = _latlng[:, 1] * const.RADIAN * const.EARTH_RADIUS * math.cos(_lat0 * const.RADIAN)
+    _xy[:, 1] = _latlng[:, 0] * const.RADIAN * const.EARTH_RADIUS
+    return _xy
+
+
+def _segmentDistances(_x, _y, _x0, _y0, _x1, _y1) -> np.ndarray:
+    # Squared distance from every point to the segment (_x0, _y0)-(_x1, _y1). It's the segment rather than the
+    # infinite line, so closed loops (where start and end coincide) work too.
+    _dx = _x1 - _x0
+    _dy = _y1 - _y0
+    _length2 = _dx * _dx + _dy * _dy
+    _px = _x - _x0
+    _py = _y - _y0
+    if _length2 > 0:
+        _t = (_px * _dx + _py * _dy) / _length2
+        np.clip(_t, 0, 1, out=_t)
+        _px -= _t * _dx
+        _py -= _t * _dy
+    return _px * _px + _py * _py
+
+
+def douglasPeucker(_latlng, _tolerance) -> np.ndarray:
+    # Boolean mask of the points to keep. Iterative rather than recursive, so long tracks can't hit the recursion
+    # limit; the distance computation within each split is vectorised.
+    _n = len(_latlng)
+    _keep = np.zeros(_n, dtype=bool)
+    if _n <= 2 or _tolerance <= 0:
+        _keep[:] = True
+        return _keep
+    _xy = projectLocal(_latlng)
+    _x = np.ascontiguousarray(_xy[:, 0])
+    _y = np.ascontiguousarray(_xy[:, 1])
+    _tolerance2 = _tolerance * _tolerance
+    _keep[0] = _keep[-1] = True
+    _stack = [(0, _n - 1)]
+    while _stack:
+        _i, _j = _stack.pop()
+        if _j <= _i + 1:
+            continue
+        _distances = _segmentDistances(_x[_i + 1:_j], _y[_i + 1:_j], _x[_i], _y[_i], _x[_j], _y[_j])
+        _k = int(_distances.argmax())
+        if _distances[_k] > _tolerance2:
+            _split = _i + 1 + _k
+            _keep[_split] = True
+            _stack.append((_i, _split))
+            _stack.append((_split, _j))
+    return _keep
+
+
+def simplifyLevels(_latlng, _tolerances=SIMPLIFY_TOLERANCES) -> list:
+    # One polyline per tolerance, finest first. Every level is simplified from the one before it rather than from the
+    # full polyline, which is a lot cheaper, and the tolerances grow fast enough that the extra error doesn't show.
+    polylines = []
+    current = _latlng
+    for tolerance in _tolerances:
+        if tolerance > 0:
+            current = current[douglasPeucker(current, tolerance)]
+        polylines.append(current)
+    return polylines
+
+
+def chooseLevel(_level_lists, _point_budget=MAP_POINT_BUDGET) -> int:
+    # _level_lists holds the simplifyLevels output of every activity on the map. Pick the most detailed level that
+    # keeps the whole map within the point budget, or the coarsest one if none does.
+    if len(_level_lists) == 0:
+        return 0
+    n_levels = len(_level_lists[0])
+    for level in range(n_levels):
+        if sum(len(x[level]) for x in _level_lists) <= _point_budget:
+            return level
+    return n_levels - 1
+
+
+def levelForZoom(_zoom, _latitude=0.0, _tolerances=SIMPLIFY_TOLERANCES) -> int:
+    # Most simplified level whose tolerance is still below the size of one pixel at this zoom level
+    metres_per_pixel = 156543.03 * math.cos(_latitude * const.RADIAN) / 2 ** _zoom
+    level = 0
+    for index, tolerance in enumerate(_tolerances):
+        if tolerance <= metres_per_pixel:
+            level = index
+    return level
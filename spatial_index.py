@@ -0,0 +1,99 @@
+import math
+
+import numpy as np
+
+from parameters import *
+import constants as const
+import geodesy as geo
+
+
+# Grid-cell index over the routes of all stored activities, to answer "which activities pass through here" without
+# going through every stream. Every activity gets a posting in each lat/lng grid cell it visits, on a coarse and a
+# fine grid (SPATIAL_CELL_SIZES, in degrees). A query looks up the cells that cover its bounding box on the finest
+# grid that doesn't need too many cells, and only the activities found there get checked against their actual points.
+def cellIds(_latlng, _cell_size) -> np.ndarray:
+    _latlng = np.asarray(_latlng, dtype=np.float64)
+    _n_cols = int(round(360 / _cell_size))
+    _rows = np.floor((_latlng[:, 0] + 90) / _cell_size).astype(np.int64)
+    _cols = np.floor((_latlng[:, 1] + 180) / _cell_size).astype(np.int64) % _n_cols
+    return np.unique(_rows * _n_cols + _cols)
+
+
+def bboxCellIds(_south, _west, _north, _east, _cell_size) -> list:
+    _n_cols = int(round(360 / _cell_size))
+    _row_range = range(int(math.floor((_south + 90) / _cell_size)), int(math.floor((_north + 90) / _cell_size)) + 1)
+    _col_range = range(int(math.floor((_west + 180) / _cell_size)), int(math.floor((_east + 180) / _cell_size)) + 1)
+    return [row * _n_cols + col % _n_cols for row in _row_range for col in _col_range]
+
+
+def pointsInPolygon(_latlng, _polygon) -> np.ndarray:
+    # Ray casting, vectorised over the points (polygons are small, routes are not)
+    _lat = np.asarray(_latlng, dtype=np.float64)[:, 0]
+    _lng = np.asarray(_latlng, dtype=np.float64)[:, 1]
+    _polygon = np.asarray(_polygon, dtype=np.float64)
+    _inside = np.zeros(len(_lat), dtype=bool)
+    for (lat1, lng1), (lat2, lng2) in zip(_polygon, np.roll(_polygon, -1, axis=0)):
+        if lat1 == lat2:
+            continue
+        _crosses = (lat1 > _lat) != (lat2 > _lat)
+        _lng_cross = lng1 + (_lat - lat1) * (lng2 - lng1) / (lat2 - lat1)
+        _inside ^= _crosses & (_lng < _lng_cross)
+    return _inside
+
+
+class SpatialIndex:
+    def __init__(self, store, cell_sizes=SPATIAL_CELL_SIZES):
+        self.store = store
+        # Coarse to fine
+        self.cell_sizes = sorted(cell_sizes, reverse=True)
+
+    def addActivity(self, athlete_id, activity_id, latlng) -> None:
+        postings = [(level, cellIds(latlng, cell_size)) for level, cell_size in enumerate(self.cell_sizes)]
+        self.store.saveSpatialPostings(athlete_id, activity_id, postings)
+
+    def _candidates(self, athlete_id, south, west, north, east) -> set:
+        # Finest grid at which the bounding box is still covered by a manageable number of cells
+        for level in reversed(range(len(self.cell_sizes))):
+            cells = bboxCellIds(south, west, north, east, self.cell_sizes[level])
+            if len(cells) <= SPATIAL_MAX_QUERY_CELLS or level == 0:
+                return self.store.spatialCandidates(athlete_id, level, cells)
+        return set()
+
+    def _filter(self, athlete_id, candidates, test) -> set:
+        result = set()
+        for activity_id in candidates:
+            activity_streams = self.store.loadStreams(athlete_id, activity_id, ['latlng'])
+            if 'latlng' in activity_streams and test(activity_streams['latlng']):
+                result.add(activity_id)
+        return result
+
+    def boxCandidates(self, athlete_id, south, west, north, east) -> set:
+        # Only the grid cells, without checking the routes themselves: a few activities that just miss the box get
+        # through as well, but nothing gets loaded from disk. Good enough for culling what a map sends to the browser.
+        return self._candidates(athlete_id, south, west, north, east)
+
+    def queryBox(self, athlete_id, south, west, north, east) -> set:
+        def test(latlng):
+            return np.any((latlng[:, 0] >= south) & (latlng[:, 0] <= north) &
+                          (latlng[:, 1] >= west) & (latlng[:, 1] <= east))
+
+        return self._filter(athlete_id, self._candidates(athlete_id, south, west, north, east), test)
+
+    def queryRadius(self, athlete_id, latitude, longitude, radius) -> set:
+        # radius in metres
+        delta_lat = radius / const.EARTH_RADIUS / const.RADIAN
+        delta_lng = delta_lat / max(math.cos(latitude * const.RADIAN), 1e-6)
+        candidates = self._candidates(athlete_id, latitude - delta_lat, longitude - delta_lng,
+                                      latitude + delta_lat, longitude + delta_lng)
+
+        def test(latlng):
+            return geo.distancesTo(latlng, (latitude, longitude)).min() <= radius
+
+        return self._filter(athlete_id, candidates, test)
+
+    def queryPolygon(self, athlete_id, polygon) -> set:
+        # polygon is a list of (latitude, longitude) corners
+        polygon = np.asarray(polygon, dtype=np.float64)
+        candidates = self._candidates(athlete_id, polygon[:, 0].min(), polygon[:, 1].min(),
+                                      polygon[:, 0].max(), polygon[:, 1].max())
+        return self._filter(athlete_id, candidates, lambda latlng: np.any(pointsInPolygon(latlng, polygon)))
@@ -0,0 +1,638 @@
+import datetime as dt
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from parameters import *
+from streams import ActivityStreams
+from activity_table import ActivityTable
+
+
+def isoDate(value):
+    # Activity dicts come with start_date either as a datetime or as an ISO string ending in 'Z'. Store them all the
+    # same way (UTC, ISO format), so they sort correctly as text.
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = dt.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=dt.timezone.utc)
+    return value.astimezone(dt.timezone.utc).isoformat()
+
+
+# Local store for everything we've pulled from Strava, so a sync only has to fetch what's new.
+# Activity summaries, gear and athletes go into SQLite (the full dict as JSON, plus the few columns we query on).
+# Activity summaries also go into a typed, partitioned Parquet table (see activity_table.py), which is what activity
+# frames get read from.
+# Streams are stored column-wise: one .npy file per stream type, under streams/<athlete_id>/<activity_id>/.
+class ActivityStore:
+    def __init__(self, root=STORE_PATH):
+        self.root = root
+        self.db_path = os.path.join(root, 'strava.db')
+        self.stream_root = os.path.join(root, 'streams')
+        os.makedirs(self.stream_root, exist_ok=True)
+        self.activity_table = ActivityTable(os.path.join(root, 'activities'))
+        self._createTables()
+
+    @contextmanager
+    def _connect(self):
+        # A fresh connection per call: Dash serves callbacks from several threads, and sqlite connections can't be
+        # shared between them.
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _createTables(self):
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS athletes (
+                    id INTEGER PRIMARY KEY,
+                    data TEXT,
+                    synced_at TEXT
+                );
+                CREATE TABLE IF NOT EXISTS activities (
+                    athlete_id INTEGER NOT NULL,
+                    id INTEGER NOT NULL,
+                    type TEXT,
+                    start_date TEXT,
+                    data TEXT,
+                    PRIMARY KEY (athlete_id, id)
+                );
+                CREATE INDEX IF NOT EXISTS activities_start_date ON activities (athlete_id, start_date);
+                CREATE TABLE IF NOT EXISTS gear (
+                    id TEXT PRIMARY KEY,
+                    athlete_id INTEGER,
+                    data TEXT
+                );
+                CREATE TABLE IF NOT EXISTS streams (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    types TEXT,
+                    n_points INTEGER,
+                    PRIMARY KEY (athlete_id, activity_id)
+                );
+                CREATE TABLE IF NOT EXISTS heatmap_activities (
+                    athlete_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    PRIMARY KEY (athlete_id, kind, activity_id)
+                );
+                CREATE TABLE IF NOT EXISTS spatial_cells (
+                    athlete_id INTEGER NOT NULL,
+                    level INTEGER NOT NULL,
+                    cell INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    PRIMARY KEY (athlete_id, level, cell, activity_id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS spatial_activities (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    PRIMARY KEY (athlete_id, activity_id)
+                );
+                CREATE TABLE IF NOT EXISTS route_signatures (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    length REAL,
+                    signature BLOB,
+                    samples BLOB,
+                    PRIMARY KEY (athlete_id, activity_id)
+                );
+                CREATE TABLE IF NOT EXISTS route_clusters (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    cluster_id INTEGER NOT NULL,
+                    PRIMARY KEY (athlete_id, activity_id)
+                );
+                CREATE TABLE IF NOT EXISTS best_efforts (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    distance REAL,
+                    elapsed_time REAL,
+                    start_index INTEGER,
+                    end_index INTEGER,
+                    PRIMARY KEY (athlete_id, activity_id, name)
+                );
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    athlete_id INTEGER PRIMARY KEY,
+                    after INTEGER,
+                    last_page INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS stream_tiers (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    resolution TEXT NOT NULL,
+                    types TEXT,
+                    n_points INTEGER,
+                    PRIMARY KEY (athlete_id, activity_id, resolution)
+                );
+                CREATE TABLE IF NOT EXISTS derived_streams (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    resolution TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    PRIMARY KEY (athlete_id, activity_id, resolution)
+                );
+                CREATE TABLE IF NOT EXISTS activity_features (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    version INTEGER NOT NULL,
+                    data TEXT,
+                    PRIMARY KEY (athlete_id, activity_id)
+                );
+                CREATE TABLE IF NOT EXISTS training_loads (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    day TEXT NOT NULL,
+                    load REAL,
+                    PRIMARY KEY (athlete_id, activity_id)
+                );
+                CREATE TABLE IF NOT EXISTS fitness_days (
+                    athlete_id INTEGER NOT NULL,
+                    day TEXT NOT NULL,
+                    load REAL,
+                    fitness REAL,
+                    fatigue REAL,
+                    PRIMARY KEY (athlete_id, day)
+                );
+                CREATE TABLE IF NOT EXISTS activity_gear (
+                    athlete_id INTEGER NOT NULL,
+                    activity_id INTEGER NOT NULL,
+                    gear_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    distance REAL,
+                    moving_time REAL,
+                    PRIMARY KEY (athlete_id, activity_id)
+                );
+                CREATE TABLE IF NOT EXISTS gear_days (
+                    athlete_id INTEGER NOT NULL,
+                    gear_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    distance REAL,
+                    moving_time REAL,
+                    activity_count INTEGER,
+                    PRIMARY KEY (athlete_id, gear_id, day)
+                );
+            """)
+            # Streams from before there were resolution tiers are all medium resolution
+            conn.execute("INSERT OR IGNORE INTO stream_tiers (athlete_id, activity_id, resolution, types, n_points) "
+                         "SELECT athlete_id, activity_id, 'medium', types, n_points FROM streams")
+            # Gear stored before gear details expired has no fetch time, so it gets fetched again on the next sync
+            if 'fetched_at' not in [x[1] for x in conn.execute("PRAGMA table_info(gear)")]:
+                conn.execute("ALTER TABLE gear ADD COLUMN fetched_at TEXT")
+
+    # Athletes and gear
+    def saveAthlete(self, athlete_id, athlete_dict) -> None:
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO athletes (id, data, synced_at) VALUES (?, ?, ?)",
+                         (athlete_id, json.dumps(athlete_dict, default=str),
+                          dt.datetime.now(dt.timezone.utc).isoformat()))
+
+    def saveGear(self, athlete_id, gear_dict) -> None:
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO gear (id, athlete_id, data, fetched_at) VALUES (?, ?, ?, ?)",
+                         (gear_dict['id'], athlete_id, json.dumps(gear_dict, default=str),
+                          dt.datetime.now(dt.timezone.utc).isoformat()))
+
+    def loadGear(self, athlete_id) -> list:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT data FROM gear WHERE athlete_id = ?", (athlete_id,)).fetchall()
+        return [json.loads(x[0]) for x in rows]
+
+    def gearFetchedAt(self, athlete_id) -> dict:
+        # {gear_id: when its details were fetched (UTC, ISO format), or None if that isn't known}
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, fetched_at FROM gear WHERE athlete_id = ?", (athlete_id,)).fetchall()
+        return {x[0]: x[1] for x in rows}
+
+    # Daily distance and time per piece of gear (see gear.py), and the activities that went into them
+    def activityGear(self, athlete_id) -> pd.DataFrame:
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT activity_id, gear_id, day, distance, moving_time FROM activity_gear "
+                                     "WHERE athlete_id = ?", conn, params=(athlete_id,))
+
+    def saveGearRollups(self, athlete_id, activity_gear_df, removed_id_list, gear_day_df, emptied_days) -> None:
+        # One transaction, so the rollups never disagree with the activities they were made from. emptied_days are
+        # (gear_id, day) pairs that no longer have any activities.
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM activity_gear WHERE athlete_id = ? AND activity_id = ?",
+                             [(athlete_id, int(x)) for x in removed_id_list])
+            conn.executemany("INSERT OR REPLACE INTO activity_gear "
+                             "(athlete_id, activity_id, gear_id, day, distance, moving_time) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(athlete_id, int(x.activity_id), x.gear_id, x.day, float(x.distance),
+                               float(x.moving_time)) for x in activity_gear_df.itertuples()])
+            conn.executemany("DELETE FROM gear_days WHERE athlete_id = ? AND gear_id = ? AND day = ?",
+                             [(athlete_id, x, y) for x, y in emptied_days])
+            conn.executemany("INSERT OR REPLACE INTO gear_days "
+                             "(athlete_id, gear_id, day, distance, moving_time, activity_count) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             [(athlete_id, x.gear_id, x.day, float(x.distance), float(x.moving_time),
+                               int(x.activity_count)) for x in gear_day_df.itertuples()])
+
+    def gearDaysFrame(self, athlete_id) -> pd.DataFrame:
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT gear_id, day, distance, moving_time, activity_count FROM gear_days "
+                                     "WHERE athlete_id = ? ORDER BY gear_id, day", conn, params=(athlete_id,),
+                                     parse_dates=['day'])
+
+    # Activities
+    def saveActivities(self, athlete_id, activity_dicts, _sync_page=None) -> int:
+        rows = [(athlete_id, x['id'], x.get('type'), isoDate(x.get('start_date')),
+                 json.dumps({col: x.get(col) for col in activity_cols}, default=str))
+                for x in activity_dicts]
+        # A store from before the Parquet table gets its SQLite history copied over first. Otherwise the table would
+        # start out with just these activities, and activityFrame would never fill it.
+        if not self.activity_table.exists(athlete_id):
+            self._fillActivityTable(athlete_id)
+        self._movePartitions(athlete_id, rows)
+        self.activity_table.write(athlete_id, activity_dicts)
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO activities (athlete_id, id, type, start_date, data) "
+                             "VALUES (?, ?, ?, ?, ?)", rows)
+            if _sync_page is not None:
+                conn.execute("INSERT OR REPLACE INTO sync_state (athlete_id, after, last_page) VALUES (?, ?, ?)",
+                             (athlete_id, _sync_page[0], _sync_page[1]))
+        return len(rows)
+
+    def _movePartitions(self, athlete_id, rows) -> None:
+        # Activities we already have, whose type or year changed, have to leave their old Parquet partition
+        if len(rows) == 0:
+            return
+        old_rows = []
+        with self._connect() as conn:
+            # Stay well below SQLite's limit on the number of query parameters
+            for start in range(0, len(rows), 500):
+                chunk = [x[1] for x in rows[start:start + 500]]
+                old_rows += conn.execute("SELECT id, type, start_date FROM activities WHERE athlete_id = ? AND id IN "
+                                         f"({','.join('?' * len(chunk))})", [athlete_id] + chunk).fetchall()
+        new_partitions = {x[1]: (x[2] or 'Other', x[3][:4] if x[3] else None) for x in rows}
+        for activity_id, kind, start_date in old_rows:
+            if start_date is not None and new_partitions[activity_id] != (kind or 'Other', start_date[:4]):
+                self.activity_table.delete(athlete_id, int(start_date[:4]), kind or 'Other', [activity_id])
+
+    def loadSyncState(self, athlete_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT after, last_page FROM sync_state WHERE athlete_id = ?",
+                               (athlete_id,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def clearSyncState(self, athlete_id) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sync_state WHERE athlete_id = ?", (athlete_id,))
+
+    def lastStartDate(self, athlete_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(start_date) FROM activities WHERE athlete_id = ?",
+                               (athlete_id,)).fetchone()
+        if row[0] is None:
+            return None
+        return dt.datetime.fromisoformat(row[0])
+
+    def activityFrame(self, athlete_id, columns=None, types=None, since=None, until=None) -> pd.DataFrame:
+        # Newest first. Only reads the given columns, of the activities of these types that started in [since, until).
+        if not self.activity_table.exists(athlete_id):
+            self._fillActivityTable(athlete_id)
+        return self.activity_table.read(athlete_id, columns, types, since, until)
+
+    def _fillActivityTable(self, athlete_id) -> None:
+        # Activities synced before the Parquet table existed only live in SQLite
+        with self._connect() as conn:
+            rows = conn.execute("SELECT data FROM activities WHERE athlete_id = ?", (athlete_id,)).fetchall()
+        if len(rows) > 0:
+            self.activity_table.write(athlete_id, [json.loads(x[0]) for x in rows])
+
+    def latestStartLatLng(self, athlete_id, activity_type):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM activities WHERE athlete_id = ? AND type = ? "
+                               "ORDER BY start_date DESC LIMIT 1", (athlete_id, activity_type)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]).get('start_latlng') or None
+
+    # Heatmap bookkeeping: which activities have already been added to the tile pyramid
+    def heatmapActivityIds(self, athlete_id, kind) -> set:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT activity_id FROM heatmap_activities WHERE athlete_id = ? AND kind = ?",
+                                (athlete_id, kind)).fetchall()
+        return {x[0] for x in rows}
+
+    def markHeatmapActivities(self, athlete_id, kind, id_list) -> None:
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO heatmap_activities (athlete_id, kind, activity_id) "
+                             "VALUES (?, ?, ?)", [(athlete_id, kind, x) for x in id_list])
+
+    # Spatial index postings: the grid cells (per level) that every activity passes through
+    def saveSpatialPostings(self, athlete_id, activity_id, postings) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM spatial_cells WHERE athlete_id = ? AND activity_id = ?",
+                         (athlete_id, activity_id))
+            conn.executemany("INSERT INTO spatial_cells (athlete_id, level, cell, activity_id) VALUES (?, ?, ?, ?)",
+                             [(athlete_id, level, int(cell), activity_id)
+                              for level, cells in postings for cell in cells])
+            conn.execute("INSERT OR IGNORE INTO spatial_activities (athlete_id, activity_id) VALUES (?, ?)",
+                         (athlete_id, activity_id))
+
+    def spatialIndexedIds(self, athlete_id) -> set:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT activity_id FROM spatial_activities WHERE athlete_id = ?",
+                                (athlete_id,)).fetchall()
+        return {x[0] for x in rows}
+
+    def spatialCandidates(self, athlete_id, level, cells) -> set:
+        candidates = set()
+        with self._connect() as conn:
+            # Stay well below SQLite's limit on the number of query parameters
+            for start in range(0, len(cells), 500):
+                chunk = cells[start:start + 500]
+                rows = conn.execute("SELECT DISTINCT activity_id FROM spatial_cells WHERE athlete_id = ? AND level = ? "
+                                    f"AND cell IN ({','.join('?' * len(chunk))})",
+                                    [athlete_id, level] + list(chunk)).fetchall()
+                candidates.update(x[0] for x in rows)
+        return candidates
+
+    # Route signatures (MinHash signature plus the resampled track) and the repeated-route clusters built from them
+    def saveRouteSignature(self, athlete_id, activity_id, length, signature, samples) -> None:
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO route_signatures "
+                         "(athlete_id, activity_id, length, signature, samples) VALUES (?, ?, ?, ?, ?)",
+                         (athlete_id, activity_id, float(length), signature.astype(np.int64).tobytes(),
+                          samples.astype(np.float64).tobytes()))
+
+    def routeSignatureIds(self, athlete_id) -> set:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT activity_id FROM route_signatures WHERE athlete_id = ?",
+                                (athlete_id,)).fetchall()
+        return {x[0] for x in rows}
+
+    def loadRouteSignatures(self, athlete_id) -> tuple:
+        # Everything stacked into arrays: ids, lengths, signatures (n, hashes), samples (n, points, 2)
+        with self._connect() as conn:
+            rows = conn.execute("SELECT activity_id, length, signature, samples FROM route_signatures "
+                                "WHERE athlete_id = ? ORDER BY activity_id", (athlete_id,)).fetchall()
+        id_list = [x[0] for x in rows]
+        if len(rows) == 0:
+            return id_list, np.zeros(0), np.zeros((0, 0), dtype=np.int64), np.zeros((0, 0, 2))
+        lengths = np.array([x[1] for x in rows], dtype=np.float64)
+        signatures = np.array([np.frombuffer(x[2], dtype=np.int64) for x in rows]).reshape(len(rows), -1)
+        samples = np.array([np.frombuffer(x[3], dtype=np.float64).reshape(-1, 2) for x in rows])
+        return id_list, lengths, signatures, samples
+
+    def saveRouteClusters(self, athlete_id, clusters) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM route_clusters WHERE athlete_id = ?", (athlete_id,))
+            conn.executemany("INSERT INTO route_clusters (athlete_id, activity_id, cluster_id) VALUES (?, ?, ?)",
+                             [(athlete_id, x, y) for x, y in clusters.items()])
+
+    def routeClusters(self, athlete_id) -> dict:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT activity_id, cluster_id FROM route_clusters WHERE athlete_id = ?",
+                                (athlete_id,)).fetchall()
+        return dict(rows)
+
+    # Best efforts: one row per activity and target distance. elapsed_time is NULL if the activity was too short.
+    def missingBestEfforts(self, athlete_id, id_list, names) -> list:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT activity_id, name FROM best_efforts WHERE athlete_id = ?",
+                                (athlete_id,)).fetchall()
+        stored = {}
+        for activity_id, name in rows:
+            stored.setdefault(activity_id, set()).add(name)
+        return [x for x in id_list if not set(names) <= stored.get(x, set())]
+
+    def saveBestEfforts(self, athlete_id, activity_id, targets, results) -> None:
+        rows = []
+        for name, target in targets.items():
+            result = results.get(name)
+            if result is None:
+                rows.append((athlete_id, activity_id, name, target, None, None, None))
+            else:
+                rows.append((athlete_id, activity_id, name, target) + tuple(result))
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO best_efforts "
+                             "(athlete_id, activity_id, name, distance, elapsed_time, start_index, end_index) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def bestEffortsFrame(self, athlete_id, activity_type) -> pd.DataFrame:
+        # Every best effort that has a time, with the start date of its activity, oldest first
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT b.activity_id, b.name, b.distance, b.elapsed_time, a.start_date "
+                                     "FROM best_efforts b JOIN activities a "
+                                     "ON a.athlete_id = b.athlete_id AND a.id = b.activity_id "
+                                     "WHERE b.athlete_id = ? AND a.type = ? AND b.elapsed_time IS NOT NULL "
+                                     "ORDER BY a.start_date", conn, params=(athlete_id, activity_type),
+                                     parse_dates=['start_date'])
+
+    def activityIdsByDate(self, athlete_id, activity_type) -> list:
+        # Newest first
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id FROM activities WHERE athlete_id = ? AND type = ? ORDER BY start_date DESC",
+                                (athlete_id, activity_type)).fetchall()
+        return [x[0] for x in rows]
+
+    # Workout features (see features.py), as JSON, with the version of the extraction they came from
+    def missingFeatures(self, athlete_id, id_list, version) -> list:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT activity_id FROM activity_features WHERE athlete_id = ? AND version = ?",
+                                (athlete_id, version)).fetchall()
+        stored = {x[0] for x in rows}
+        return [x for x in id_list if x not in stored]
+
+    def saveFeatures(self, athlete_id, version, features) -> None:
+        # features is a list of (activity_id, {name: value})
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO activity_features (athlete_id, activity_id, version, data) "
+                             "VALUES (?, ?, ?, ?)",
+                             [(athlete_id, x, version, json.dumps(y)) for x, y in features])
+
+    def featuresFrame(self, athlete_id, activity_type, version) -> pd.DataFrame:
+        # A row per activity with features (of every type if activity_type is None), with its start date, oldest first
+        type_condition = "" if activity_type is None else "AND a.type = ? "
+        with self._connect() as conn:
+            rows = conn.execute("SELECT f.activity_id, a.start_date, f.data FROM activity_features f JOIN activities a "
+                                "ON a.athlete_id = f.athlete_id AND a.id = f.activity_id "
+                                f"WHERE f.athlete_id = ? AND f.version = ? {type_condition}ORDER BY a.start_date",
+                                (athlete_id, version) + (() if activity_type is None else (activity_type,))).fetchall()
+        feature_df = pd.DataFrame.from_records([json.loads(x[2]) for x in rows], index=range(len(rows)))
+        feature_df.insert(0, 'activity_id', [x[0] for x in rows])
+        feature_df.insert(1, 'start_date', pd.to_datetime([x[1] for x in rows], utc=True))
+        return feature_df
+
+    # Training load per activity, and the fitness state at the end of every day (see fitness.py)
+    def trainingLoads(self, athlete_id) -> pd.DataFrame:
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT activity_id, day, load FROM training_loads WHERE athlete_id = ?", conn,
+                                     params=(athlete_id,))
+
+    def saveTrainingLoads(self, athlete_id, load_df, removed_id_list) -> None:
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO training_loads (athlete_id, activity_id, day, load) "
+                             "VALUES (?, ?, ?, ?)",
+                             [(athlete_id, int(x), y, float(z))
+                              for x, y, z in zip(load_df['activity_id'], load_df['day'], load_df['load'])])
+            conn.executemany("DELETE FROM training_loads WHERE athlete_id = ? AND activity_id = ?",
+                             [(athlete_id, int(x)) for x in removed_id_list])
+
+    def lastFitnessDay(self, athlete_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(day) FROM fitness_days WHERE athlete_id = ?", (athlete_id,)).fetchone()
+        return row[0]
+
+    def fitnessState(self, athlete_id, day) -> tuple:
+        # (fitness, fatigue) at the end of the last day before day, or zeros if there's nothing before it
+        with self._connect() as conn:
+            row = conn.execute("SELECT fitness, fatigue FROM fitness_days WHERE athlete_id = ? AND day < ? "
+                               "ORDER BY day DESC LIMIT 1", (athlete_id, day)).fetchone()
+        return (0.0, 0.0) if row is None else tuple(row)
+
+    def saveFitnessDays(self, athlete_id, start_day, rows) -> None:
+        # Replaces everything from start_day on. rows are (day, load, fitness, fatigue).
+        with self._connect() as conn:
+            conn.execute("DELETE FROM fitness_days WHERE athlete_id = ? AND day >= ?", (athlete_id, start_day))
+            conn.executemany("INSERT INTO fitness_days (athlete_id, day, load, fitness, fatigue) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [(athlete_id, x, float(y), float(z), float(w)) for x, y, z, w in rows])
+
+    def fitnessFrame(self, athlete_id) -> pd.DataFrame:
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT day, load, fitness, fatigue FROM fitness_days WHERE athlete_id = ? "
+                                     "ORDER BY day", conn, params=(athlete_id,), parse_dates=['day'])
+
+    # Streams
+    # Streams come in resolution tiers (STREAM_RESOLUTIONS, coarsest first), each stored separately. Medium streams live
+    # directly in the activity's folder, where all streams went before there were tiers; the others get a subfolder.
+    # Wherever a tier is asked for, a finer one that has the same streams will do as well.
+    def _streamDir(self, athlete_id, activity_id, resolution='medium') -> str:
+        path = os.path.join(self.stream_root, str(athlete_id), str(activity_id))
+        return path if resolution == 'medium' else os.path.join(path, resolution)
+
+    @staticmethod
+    def _tiersFrom(resolution) -> list:
+        return STREAM_RESOLUTIONS[STREAM_RESOLUTIONS.index(resolution):]
+
+    def hasStreams(self, athlete_id, activity_id, type_list, resolution=STREAM_RESOLUTIONS[0]) -> bool:
+        return len(self.missingStreams(athlete_id, [activity_id], type_list, resolution)) == 0
+
+    def missingStreams(self, athlete_id, id_list, type_list, resolution=STREAM_RESOLUTIONS[0]) -> list:
+        tiers = self._tiersFrom(resolution)
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT activity_id, types FROM stream_tiers WHERE athlete_id = ? AND resolution IN "
+                                f"({','.join('?' * len(tiers))})", [athlete_id] + tiers).fetchall()
+        stored = {}
+        for activity_id, types in rows:
+            stored.setdefault(activity_id, []).append(set(types.split(',')))
+        return [x for x in id_list if not any(set(type_list) <= y for y in stored.get(x, []))]
+
+    def streamPage(self, athlete_id, activity_type, type_list, resolution, recent_count, offset, limit,
+                   candidate_ids=None) -> list:
+        # (id, whether it has the streams) of up to limit activities of this type, newest first, skipping the first
+        # offset. Only activities with these streams at this resolution (or finer) count, plus the recent_count most
+        # recent ones. Given candidate_ids, only those count, plus the activities that aren't in the spatial index yet.
+        # Goes down the start date index and stops after offset + limit matches, so it doesn't depend on the size of
+        # the history.
+        tiers = self._tiersFrom(resolution)
+        has_streams = (f"EXISTS (SELECT 1 FROM stream_tiers t WHERE t.athlete_id = a.athlete_id "
+                       f"AND t.activity_id = a.id AND t.resolution IN ({','.join('?' * len(tiers))})"
+                       + " AND (',' || t.types || ',') LIKE ?" * len(type_list) + ")")
+        has_streams_params = tiers + [f"%,{x},%" for x in type_list]
+        query = (f"SELECT a.id, {has_streams} FROM activities a WHERE a.athlete_id = ? AND a.type = ? "
+                 f"AND ({has_streams} OR a.id IN (SELECT id FROM activities WHERE athlete_id = ? AND type = ? "
+                 f"ORDER BY start_date DESC LIMIT ?))")
+        params = has_streams_params + [athlete_id, activity_type] + has_streams_params + [athlete_id, activity_type,
+                                                                                          recent_count]
+        with self._connect() as conn:
+            if candidate_ids is not None:
+                conn.execute("CREATE TEMP TABLE candidates (activity_id INTEGER PRIMARY KEY)")
+                conn.executemany("INSERT INTO candidates (activity_id) VALUES (?)", [(x,) for x in candidate_ids])
+                query += (" AND (a.id IN (SELECT activity_id FROM candidates) OR a.id NOT IN "
+                          "(SELECT activity_id FROM spatial_activities WHERE athlete_id = ?))")
+                params.append(athlete_id)
+            rows = conn.execute(query + " ORDER BY a.start_date DESC LIMIT ? OFFSET ?",
+                                params + [limit, offset]).fetchall()
+        return [(x[0], bool(x[1])) for x in rows]
+
+    def saveStreams(self, athlete_id, activity_id, type_list, activity_stream, resolution='medium') -> None:
+        # type_list is what we asked for. Not every activity has every stream (no heartrate, manual entries without
+        # GPS), so we record the request rather than what came back, or we'd keep asking for streams that don't exist.
+        streams = ActivityStreams.fromStrava(type_list, activity_stream)
+        streams.save(self._streamDir(athlete_id, activity_id, resolution))
+        n_points = len(streams)
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT types FROM stream_tiers WHERE athlete_id = ? AND activity_id = ? "
+                               "AND resolution = ?", (athlete_id, activity_id, resolution)).fetchone()
+            stored_types = set() if row is None else set(row[0].split(','))
+            conn.execute("INSERT OR REPLACE INTO stream_tiers (athlete_id, activity_id, resolution, types, n_points) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (athlete_id, activity_id, resolution, ','.join(sorted(stored_types | set(type_list))),
+                          n_points))
+            # New streams mean the derived ones have to be worked out again
+            conn.execute("DELETE FROM derived_streams WHERE athlete_id = ? AND activity_id = ? AND resolution = ?",
+                         (athlete_id, activity_id, resolution))
+
+    def loadStreams(self, athlete_id, activity_id, type_list=None, resolution=STREAM_RESOLUTIONS[0]) -> ActivityStreams:
+        # Memory-mapped, so only the parts that actually get used are read from disk. Comes from the first tier (from
+        # resolution up) that has all of type_list; if none does, from the one that has the most of them.
+        best = ActivityStreams({})
+        for tier in self._tiersFrom(resolution):
+            activity_streams = ActivityStreams.load(self._streamDir(athlete_id, activity_id, tier), type_list)
+            if type_list is not None and all(x in activity_streams for x in type_list):
+                return activity_streams
+            if len(activity_streams.keys()) > len(best.keys()):
+                best = activity_streams
+        return best
+
+    def tierStreams(self, athlete_id, activity_id, resolution, type_list=None) -> ActivityStreams:
+        # The streams of exactly this tier, unlike loadStreams
+        return ActivityStreams.load(self._streamDir(athlete_id, activity_id, resolution), type_list)
+
+    # Derived streams (see derived.py) are extra columns in the tier they were made from, and get added to its types
+    def missingDerived(self, athlete_id, id_list, resolution, version) -> list:
+        # The activities with distance and time streams at this resolution, but no derived streams of this version
+        with self._connect() as conn:
+            tiers = dict(conn.execute("SELECT activity_id, types FROM stream_tiers WHERE athlete_id = ? "
+                                      "AND resolution = ?", (athlete_id, resolution)).fetchall())
+            done = {x[0] for x in conn.execute("SELECT activity_id FROM derived_streams WHERE athlete_id = ? "
+                                               "AND resolution = ? AND version = ?",
+                                               (athlete_id, resolution, version))}
+        return [x for x in id_list if x not in done and {'distance', 'time'} <= set((tiers.get(x) or '').split(','))]
+
+    def saveDerived(self, athlete_id, activity_id, resolution, version, streams) -> None:
+        streams.save(self._streamDir(athlete_id, activity_id, resolution))
+        with self._connect() as conn:
+            row = conn.execute("SELECT types FROM stream_tiers WHERE athlete_id = ? AND activity_id = ? "
+                               "AND resolution = ?", (athlete_id, activity_id, resolution)).fetchone()
+            stored_types = set() if row is None else set(row[0].split(','))
+            conn.execute("UPDATE stream_tiers SET types = ? WHERE athlete_id = ? AND activity_id = ? "
+                         "AND resolution = ?",
+                         (','.join(sorted(stored_types | set(streams.keys()))), athlete_id, activity_id, resolution))
+            conn.execute("INSERT OR REPLACE INTO derived_streams (athlete_id, activity_id, resolution, version) "
+                         "VALUES (?, ?, ?, ?)", (athlete_id, activity_id, resolution, version))
+
+    # Simplified polylines, one file per tolerance, so changing the tolerances doesn't pick up stale levels
+    def saveSimplified(self, athlete_id, activity_id, tolerances, polylines) -> None:
+        lod_dir = os.path.join(self._streamDir(athlete_id, activity_id), 'lod')
+        os.makedirs(lod_dir, exist_ok=True)
+        for tolerance, polyline in zip(tolerances, polylines):
+            if tolerance > 0:
+                np.save(os.path.join(lod_dir, f"{tolerance:g}.npy"), polyline)
+
+    def loadSimplified(self, athlete_id, activity_id, tolerances, latlng):
+        # Level 0 is latlng itself. Returns None if any of the other levels hasn't been computed yet.
+        lod_dir = os.path.join(self._streamDir(athlete_id, activity_id), 'lod')
+        polylines = []
+        for tolerance in tolerances:
+            if tolerance <= 0:
+                polylines.append(latlng)
+                continue
+            path = os.path.join(lod_dir, f"{tolerance:g}.npy")
+            if not os.path.exists(path):
+                return None
+            polylines.append(np.load(path, mmap_mode='r'))
+        return polylines
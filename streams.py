@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+
+
+# Storage types per stream. Anything that isn't listed here is kept as float32.
+STREAM_DTYPES = {
+    'latlng': np.float64,
+    'time': np.int32,
+    'distance': np.float32,
+    'altitude': np.float32,
+    'heartrate': np.int16,
+    'cadence': np.int16,
+    'watts': np.int16,
+    'temp': np.int16,
+    'velocity_smooth': np.float32,
+    'grade_smooth': np.float32,
+    'moving': np.bool_,
+    'is_moving': np.bool_,
+    'hr_zone': np.int8,
+}
+
+
+class ActivityStreams:
+    # The streams of one activity, as one typed NumPy array per stream type (latlng is an (N, 2) array).
+    # Slicing with a range gives a new ActivityStreams whose columns are views on the same memory, so cutting out a
+    # segment doesn't copy anything. On disk, every column is a separate .npy file, which can be memory-mapped.
+    def __init__(self, columns=None):
+        self.columns = {} if columns is None else columns
+
+    @classmethod
+    def fromStrava(cls, _type_list, _activity_stream):
+        # _activity_stream is what stravalib's get_activity_streams returns: a dict of stream objects with .data
+        columns = {}
+        if _activity_stream is not None:
+            for item in _type_list:
+                if item in _activity_stream.keys():
+                    data = _activity_stream[item]
+                    data = data if isinstance(data, np.ndarray) else data.data
+                    columns[item] = np.asarray(data, dtype=STREAM_DTYPES.get(item, np.float32))
+        return cls(columns)
+
+    @classmethod
+    def load(cls, _path, _type_list=None, _mmap=True):
+        columns = {}
+        if os.path.isdir(_path):
+            for file_name in sorted(os.listdir(_path)):
+                item, extension = os.path.splitext(file_name)
+                if extension == '.npy' and (_type_list is None or item in _type_list):
+                    columns[item] = np.load(os.path.join(_path, file_name), mmap_mode='r' if _mmap else None)
+        return cls(columns)
+
+    def save(self, _path) -> None:
+        os.makedirs(_path, exist_ok=True)
+        for item, data in self.columns.items():
+            np.save(os.path.join(_path, item + '.npy'), data)
+
+    def __len__(self):
+        if len(self.columns) == 0:
+            return 0
+        return max(x.shape[0] for x in self.columns.values())
+
+    def __contains__(self, item):
+        return item in self.columns
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        return ActivityStreams({item: data[key] for item, data in self.columns.items()})
+
+    def keys(self):
+        return self.columns.keys()
+
+    def get(self, item, default=None):
+        return self.columns.get(item, default)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(x.nbytes for x in self.columns.values())
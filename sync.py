@@ -0,0 +1,55 @@
+from parameters import *
+
+
+# Full-history activity sync, set up as a chain of generators so only one page of activities is held in memory at a
+# time. Pages are requested in ascending start_date order (that's what Strava does when "after" is given), which
+# keeps page boundaries stable while new activities get added, so an interrupted sync can pick up at the next page.
+def pageActivities(_client, _after=0, _start_page=1, _per_page=SYNC_PAGE_SIZE):
+    page_index = _start_page
+    while True:
+        page = _client.protocol.get('/athlete/activities', after=_after, page=page_index, per_page=_per_page)
+        if len(page) == 0:
+            return
+        yield page_index, page
+        if len(page) < _per_page:
+            return
+        page_index += 1
+
+
+def journalPages(_pages, _journal, _athlete_id, _after):
+    # Records every page in the response journal, as it came from the API, on its way through
+    for page_index, page in _pages:
+        _journal.record('activities', _athlete_id, page_index, page, {'after': _after})
+        yield page_index, page
+
+
+def extractActivities(_pages):
+    for page_index, page in _pages:
+        yield page_index, [{col: activity.get(col) for col in activity_cols} for activity in page]
+
+
+def syncActivities(_client, _store, _athlete_id, _per_page=SYNC_PAGE_SIZE, _journal=None) -> int:
+    # Resume an interrupted sync where it left off. Otherwise, start after the most recent activity in the store
+    # (or at the very beginning for a new athlete).
+    sync_state = _store.loadSyncState(_athlete_id)
+    if sync_state is not None:
+        after, last_page = sync_state
+        start_page = last_page + 1
+        print(f"Resuming activity sync at page {start_page}")
+    else:
+        last_start_date = _store.lastStartDate(_athlete_id)
+        after = 0 if last_start_date is None else int(last_start_date.timestamp())
+        start_page = 1
+
+    pages = pageActivities(_client, after, start_page, _per_page)
+    if _journal is not None:
+        pages = journalPages(pages, _journal, _athlete_id, after)
+    activity_count = 0
+    for page_index, activity_data in extractActivities(pages):
+        # Every page gets written together with the sync progress, so the two can't get out of step.
+        _store.saveActivities(_athlete_id, activity_data, _sync_page=(after, page_index))
+        activity_count += len(activity_data)
+        print(f"Synced page {page_index} ({activity_count} activities so far)")
+
+    _store.clearSyncState(_athlete_id)
+    return activity_count